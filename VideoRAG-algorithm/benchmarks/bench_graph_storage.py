@@ -0,0 +1,109 @@
+"""
+Load / save timings for the NetworkX graph storage formats.
+
+Builds a synthetic entity graph shaped like the ones entity extraction
+produces (upper-case quoted entity names, <SEP>-joined descriptions and
+source chunk ids, weighted edges) and compares GraphML with the binary
+snapshot NetworkXStorage now writes.
+
+    python benchmarks/bench_graph_storage.py --nodes 10000 50000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import networkx as nx
+
+from videorag._storage.gdb_networkx import NetworkXStorage
+from videorag.prompt import GRAPH_FIELD_SEP
+
+ENTITY_TYPES = ['"PERSON"', '"ORGANIZATION"', '"LOCATION"', '"EVENT"', '"OBJECT"']
+
+
+def make_graph(num_nodes, edges_per_node, rng):
+    words = np.array([f"word{i}" for i in range(5000)])
+    chunk_ids = np.array([f"chunk-{i:032x}" for i in range(max(1, num_nodes // 5))])
+
+    def description(mentions):
+        return GRAPH_FIELD_SEP.join(
+            " ".join(rng.choice(words, 30)) for _ in range(mentions)
+        )
+
+    def sources(mentions):
+        return GRAPH_FIELD_SEP.join(rng.choice(chunk_ids, mentions))
+
+    graph = nx.Graph()
+    for i in range(num_nodes):
+        mentions = int(rng.integers(1, 6))
+        graph.add_node(
+            f'"ENTITY {i}"',
+            entity_type=ENTITY_TYPES[i % len(ENTITY_TYPES)],
+            description=description(mentions),
+            source_id=sources(mentions),
+        )
+    names = list(graph.nodes)
+    for _ in range(num_nodes * edges_per_node):
+        src, tgt = rng.choice(num_nodes, 2, replace=False)
+        graph.add_edge(
+            names[src],
+            names[tgt],
+            weight=float(rng.integers(1, 10)),
+            description=description(1),
+            source_id=sources(1),
+            order=1,
+        )
+    return graph
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def bench(name, write, read, graph, file_name):
+    save_time, _ = timed(lambda: write(graph, file_name))
+    load_time, loaded = timed(lambda: read(file_name))
+    assert loaded.number_of_nodes() == graph.number_of_nodes()
+    assert loaded.number_of_edges() == graph.number_of_edges()
+    print(
+        f"{name:>10} {graph.number_of_nodes():>8} nodes {graph.number_of_edges():>8} edges | "
+        f"load {load_time * 1000:>9.1f} ms | save {save_time * 1000:>9.1f} ms | "
+        f"{os.path.getsize(file_name) / 2**20:>7.1f} MiB"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--edges-per-node", type=int, default=3)
+    args = parser.parse_args()
+
+    for num_nodes in args.nodes:
+        graph = make_graph(num_nodes, args.edges_per_node, np.random.default_rng(0))
+        workdir = tempfile.mkdtemp(prefix="graph-bench-")
+        try:
+            bench(
+                "graphml",
+                NetworkXStorage.write_nx_graph,
+                NetworkXStorage.load_nx_graph,
+                graph,
+                os.path.join(workdir, "graph.graphml"),
+            )
+            bench(
+                "snapshot",
+                NetworkXStorage.write_nx_snapshot,
+                NetworkXStorage.load_nx_snapshot,
+                graph,
+                os.path.join(workdir, "graph.npz"),
+            )
+        finally:
+            shutil.rmtree(workdir)
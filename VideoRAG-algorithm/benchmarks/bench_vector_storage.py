@@ -0,0 +1,150 @@
+"""
+Load / save / query timings for the session vector stores.
+
+Compares NanoVectorDB (one JSON file, rewritten on every save) with
+MmapVectorDB (append-only matrix + metadata sidecar) in each storage layout.
+"save" is measured the way ingestion uses it: after upserting one more video
+worth of vectors into an already populated store. recall@k is measured
+against exact float32 search over the same vectors, with queries drawn near
+stored vectors so that the neighbourhoods are meaningful.
+
+    python benchmarks/bench_vector_storage.py --sizes 10000 100000 1000000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nano_vectordb import NanoVectorDB
+
+from videorag._storage.vdb_mmap import MmapVectorDB
+
+VIDEO_SEGMENTS = 120  # a one-hour video cut into 30s segments
+# (name, storage dtype, rescore factor)
+LAYOUTS = [
+    ("float32", "float32", 0),
+    ("float16", "float16", 0),
+    ("float16+rescore", "float16", 4),
+    ("int8", "int8", 0),
+    ("int8+rescore", "int8", 4),
+]
+
+
+def make_datas(start, count, dim, rng):
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    return [
+        {"__id__": f"video_{i}", "__video_name__": "video", "__index__": str(i), "__vector__": v}
+        for i, v in zip(range(start, start + count), vectors)
+    ]
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def exact_top_k(size, dim, queries, k, seed):
+    """Ground truth from the same vectors the stores were filled with"""
+    rng = np.random.default_rng(seed)
+    normed = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    best = [[] for _ in queries]
+    for start in range(0, size, 50000):
+        datas = make_datas(start, min(50000, size - start), dim, rng)
+        vectors = np.stack([d["__vector__"] for d in datas])
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        scores = vectors @ normed.T
+        for i in range(len(queries)):
+            best[i].extend(zip(scores[:, i], (d["__id__"] for d in datas)))
+            best[i] = sorted(best[i], reverse=True)[:k]
+    return [{id_ for _, id_ in b} for b in best]
+
+
+def recall_at_k(client, queries, truth, k):
+    hits = [
+        len({r["__id__"] for r in client.query(q, top_k=k, better_than_threshold=-1)} & t)
+        for q, t in zip(queries, truth)
+    ]
+    return sum(hits) / (k * len(queries))
+
+
+def disk_bytes(workdir, prefix):
+    return sum(
+        os.path.getsize(os.path.join(workdir, f))
+        for f in os.listdir(workdir)
+        if f.startswith(prefix) and not f.endswith((".json", ".jsonl"))
+    )
+
+
+def bench(name, open_client, size, dim, queries, seed, truth=None, k=10, prefix=None, workdir=None):
+    rng = np.random.default_rng(seed)
+    client = open_client()
+    for start in range(0, size, 50000):
+        client.upsert(make_datas(start, min(50000, size - start), dim, rng))
+    client.save()
+    del client
+
+    load_time, client = timed(open_client)
+    client.upsert(make_datas(size, VIDEO_SEGMENTS, dim, rng))
+    save_time, _ = timed(client.save)
+    query_times = [
+        timed(lambda: client.query(q, top_k=10, better_than_threshold=-1))[0] for q in queries
+    ]
+    extra = ""
+    if truth is not None:
+        extra = (
+            f" | vectors {disk_bytes(workdir, prefix) / 2**20:>8.1f} MiB"
+            f" | recall@{k} {recall_at_k(client, queries, truth, k):.3f}"
+        )
+    print(
+        f"{name:>20} {size:>9} | load {load_time * 1000:>9.1f} ms | "
+        f"save {save_time * 1000:>9.1f} ms | query p50 {np.median(query_times) * 1000:>8.2f} ms"
+        + extra
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--nano-max", type=int, default=100000, help="skip NanoVectorDB above this size")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    seed = 0
+    for size in args.sizes:
+        # queries are noisy copies of stored vectors
+        stored = np.stack(
+            [d["__vector__"] for d in make_datas(0, min(size, 50000), args.dim, np.random.default_rng(seed))]
+        )
+        query_rng = np.random.default_rng(1)
+        queries = stored[query_rng.choice(len(stored), args.queries, replace=False)]
+        queries = queries + 0.5 * query_rng.standard_normal(queries.shape, dtype=np.float32)
+        workdir = tempfile.mkdtemp(prefix="vdb-bench-")
+        try:
+            truth = exact_top_k(size, args.dim, queries, args.k, seed)
+            if size <= args.nano_max:
+                bench(
+                    "nanovectordb",
+                    lambda: NanoVectorDB(args.dim, storage_file=os.path.join(workdir, "vdb_nano.json")),
+                    size, args.dim, queries, seed,
+                )
+            for name, dtype, rescore_factor in LAYOUTS:
+                prefix = f"vdb_{name}"
+                bench(
+                    f"mmap-{name}",
+                    lambda: MmapVectorDB(
+                        args.dim, os.path.join(workdir, prefix), dtype=dtype, rescore_factor=rescore_factor
+                    ),
+                    size, args.dim, queries, seed, truth=truth, k=args.k, prefix=prefix, workdir=workdir,
+                )
+        finally:
+            shutil.rmtree(workdir)
@@ -1 +1,3 @@
-from .videorag import VideoRAG, QueryParam
\ No newline at end of file
+from .videorag import VideoRAG, QueryParam, VideoScope
+from ._scheduler import LLMScheduler
+from ._batch import LocalBatchServer
@@ -0,0 +1,439 @@
+"""
+Entity extraction through an OpenAI-compatible batch API.
+
+Bulk ingestion spends most of its time and money on the per-chunk extraction
+calls (and their gleaning rounds). BatchCompletion stands in for the best
+model function: the calls of all chunks are collected into rounds, each round
+is written to a JSONL file, uploaded and submitted as one batch job, polled
+until it finishes, and the answers are handed back to the waiting chunks,
+which then go on to their next gleaning call or to the merge phase. This
+follows the upload / download / parse steps of reproduce/*/batch_*_upload.py.
+
+Answers are written to the LLM response cache under the same key the
+interactive completion functions use, and submitted jobs are recorded in
+`<working_dir>/_batch/jobs.json`, so an ingestion that is stopped and started
+again replays finished rounds from the cache and resumes polling the job it
+was waiting on instead of submitting it again.
+
+LocalBatchServer implements the same files / batches endpoints on top of any
+async completion function, for tests and for providers without a batch API.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from openai import AsyncOpenAI
+
+from ._llm import get_openai_async_client_instance
+from ._utils import compute_args_hash, compute_mdhash_id, load_json, logger, write_json
+from .base import BaseKVStorage
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchCompletion:
+    """A completion function (`prompt, system_prompt=None, history_messages=[]`)
+    whose calls are answered by batch jobs of `model`.
+
+    Callers are wrapped with `track`; once every tracked caller is waiting on a
+    call, the calls not yet submitted go out as one round. Requests the batch
+    could not answer are retried through `fallback_func` when given, like the
+    re-requests of the reproduce parse scripts."""
+
+    def __init__(
+        self,
+        model: str,
+        working_dir: str,
+        hashing_kv: BaseKVStorage = None,
+        fallback_func: callable = None,
+        base_url: str = None,
+        api_key: str = None,
+        poll_interval: float = 60,
+        completion_window: str = "24h",
+        max_requests_per_batch: int = 50000,
+    ):
+        self.model = model
+        self.hashing_kv = hashing_kv
+        self.fallback_func = fallback_func
+        self.client = (
+            AsyncOpenAI(base_url=base_url, api_key=api_key)
+            if base_url is not None or api_key is not None
+            else get_openai_async_client_instance()
+        )
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.max_requests_per_batch = max_requests_per_batch
+        self._dir = os.path.join(working_dir, "_batch")
+        self._state_file = os.path.join(self._dir, "jobs.json")
+        # tracked callers, and calls whose answer is not in yet
+        self._active = 0
+        self._waiting = 0
+        # args hash -> (request body, waiting futures), not submitted yet
+        self._pending: dict[str, tuple[dict, list[asyncio.Future]]] = {}
+        self._rounds = set()
+
+    async def __call__(self, prompt, system_prompt=None, history_messages=[], **kwargs) -> str:
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.extend(history_messages)
+        messages.append({"role": "user", "content": prompt})
+        args_hash = compute_args_hash(self.model, messages)
+        if self.hashing_kv is not None:
+            if_cache_return = await self.hashing_kv.get_by_id(args_hash)
+            if if_cache_return is not None and if_cache_return["return"] is not None:
+                return if_cache_return["return"]
+
+        future = asyncio.get_running_loop().create_future()
+        if args_hash in self._pending:
+            self._pending[args_hash][1].append(future)
+        else:
+            self._pending[args_hash] = ({"model": self.model, "messages": messages, **kwargs}, [future])
+        self._waiting += 1
+        self._maybe_submit()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._waiting -= 1
+                self._maybe_submit()
+            raise
+
+    def track(self, coro):
+        """Wrap a caller whose calls should be grouped with the other callers'.
+        It counts as running from now on, not from when it is first scheduled,
+        so the callers of one gather are all waited for."""
+        self._active += 1
+        return self._tracked(coro)
+
+    async def _tracked(self, coro):
+        try:
+            return await coro
+        finally:
+            self._active -= 1
+            self._maybe_submit()
+
+    def _maybe_submit(self):
+        # a caller that is still running may add a call to this round
+        if not self._pending or self._waiting < self._active:
+            return
+        requests, self._pending = self._pending, {}
+        task = asyncio.ensure_future(self._run_round(requests))
+        self._rounds.add(task)
+        task.add_done_callback(self._rounds.discard)
+
+    def _resolve(self, futures: list[asyncio.Future], result=None, exception=None):
+        for future in futures:
+            if future.done():
+                continue
+            # counted here rather than when the caller resumes, so that the
+            # answered callers are not mistaken for waiting ones meanwhile
+            self._waiting -= 1
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    async def _run_round(self, requests: dict[str, tuple[dict, list[asyncio.Future]]]):
+        keys = list(requests)
+        jobs = [
+            {k: requests[k][0] for k in keys[i : i + self.max_requests_per_batch]}
+            for i in range(0, len(keys), self.max_requests_per_batch)
+        ]
+        logger.info(f"Submitting {len(keys)} {self.model} calls as {len(jobs)} batch job(s)")
+        try:
+            results = {}
+            for job_results in await asyncio.gather(*[self._run_job(job) for job in jobs]):
+                results.update(job_results)
+            missing = [k for k in keys if k not in results]
+            if missing:
+                if self.fallback_func is None:
+                    raise RuntimeError(f"Batch jobs did not answer {len(missing)} of {len(keys)} requests")
+                logger.warning(f"Batch jobs did not answer {len(missing)} of {len(keys)} requests, re-requesting them")
+                answers = await asyncio.gather(
+                    *[
+                        self.fallback_func(
+                            requests[k][0]["messages"][-1]["content"],
+                            history_messages=requests[k][0]["messages"][:-1],
+                        )
+                        for k in missing
+                    ]
+                )
+                results.update(zip(missing, answers))
+        except Exception as e:
+            logger.error(f"Batch round of {len(keys)} requests failed: {e}")
+            for _, futures in requests.values():
+                self._resolve(futures, exception=e)
+            return
+        for k, (_, futures) in requests.items():
+            self._resolve(futures, results[k])
+        self._maybe_submit()
+
+    async def _run_job(self, requests: dict[str, dict]) -> dict[str, str]:
+        """Submit (or resume) one batch job and return its answers by args hash"""
+        job_key = compute_mdhash_id("".join(sorted(requests)), prefix="batch-")
+        input_file = os.path.join(self._dir, f"{job_key}.jsonl")
+        jobs = load_json(self._state_file) or {}
+        batch_id = jobs.get(job_key)
+        if batch_id is None:
+            os.makedirs(self._dir, exist_ok=True)
+            with open(input_file, "w", encoding="utf-8") as f:
+                for custom_id, body in requests.items():
+                    f.write(
+                        json.dumps(
+                            {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+                            ensure_ascii=False,
+                        )
+                        + "\n"
+                    )
+            with open(input_file, "rb") as f:
+                batch_input_file = await self.client.files.create(file=f, purpose="batch")
+            batch = await self.client.batches.create(
+                input_file_id=batch_input_file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window=self.completion_window,
+                metadata={"description": f"videorag entity extraction: {job_key}"},
+            )
+            batch_id = batch.id
+            jobs = load_json(self._state_file) or {}
+            jobs[job_key] = batch_id
+            write_json(jobs, self._state_file)
+            logger.info(f"Batch {batch_id} has been created for {len(requests)} requests")
+        else:
+            logger.info(f"Resuming batch {batch_id} for {len(requests)} requests")
+
+        while True:
+            batch = await self.client.batches.retrieve(batch_id)
+            if batch.status in BATCH_FINAL_STATUSES:
+                break
+            counts = batch.request_counts
+            if counts is not None:
+                logger.info(f"Batch {batch_id} {batch.status}: {counts.completed}/{counts.total} done")
+            await asyncio.sleep(self.poll_interval)
+        if batch.status != "completed":
+            logger.warning(f"Batch {batch_id} ended as {batch.status}")
+
+        results = {}
+        failed = 0
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await self.client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                dp = json.loads(line)
+                response = dp.get("response") or {}
+                try:
+                    assert response.get("status_code") == 200
+                    results[dp["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+                except (AssertionError, KeyError, IndexError, TypeError):
+                    failed += 1
+        if failed:
+            logger.warning(f"Batch {batch_id}: {failed} requests failed")
+        results = {k: v for k, v in results.items() if k in requests and v is not None}
+
+        if self.hashing_kv is not None and results:
+            await self.hashing_kv.upsert(
+                {k: {"return": v, "model": self.model} for k, v in results.items()}
+            )
+            await self.hashing_kv.index_done_callback()
+        # the answers are cached (or handed back) now, the job is done with
+        jobs = load_json(self._state_file) or {}
+        jobs.pop(job_key, None)
+        write_json(jobs, self._state_file)
+        if os.path.exists(input_file):
+            os.remove(input_file)
+        return results
+
+
+class _BatchRequestHandler(BaseHTTPRequestHandler):
+    server: "_BatchHTTPServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, obj: dict, status: int = 200):
+        self._send(status, json.dumps(obj).encode("utf-8"))
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        state = self.server.state
+        if self.path.rstrip("/").endswith("/files"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + self._body()
+            )
+            fields = {
+                part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                for part in message.iter_parts()
+            }
+            self._send_json(state.add_file(fields["file"], fields.get("purpose", b"batch").decode()))
+        elif self.path.rstrip("/").endswith("/batches"):
+            self._send_json(state.create_batch(json.loads(self._body())))
+        else:
+            self._send_json({"error": {"message": f"Unknown path {self.path}"}}, 404)
+
+    def do_GET(self):
+        state = self.server.state
+        parts = self.path.rstrip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in state.batches:
+            self._send_json(state.batches[parts[-1]])
+        elif len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content" and parts[-2] in state.files:
+            self._send(200, state.files[parts[-2]], "application/octet-stream")
+        else:
+            self._send_json({"error": {"message": f"Unknown path {self.path}"}}, 404)
+
+
+class _BatchHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    state: "LocalBatchServer"
+
+
+class LocalBatchServer:
+    """Serves the files and batches endpoints of the OpenAI API, answering
+    every request of a batch with `complete(body) -> str` (an async function
+    taking the chat completion request body), at most `max_async` at a time."""
+
+    def __init__(self, complete: callable, max_async: int = 16):
+        self.complete = complete
+        self.max_async = max_async
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.base_url = None
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serve in a background thread; returns the base_url clients use"""
+        self._server = _BatchHTTPServer((host, port), _BatchRequestHandler)
+        self._server.state = self
+        bound_host, bound_port = self._server.server_address[:2]
+        self.base_url = f"http://{bound_host}:{bound_port}/v1"
+        self._thread = threading.Thread(target=self._server.serve_forever, name="local-batch-server", daemon=True)
+        self._thread.start()
+        logger.info(f"Local batch server listening on {self.base_url}")
+        return self.base_url
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+    def _new_id(self, prefix: str) -> str:
+        with self._lock:
+            return f"{prefix}-{next(self._ids)}"
+
+    def add_file(self, content: bytes, purpose: str) -> dict:
+        file_id = self._new_id("file")
+        self.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": f"{file_id}.jsonl",
+            "purpose": purpose,
+            "status": "processed",
+        }
+
+    def create_batch(self, params: dict) -> dict:
+        batch_id = self._new_id("batch")
+        batch = self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": params["endpoint"],
+            "input_file_id": params["input_file_id"],
+            "completion_window": params.get("completion_window", "24h"),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "completed_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": params.get("metadata"),
+        }
+        threading.Thread(target=asyncio.run, args=(self._run_batch(batch),), daemon=True).start()
+        return batch
+
+    async def _run_batch(self, batch: dict):
+        requests = [
+            json.loads(line)
+            for line in self.files[batch["input_file_id"]].decode("utf-8").splitlines()
+            if line.strip()
+        ]
+        batch["request_counts"]["total"] = len(requests)
+        batch["status"] = "in_progress"
+        semaphore = asyncio.Semaphore(self.max_async)
+        outputs, errors = [], []
+
+        async def run_request(request: dict):
+            async with semaphore:
+                try:
+                    content = await self.complete(request["body"])
+                except Exception as e:
+                    batch["request_counts"]["failed"] += 1
+                    errors.append(
+                        {
+                            "id": self._new_id("batch_req"),
+                            "custom_id": request["custom_id"],
+                            "response": {"status_code": 500, "body": {"error": {"message": str(e)}}},
+                            "error": None,
+                        }
+                    )
+                    return
+            batch["request_counts"]["completed"] += 1
+            outputs.append(
+                {
+                    "id": self._new_id("batch_req"),
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "object": "chat.completion",
+                            "model": request["body"].get("model"),
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {"role": "assistant", "content": content},
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                        },
+                    },
+                    "error": None,
+                }
+            )
+
+        await asyncio.gather(*[run_request(r) for r in requests])
+
+        def to_file(lines: list[dict]):
+            if not lines:
+                return None
+            return self.add_file("".join(json.dumps(l) + "\n" for l in lines).encode("utf-8"), "batch_output")["id"]
+
+        batch["output_file_id"] = to_file(outputs)
+        batch["error_file_id"] = to_file(errors)
+        batch["completed_at"] = int(time.time())
+        batch["status"] = "completed"
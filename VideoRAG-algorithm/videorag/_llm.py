@@ -17,8 +17,15 @@ from tenacity import (
     retry_if_exception_type,
 )
 import os
-
-from ._utils import compute_args_hash, wrap_embedding_func_with_attrs
+from contextlib import asynccontextmanager
+
+from ._scheduler import SchedulerSlot
+from ._utils import (
+    TokenBucketLimiter,
+    compute_args_hash,
+    encode_string_by_tiktoken,
+    wrap_embedding_func_with_attrs,
+)
 from .base import BaseKVStorage
 from ._utils import EmbeddingFunc
 
@@ -70,6 +77,20 @@ class LLMConfig:
     cheap_model_max_token_size: int
     cheap_model_max_async: int
 
+    # Per-request limits of the embedding endpoint, defaulting to
+    # EMBEDDING_PROVIDER_LIMITS for the known providers
+    embedding_max_inputs_per_request: int = None
+    embedding_max_tokens_per_request: int = None
+
+    # Provider quotas per model in requests / tokens per minute, None leaves
+    # that dimension unmetered (see model_rate_limiters)
+    best_model_rpm: int = None
+    best_model_tpm: int = None
+    cheap_model_rpm: int = None
+    cheap_model_tpm: int = None
+    # completion tokens reserved for a call that does not pass max_tokens
+    expected_completion_tokens: int = 512
+
     # Assigned in post init
     embedding_func: EmbeddingFunc  = None    
     best_model_func: callable = None    
@@ -90,6 +111,103 @@ class LLMConfig:
             self.cheap_model_name, prompt, *args, **kwargs
         )
 
+# (max inputs, max total tokens) a single embedding request may carry
+EMBEDDING_PROVIDER_LIMITS = {
+    "openai_embedding": (2048, 300000),
+    "azure_openai_embedding": (2048, 300000),
+    # text-embedding-v3 / v4 accept at most 10 texts per call
+    "dashscope_embedding": (10, 81920),
+    # SiliconFlow BAAI/bge-m3
+    "bge_m3_embedding": (32, 65536),
+}
+
+
+def embedding_request_limits(llm) -> tuple[int, int]:
+    """Resolve (max inputs, max tokens) per embedding request for an LLMConfig"""
+    raw_name = getattr(llm.embedding_func_raw, "__name__", None)
+    max_inputs, max_tokens = EMBEDDING_PROVIDER_LIMITS.get(
+        raw_name,
+        (llm.embedding_batch_num, llm.embedding_batch_num * llm.embedding_max_token_size),
+    )
+    max_inputs = min(max_inputs, llm.embedding_batch_num)
+    return (
+        getattr(llm, "embedding_max_inputs_per_request", None) or max_inputs,
+        getattr(llm, "embedding_max_tokens_per_request", None) or max_tokens,
+    )
+
+# one bucket per model and quota, shared by every session in the process
+# since they draw on the same provider quota; a config with other limits for
+# the same model gets its own bucket instead of silently inheriting the first
+_model_rate_limiters: dict[tuple, TokenBucketLimiter] = {}
+
+
+def without_rate_limit_retry(func):
+    """`func` with its tenacity retry narrowed to connection errors, for callers
+    that back off on 429 themselves (EmbeddingBatcher); direct callers of the
+    embedding functions keep the RateLimitError retry"""
+    retry_with = getattr(func, "retry_with", None)
+    if retry_with is None:
+        return func
+    return retry_with(retry=retry_if_exception_type(APIConnectionError))
+
+
+def model_rate_limiters(llm) -> tuple[TokenBucketLimiter, TokenBucketLimiter]:
+    """Rate limiters of the best and cheap model of an LLMConfig, None for a
+    model without a configured quota"""
+    limiters = []
+    for prefix in ("best_model", "cheap_model"):
+        rpm = getattr(llm, f"{prefix}_rpm", None)
+        tpm = getattr(llm, f"{prefix}_tpm", None)
+        model_name = getattr(llm, f"{prefix}_name")
+        if not rpm and not tpm:
+            limiters.append(None)
+            continue
+        key = (model_name, rpm, tpm)
+        if key not in _model_rate_limiters:
+            _model_rate_limiters[key] = TokenBucketLimiter(
+                rpm=rpm,
+                tpm=tpm,
+                expected_completion_tokens=getattr(llm, "expected_completion_tokens", 512),
+            )
+        limiters.append(_model_rate_limiters[key])
+    return tuple(limiters)
+
+
+async def _acquire_quota(rate_limiter: TokenBucketLimiter, messages: list[dict], kwargs: dict):
+    """Wait until the model's quota admits the call; returns the reservation
+    for _settle_quota"""
+    if rate_limiter is None:
+        return None
+    prompt_tokens = sum(len(encode_string_by_tiktoken(str(m["content"]))) for m in messages)
+    reserved = prompt_tokens + kwargs.get("max_tokens", rate_limiter.expected_completion_tokens)
+    await rate_limiter.acquire(reserved)
+    return prompt_tokens, reserved
+
+
+def _settle_quota(rate_limiter: TokenBucketLimiter, reservation, content: str):
+    if reservation is None:
+        return
+    prompt_tokens, reserved = reservation
+    rate_limiter.settle(prompt_tokens + len(encode_string_by_tiktoken(content or "")) - reserved)
+
+
+def _refund_quota(rate_limiter: TokenBucketLimiter, reservation):
+    """Return the tokens of a failed call, which the retry reserves again"""
+    if reservation is None:
+        return
+    rate_limiter.settle(-reservation[1])
+
+
+@asynccontextmanager
+async def _scheduled(scheduler_slot: SchedulerSlot):
+    """Hold a slot of the shared scheduler, if any, for one provider call"""
+    if scheduler_slot is None:
+        yield
+        return
+    async with scheduler_slot.held():
+        yield
+
+
 ##### OpenAI Configuration
 @retry(
     stop=stop_after_attempt(5),
@@ -101,6 +219,8 @@ async def openai_complete_if_cache(
 ) -> str:
     openai_async_client = get_openai_async_client_instance()
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    rate_limiter: TokenBucketLimiter = kwargs.pop("rate_limiter", None)
+    scheduler_slot: SchedulerSlot = kwargs.pop("scheduler_slot", None)
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
@@ -113,9 +233,16 @@ async def openai_complete_if_cache(
         if if_cache_return is not None and if_cache_return["return"] is not None:
             return if_cache_return["return"]
 
-    response = await openai_async_client.chat.completions.create(
-        model=model, messages=messages, **kwargs
-    )
+    async with _scheduled(scheduler_slot):
+        reservation = await _acquire_quota(rate_limiter, messages, kwargs)
+        try:
+            response = await openai_async_client.chat.completions.create(
+                model=model, messages=messages, **kwargs
+            )
+        except BaseException:
+            _refund_quota(rate_limiter, reservation)
+            raise
+        _settle_quota(rate_limiter, reservation, response.choices[0].message.content)
 
     if hashing_kv is not None:
         await hashing_kv.upsert(
@@ -157,7 +284,7 @@ async def openai_embedding(model_name: str, texts: list[str]) -> np.ndarray:
     response = await openai_async_client.embeddings.create(
         model=model_name, input=texts, encoding_format="float"
     )
-    return np.array([dp.embedding for dp in response.data])
+    return np.array([dp.embedding for dp in response.data], dtype=np.float32)
 
 openai_config = LLMConfig(
     embedding_func_raw = openai_embedding,
@@ -212,6 +339,8 @@ async def azure_openai_complete_if_cache(
 ) -> str:
     azure_openai_client = get_azure_openai_async_client_instance()
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    rate_limiter: TokenBucketLimiter = kwargs.pop("rate_limiter", None)
+    scheduler_slot: SchedulerSlot = kwargs.pop("scheduler_slot", None)
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
@@ -224,9 +353,16 @@ async def azure_openai_complete_if_cache(
         if if_cache_return is not None and if_cache_return["return"] is not None:
             return if_cache_return["return"]
 
-    response = await azure_openai_client.chat.completions.create(
-        model=deployment_name, messages=messages, **kwargs
-    )
+    async with _scheduled(scheduler_slot):
+        reservation = await _acquire_quota(rate_limiter, messages, kwargs)
+        try:
+            response = await azure_openai_client.chat.completions.create(
+                model=deployment_name, messages=messages, **kwargs
+            )
+        except BaseException:
+            _refund_quota(rate_limiter, reservation)
+            raise
+        _settle_quota(rate_limiter, reservation, response.choices[0].message.content)
 
     if hashing_kv is not None:
         await hashing_kv.upsert(
@@ -276,7 +412,7 @@ async def azure_openai_embedding(model_name: str, texts: list[str]) -> np.ndarra
     response = await azure_openai_client.embeddings.create(
         model=model_name, input=texts, encoding_format="float"
     )
-    return np.array([dp.embedding for dp in response.data])
+    return np.array([dp.embedding for dp in response.data], dtype=np.float32)
 
 
 azure_openai_config = LLMConfig(
@@ -309,6 +445,7 @@ async def ollama_complete_if_cache(
     ollama_client = get_ollama_async_client_instance()
 
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    scheduler_slot: SchedulerSlot = kwargs.pop("scheduler_slot", None)
     messages = []
     
     if system_prompt:
@@ -324,10 +461,11 @@ async def ollama_complete_if_cache(
             return if_cache_return["return"]
 
     # Send the request to Ollama
-    response = await ollama_client.chat(
-        model=model,
-        messages=messages
-    )
+    async with _scheduled(scheduler_slot):
+        response = await ollama_client.chat(
+            model=model,
+            messages=messages
+        )
     # print(messages)
     # print(response['message']['content'])
 
@@ -346,7 +484,8 @@ async def ollama_complete(model_name, prompt, system_prompt=None, history_messag
         model_name,
         prompt,
         system_prompt=system_prompt,
-        history_messages=history_messages
+        history_messages=history_messages,
+        scheduler_slot=kwargs.get("scheduler_slot"),
     )
 
 async def ollama_mini_complete(model_name, prompt, system_prompt=None, history_messages=[], **kwargs) -> str:
@@ -355,7 +494,8 @@ async def ollama_mini_complete(model_name, prompt, system_prompt=None, history_m
         model_name,
         prompt,
         system_prompt=system_prompt,
-        history_messages=history_messages
+        history_messages=history_messages,
+        scheduler_slot=kwargs.get("scheduler_slot"),
     )
 
 @retry(
@@ -376,7 +516,7 @@ async def ollama_embedding(model_name: str, texts: list[str]) -> np.ndarray:
     # Extract embeddings from the response
     embeddings = response['embeddings']
 
-    return np.array(embeddings)
+    return np.array(embeddings, dtype=np.float32)
 
 @retry(
     stop=stop_after_attempt(5),
@@ -422,7 +562,7 @@ async def dashscope_embedding(model_name: str, texts: list[str]) -> np.ndarray:
     )
 
     # 提取embeddings并返回numpy数组
-    return np.array([dp.embedding for dp in response.data])
+    return np.array([dp.embedding for dp in response.data], dtype=np.float32)
 
 # 全局配置设置函数
 def set_dashscope_embedding_config(config: dict):
@@ -463,6 +603,8 @@ async def deepseek_complete_if_cache(
     import httpx
     
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    rate_limiter: TokenBucketLimiter = kwargs.pop("rate_limiter", None)
+    scheduler_slot: SchedulerSlot = kwargs.pop("scheduler_slot", None)
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
@@ -475,25 +617,34 @@ async def deepseek_complete_if_cache(
         if if_cache_return is not None and if_cache_return["return"] is not None:
             return if_cache_return["return"]
 
-    # DeepSeek API调用
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://api.deepseek.com/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {os.environ.get('DEEPSEEK_API_KEY', 'sk-*******')}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": model,
-                "messages": messages,
-                "temperature": kwargs.get("temperature", 0.7),
-                "max_tokens": kwargs.get("max_tokens", 4096)
-            },
-            timeout=60.0
-        )
-        response.raise_for_status()
-        result = response.json()
-        content = result["choices"][0]["message"]["content"]
+    # reserve what the request will actually allow the model to generate
+    kwargs.setdefault("max_tokens", 4096)
+    async with _scheduled(scheduler_slot):
+        reservation = await _acquire_quota(rate_limiter, messages, kwargs)
+        # DeepSeek API调用
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await client.post(
+                    "https://api.deepseek.com/v1/chat/completions",
+                    headers={
+                        "Authorization": f"Bearer {os.environ.get('DEEPSEEK_API_KEY', 'sk-*******')}",
+                        "Content-Type": "application/json"
+                    },
+                    json={
+                        "model": model,
+                        "messages": messages,
+                        "temperature": kwargs.get("temperature", 0.7),
+                        "max_tokens": kwargs["max_tokens"]
+                    },
+                    timeout=60.0
+                )
+                response.raise_for_status()
+                result = response.json()
+                content = result["choices"][0]["message"]["content"]
+        except BaseException:
+            _refund_quota(rate_limiter, reservation)
+            raise
+        _settle_quota(rate_limiter, reservation, content)
 
     if hashing_kv is not None:
         await hashing_kv.upsert(
@@ -538,7 +689,7 @@ async def bge_m3_embedding(model_name: str, texts: list[str]) -> np.ndarray:
         response.raise_for_status()
         result = response.json()
         embeddings = [item["embedding"] for item in result["data"]]
-        return np.array(embeddings)
+        return np.array(embeddings, dtype=np.float32)
 
 # DeepSeek + BAAI/bge-m3 配置
 deepseek_bge_config = LLMConfig(
@@ -1,8 +1,10 @@
 import re
 import json
+import time
 import openai
 import asyncio
 import tiktoken
+import numpy as np
 from typing import Union
 from collections import Counter, defaultdict
 from ._splitter import SeparatorSplitter
@@ -26,8 +28,14 @@ from .base import (
     CommunitySchema,
     TextChunkSchema,
     QueryParam,
+    VideoScope,
+    open_storages,
+    segment_video_name,
+    value_videos,
 )
 from .prompt import GRAPH_FIELD_SEP, PROMPTS
+from ._batch import BatchCompletion
+from ._storage import EntityChunkIndex
 from ._videoutil import (
     retrieved_segment_caption,
 )
@@ -271,23 +279,29 @@ async def _handle_single_relationship_extraction(
     )
 
 
-async def _merge_nodes_then_upsert(
+async def _merge_nodes(
     entity_name: str,
     nodes_data: list[dict],
-    knowledge_graph_inst: BaseGraphStorage,
+    already_node: Union[dict, None],
     global_config: dict,
-):
+) -> dict:
     already_entitiy_types = []
     already_source_ids = []
     already_description = []
+    already_video_names = []
 
-    already_node = await knowledge_graph_inst.get_node(entity_name)
     if already_node is not None:
         already_entitiy_types.append(already_node["entity_type"])
         already_source_ids.extend(
             split_string_by_multi_markers(already_node["source_id"], [GRAPH_FIELD_SEP])
         )
         already_description.append(already_node["description"])
+        # nodes written before videos were tracked: their videos are unknown
+        already_video_names = (
+            split_string_by_multi_markers(already_node["video_names"], [GRAPH_FIELD_SEP])
+            if "video_names" in already_node
+            else None
+        )
 
     entity_type = sorted(
         Counter(
@@ -310,27 +324,31 @@ async def _merge_nodes_then_upsert(
         description=description,
         source_id=source_id,
     )
-    await knowledge_graph_inst.upsert_node(
-        entity_name,
-        node_data=node_data,
-    )
-    node_data["entity_name"] = entity_name
+    if already_video_names is not None:
+        node_data["video_names"] = GRAPH_FIELD_SEP.join(
+            sorted(
+                set(already_video_names).union(
+                    *[dp.get("video_names", []) for dp in nodes_data]
+                )
+            )
+        )
     return node_data
 
 
-async def _merge_edges_then_upsert(
+async def _merge_edges(
     src_id: str,
     tgt_id: str,
     edges_data: list[dict],
-    knowledge_graph_inst: BaseGraphStorage,
+    already_edge: Union[dict, None],
     global_config: dict,
-):
+) -> tuple[dict, dict]:
+    """Merged edge data, and the node data to give an endpoint that is not in
+    the graph yet"""
     already_weights = []
     already_source_ids = []
     already_description = []
     already_order = []
-    if await knowledge_graph_inst.has_edge(src_id, tgt_id):
-        already_edge = await knowledge_graph_inst.get_edge(src_id, tgt_id)
+    if already_edge is not None:
         already_weights.append(already_edge["weight"])
         already_source_ids.extend(
             split_string_by_multi_markers(already_edge["source_id"], [GRAPH_FIELD_SEP])
@@ -347,32 +365,80 @@ async def _merge_edges_then_upsert(
     source_id = GRAPH_FIELD_SEP.join(
         set([dp["source_id"] for dp in edges_data] + already_source_ids)
     )
-    for need_insert_id in [src_id, tgt_id]:
-        if not (await knowledge_graph_inst.has_node(need_insert_id)):
-            await knowledge_graph_inst.upsert_node(
-                need_insert_id,
-                node_data={
-                    "source_id": source_id,
-                    "description": description,
-                    "entity_type": '"UNKNOWN"',
-                },
-            )
+    endpoint_data = {
+        "source_id": source_id,
+        "description": description,
+        "entity_type": '"UNKNOWN"',
+    }
     description = await _handle_entity_relation_summary(
         (src_id, tgt_id), description, global_config
     )
-    await knowledge_graph_inst.upsert_edge(
-        src_id,
-        tgt_id,
-        edge_data=dict(
-            weight=weight, description=description, source_id=source_id, order=order
+    edge_data = dict(
+        weight=weight, description=description, source_id=source_id, order=order
+    )
+    return edge_data, endpoint_data
+
+
+async def _merge_then_upsert(
+    maybe_nodes: dict[str, list[dict]],
+    maybe_edges: dict[tuple[str, str], list[dict]],
+    knowledge_graph_inst: BaseGraphStorage,
+    global_config: dict,
+) -> tuple[dict[str, dict], dict[tuple[str, str], dict]]:
+    """Merge the extracted nodes and edges with what the graph already holds.
+    Existing records are read and the results written in batches, so a graph
+    database sees a handful of queries per insert rather than several per
+    entity. Returns the written nodes (including endpoints created for edges)
+    and edges."""
+    entity_names = list(maybe_nodes)
+    edge_keys = list(maybe_edges)
+    endpoints = list({n for edge in edge_keys for n in edge} - maybe_nodes.keys())
+    already_nodes, already_edges, already_endpoints = await asyncio.gather(
+        knowledge_graph_inst.get_nodes(entity_names),
+        knowledge_graph_inst.get_edges(edge_keys),
+        knowledge_graph_inst.get_nodes(endpoints),
+    )
+    merged_nodes, merged_edges = await asyncio.gather(
+        asyncio.gather(
+            *[
+                _merge_nodes(k, maybe_nodes[k], n, global_config)
+                for k, n in zip(entity_names, already_nodes)
+            ]
+        ),
+        asyncio.gather(
+            *[
+                _merge_edges(k[0], k[1], maybe_edges[k], e, global_config)
+                for k, e in zip(edge_keys, already_edges)
+            ]
         ),
     )
-    return_edge_data = dict(
-        src_tgt=(src_id, tgt_id),
-        description=description,
-        weight=weight
+    all_nodes = dict(zip(entity_names, merged_nodes))
+    missing_endpoints = {n for n, d in zip(endpoints, already_endpoints) if d is None}
+    for edge, (_, endpoint_data) in zip(edge_keys, merged_edges):
+        for n in edge:
+            if n in missing_endpoints:
+                all_nodes.setdefault(n, endpoint_data)
+    all_edges = {k: edge_data for k, (edge_data, _) in zip(edge_keys, merged_edges)}
+    # edges are matched on their endpoints, so the nodes go first
+    await knowledge_graph_inst.upsert_nodes(all_nodes)
+    await knowledge_graph_inst.upsert_edges(all_edges)
+    return all_nodes, all_edges
+
+
+async def _update_chunk_index(
+    chunk_index: EntityChunkIndex,
+    chunks: dict[str, TextChunkSchema],
+    all_nodes: dict[str, dict],
+):
+    """Record the segments of the new chunks and the merged chunk list of every
+    node written for them"""
+    await chunk_index.upsert_chunks(
+        {k: v.get("video_segment_id", []) for k, v in chunks.items()}
     )
-    return return_edge_data
+    await chunk_index.upsert_entities({
+        k: split_string_by_multi_markers(v["source_id"], [GRAPH_FIELD_SEP])
+        for k, v in all_nodes.items()
+    })
 
 
 async def extract_entities(
@@ -380,6 +446,7 @@ async def extract_entities(
     knowledge_graph_inst: BaseGraphStorage,
     entity_vdb: BaseVectorStorage,
     global_config: dict,
+    chunk_index=None,
 ) -> Union[BaseGraphStorage, None]:
     # 验证global_config配置
     if not isinstance(global_config, dict):
@@ -492,38 +559,48 @@ async def extract_entities(
         return dict(maybe_nodes), dict(maybe_edges)
 
     # use_llm_func is wrapped in ascynio.Semaphore, limiting max_async callings
-    results = await asyncio.gather(
-        *[_process_single_content(c) for c in ordered_chunks]
-    )
+    tasks = [_process_single_content(c) for c in ordered_chunks]
+    if isinstance(use_llm_func, BatchCompletion):
+        # each round of calls (first pass, then every gleaning step) of all
+        # chunks goes out as one batch job
+        tasks = [use_llm_func.track(t) for t in tasks]
+    results = await asyncio.gather(*tasks)
     print()  # clear the progress bar
     maybe_nodes = defaultdict(list)
     maybe_edges = defaultdict(list)
     for m_nodes, m_edges in results:
         for k, v in m_nodes.items():
+            for dp in v:
+                dp["video_names"] = value_videos(chunks[dp["source_id"]]) or []
             maybe_nodes[k].extend(v)
         for k, v in m_edges.items():
             # it's undirected graph
             maybe_edges[tuple(sorted(k))].extend(v)
-    all_entities_data = await asyncio.gather(
-        *[
-            _merge_nodes_then_upsert(k, v, knowledge_graph_inst, global_config)
-            for k, v in maybe_nodes.items()
-        ]
-    )
-    all_edges_data = await asyncio.gather(
-        *[
-            _merge_edges_then_upsert(k[0], k[1], v, knowledge_graph_inst, global_config)
-            for k, v in maybe_edges.items()
-        ]
+    all_nodes, all_edges = await _merge_then_upsert(
+        maybe_nodes, maybe_edges, knowledge_graph_inst, global_config
     )
+    all_entities_data = [
+        {**all_nodes[k], "entity_name": k} for k in maybe_nodes
+    ]
+    all_edges_data = [
+        dict(src_tgt=k, description=v["description"], weight=v["weight"])
+        for k, v in all_edges.items()
+    ]
     if not len(all_entities_data):
         logger.warning("Didn't extract any entities, maybe your LLM is not working")
         return None
+    if chunk_index is not None:
+        await _update_chunk_index(chunk_index, chunks, all_nodes)
     if entity_vdb is not None:
         data_for_vdb = {
             compute_mdhash_id(dp["entity_name"], prefix="ent-"): {
                 "content": dp["entity_name"] + dp["description"],
                 "entity_name": dp["entity_name"],
+                **(
+                    {"video_names": split_string_by_multi_markers(dp["video_names"], [GRAPH_FIELD_SEP])}
+                    if "video_names" in dp
+                    else {}
+                ),
             }
             for dp in all_entities_data
         }
@@ -536,60 +613,97 @@ async def _find_most_related_segments_from_entities(
     node_datas: list[dict],
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     knowledge_graph_inst: BaseGraphStorage,
+    chunk_index: EntityChunkIndex,
 ):
-    text_units = [
-        split_string_by_multi_markers(dp["source_id"], [GRAPH_FIELD_SEP])
-        for dp in node_datas
+    """Segments of the `topk_chunks` chunks the entities come from, ranked by
+    how many one-hop neighbours of the entity share the chunk. Chunk ids come
+    from `chunk_index`; entities and chunks it has not seen yet (sessions built
+    before it existed) are read from the graph and the chunk store once and
+    added to it."""
+    names = [dp["entity_name"] for dp in node_datas]
+    edges = await knowledge_graph_inst.get_nodes_edges(names)
+    neighbours = [[e[1] for e in this_edges] if this_edges else [] for this_edges in edges]
+    all_one_hop_nodes = list({n for this_neighbours in neighbours for n in this_neighbours})
+
+    unindexed = {
+        dp["entity_name"]: split_string_by_multi_markers(dp["source_id"], [GRAPH_FIELD_SEP])
+        for dp, c in zip(node_datas, chunk_index.entity_chunks(names))
+        if c is None
+    }
+    unindexed_one_hop_nodes = [
+        n for n, c in zip(all_one_hop_nodes, chunk_index.entity_chunks(all_one_hop_nodes)) if c is None
     ]
-    edges = await asyncio.gather(
-        *[knowledge_graph_inst.get_node_edges(dp["entity_name"]) for dp in node_datas]
-    )
-    all_one_hop_nodes = set()
-    for this_edges in edges:
-        if not this_edges:
-            continue
-        all_one_hop_nodes.update([e[1] for e in this_edges])
-    all_one_hop_nodes = list(all_one_hop_nodes)
-    all_one_hop_nodes_data = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(e) for e in all_one_hop_nodes]
-    )
-    all_one_hop_text_units_lookup = {
-        k: set(split_string_by_multi_markers(v["source_id"], [GRAPH_FIELD_SEP]))
-        for k, v in zip(all_one_hop_nodes, all_one_hop_nodes_data)
+    unindexed_one_hop_datas = await knowledge_graph_inst.get_nodes(unindexed_one_hop_nodes)
+    unindexed.update({
+        n: split_string_by_multi_markers(v["source_id"], [GRAPH_FIELD_SEP])
+        for n, v in zip(unindexed_one_hop_nodes, unindexed_one_hop_datas)
         if v is not None
-    }
-    all_text_units_lookup = {}
-    for index, (this_text_units, this_edges) in enumerate(zip(text_units, edges)):
-        for c_id in this_text_units:
-            if c_id in all_text_units_lookup:
-                continue
-            relation_counts = 0
-            for e in this_edges:
-                if (
-                    e[1] in all_one_hop_text_units_lookup
-                    and c_id in all_one_hop_text_units_lookup[e[1]]
-                ):
-                    relation_counts += 1
-            all_text_units_lookup[c_id] = {
-                "data": await text_chunks_db.get_by_id(c_id),
-                "order": index,
-                "relation_counts": relation_counts,
-            }
-    if any([v is None for v in all_text_units_lookup.values()]):
-        logger.warning("Text chunks are missing, maybe the storage is damaged")
-    all_text_units = [
-        {"id": k, **v} for k, v in all_text_units_lookup.items() if v is not None
+    })
+    if unindexed:
+        await chunk_index.upsert_entities(unindexed)
+
+    empty = np.zeros(0, dtype=np.int32)
+    entity_chunks = chunk_index.entity_chunks(names)
+    one_hop_chunks = dict(zip(all_one_hop_nodes, chunk_index.entity_chunks(all_one_hop_nodes)))
+    related_chunks = [
+        np.concatenate([one_hop_chunks[n] for n in this_neighbours if one_hop_chunks[n] is not None] or [empty])
+        for this_neighbours in neighbours
     ]
-    sorted_text_units = sorted(
-        all_text_units, key=lambda x: -x["relation_counts"]
-    )[:topk_chunks]
-    
-    chunk_related_segments = set()
-    for _chunk_data in sorted_text_units:
-        for s_id in _chunk_data['data']['video_segment_id']:
-            chunk_related_segments.add(s_id)
-    
-    return chunk_related_segments
+    chunk_ids = np.concatenate(entity_chunks or [empty])
+    if not len(chunk_ids):
+        return set()
+    # relation count of a chunk under an entity = number of its neighbours that
+    # share the chunk, counted over (entity position, chunk id) pairs
+    width = int(np.concatenate([chunk_ids, *related_chunks]).max()) + 1
+    chunk_keys = np.repeat(np.arange(len(entity_chunks), dtype=np.int64), [len(c) for c in entity_chunks]) * width + chunk_ids
+    related_keys, related_counts = np.unique(
+        np.repeat(np.arange(len(related_chunks), dtype=np.int64), [len(c) for c in related_chunks]) * width
+        + np.concatenate(related_chunks),
+        return_counts=True,
+    )
+    related_keys = np.append(related_keys, np.iinfo(np.int64).max)
+    related_counts = np.append(related_counts, 0)
+    at = np.searchsorted(related_keys, chunk_keys)
+    relation_counts = np.where(related_keys[at] == chunk_keys, related_counts[at], 0)
+    # a chunk is counted under the first entity it comes from
+    _, first = np.unique(chunk_ids, return_index=True)
+    ranked = first[np.lexsort((first, -relation_counts[first]))]
+    top_chunk_ids = chunk_ids[ranked[:topk_chunks]].tolist()
+
+    segments = chunk_index.chunk_segments(top_chunk_ids)
+    unindexed_chunks = [i for i, s in zip(top_chunk_ids, segments) if s is None]
+    if unindexed_chunks:
+        keys = chunk_index.chunk_keys(unindexed_chunks)
+        datas = await text_chunks_db.get_by_ids(keys, fields={"video_segment_id"})
+        if any([v is None for v in datas]):
+            logger.warning("Text chunks are missing, maybe the storage is damaged")
+        await chunk_index.upsert_chunks(
+            {k: v["video_segment_id"] for k, v in zip(keys, datas) if v is not None}
+        )
+        segments = chunk_index.chunk_segments(top_chunk_ids)
+    return {s_id for s in segments if s is not None for s_id in s}
+
+async def _load_segment_videos(segment_ids, video_segments) -> dict[str, dict]:
+    """Segment records of the videos the given segment ids belong to, by video name"""
+    video_names = sorted({segment_video_name(s_id) for s_id in segment_ids})
+    return dict(zip(video_names, await video_segments.get_by_ids(video_names)))
+
+async def _filter_segments_by_scope(
+    segment_ids: set[str], scope: VideoScope, video_segments
+) -> set[str]:
+    if scope is None:
+        return segment_ids
+    segment_ids = {s_id for s_id in segment_ids if scope.allows_video(segment_video_name(s_id))}
+    segment_videos = await _load_segment_videos(segment_ids, video_segments)
+    scoped_ids = set()
+    for s_id in segment_ids:
+        segment = (segment_videos[segment_video_name(s_id)] or {}).get(s_id.split('_')[-1])
+        if segment is None:
+            logger.warning(f"Video segment {s_id} is missing, maybe the storage is damaged")
+            continue
+        if scope.allows_time(segment["time"]):
+            scoped_ids.add(s_id)
+    return scoped_ids
 
 async def _refine_entity_retrieval_query(
     query,
@@ -624,6 +738,85 @@ async def _extract_keywords_query(
     final_result = await use_llm_func(keywords_prompt)
     return final_result
 
+# reciprocal rank fusion constant, as in Cormack et al. (2009)
+RRF_K = 60
+
+def _fuse_by_rank(result_lists: list[list[dict]], top_k: int) -> list[dict]:
+    scores = defaultdict(float)
+    for results in result_lists:
+        for rank, r in enumerate(results):
+            scores[r["id"]] += 1 / (RRF_K + rank + 1)
+    best = sorted(scores.items(), key=lambda x: -x[1])[:top_k]
+    return [{"id": k, "fused_score": v} for k, v in best]
+
+async def _timed(coro):
+    start = time.perf_counter()
+    result = await coro
+    return result, (time.perf_counter() - start) * 1000
+
+async def videorag_retrieve(
+    queries: list[str],
+    entities_vdb,
+    chunks_vdb,
+    video_segment_feature_vdb,
+    query_param: QueryParam,
+    global_config: dict,
+    chunks_lexical=None,
+) -> list[dict]:
+    """Vector retrieval for a batch of queries. The rewrites are generated
+    concurrently and every storage is searched once with all of them. With
+    `chunks_lexical` the chunk search is hybrid: BM25 runs alongside the dense
+    search and the two rankings are fused."""
+    entity_queries, visual_queries = await asyncio.gather(
+        asyncio.gather(
+            *[_refine_entity_retrieval_query(q, query_param, global_config) for q in queries]
+        ),
+        asyncio.gather(
+            *[_refine_visual_retrieval_query(q, query_param, global_config) for q in queries]
+        ),
+    )
+    lexical_search = (
+        chunks_lexical.query_batch(queries, top_k=query_param.top_k, scope=query_param.scope)
+        if chunks_lexical is not None
+        else asyncio.sleep(0, result=None)
+    )
+    (
+        (dense_chunks, dense_ms),
+        (lexical_chunks, lexical_ms),
+        entity_results,
+        segment_results,
+    ) = await asyncio.gather(
+        _timed(chunks_vdb.query_batch(queries, top_k=query_param.top_k, scope=query_param.scope)),
+        _timed(lexical_search),
+        entities_vdb.query_batch(
+            entity_queries, top_k=query_param.top_k, scope=query_param.scope
+        ),
+        video_segment_feature_vdb.query_batch(visual_queries, scope=query_param.scope),
+    )
+    if lexical_chunks is None:
+        chunk_results = dense_chunks
+        logger.info(f"Chunk search for {len(queries)} queries: dense {dense_ms:.1f} ms")
+    else:
+        chunk_results = [
+            _fuse_by_rank([dense, lexical], query_param.top_k)
+            for dense, lexical in zip(dense_chunks, lexical_chunks)
+        ]
+        logger.info(
+            f"Chunk search for {len(queries)} queries: dense {dense_ms:.1f} ms, lexical {lexical_ms:.1f} ms"
+        )
+    return [
+        dict(
+            chunk_results=c,
+            query_for_entity_retrieval=eq,
+            entity_results=e,
+            query_for_visual_retrieval=vq,
+            segment_results=s,
+        )
+        for c, eq, e, vq, s in zip(
+            chunk_results, entity_queries, entity_results, visual_queries, segment_results
+        )
+    ]
+
 async def videorag_query(
     query,
     entities_vdb,
@@ -637,14 +830,21 @@ async def videorag_query(
     caption_tokenizer,
     query_param: QueryParam,
     global_config: dict,
+    entity_chunk_index: EntityChunkIndex,
+    retrieval: dict = None,
 ) -> str:
     use_model_func = global_config["llm"]["best_model_func"]
     query = query
+    if retrieval is None:
+        retrieval = (await videorag_retrieve(
+            [query], entities_vdb, chunks_vdb, video_segment_feature_vdb, query_param, global_config
+        ))[0]
     
     # naive chunks
-    results = await chunks_vdb.query(query, top_k=query_param.top_k)
+    results = retrieval["chunk_results"]
     if not len(results):
         return PROMPTS["fail_response"]
+    await open_storages(text_chunks_db, knowledge_graph_inst, video_segments, video_path_db, entity_chunk_index)
     chunks_ids = [r["id"] for r in results]
     chunks = await text_chunks_db.get_by_ids(chunks_ids)
 
@@ -658,38 +858,32 @@ async def videorag_query(
     retreived_chunk_context = section
     
     # visual retrieval
-    query_for_entity_retrieval = await _refine_entity_retrieval_query(
-        query,
-        query_param,
-        global_config,
-    )
-    entity_results = await entities_vdb.query(query_for_entity_retrieval, top_k=query_param.top_k)
+    query_for_entity_retrieval = retrieval["query_for_entity_retrieval"]
+    entity_results = retrieval["entity_results"]
     entity_retrieved_segments = set()
     if len(entity_results):
-        node_datas = await asyncio.gather(
-            *[knowledge_graph_inst.get_node(r["entity_name"]) for r in entity_results]
+        entity_names = [r["entity_name"] for r in entity_results]
+        node_datas, node_degrees = await asyncio.gather(
+            knowledge_graph_inst.get_nodes(entity_names),
+            knowledge_graph_inst.node_degrees(entity_names),
         )
         if not all([n is not None for n in node_datas]):
             logger.warning("Some nodes are missing, maybe the storage is damaged")
-        node_degrees = await asyncio.gather(
-            *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in entity_results]
-        )
         node_datas = [
             {**n, "entity_name": k["entity_name"], "rank": d}
             for k, n, d in zip(entity_results, node_datas, node_degrees)
             if n is not None
         ]
         entity_retrieved_segments = entity_retrieved_segments.union(await _find_most_related_segments_from_entities(
-            global_config["retrieval_topk_chunks"], node_datas, text_chunks_db, knowledge_graph_inst
+            global_config["retrieval_topk_chunks"], node_datas, text_chunks_db, knowledge_graph_inst, entity_chunk_index
         ))
+        entity_retrieved_segments = await _filter_segments_by_scope(
+            entity_retrieved_segments, query_param.scope, video_segments
+        )
     
     # visual retrieval
-    query_for_visual_retrieval = await _refine_visual_retrieval_query(
-        query,
-        query_param,
-        global_config,
-    )
-    segment_results = await video_segment_feature_vdb.query(query_for_visual_retrieval)
+    query_for_visual_retrieval = retrieval["query_for_visual_retrieval"]
+    segment_results = retrieval["segment_results"]
     visual_retrieved_segments = set()
     if len(segment_results):
         for n in segment_results:
@@ -728,11 +922,12 @@ async def videorag_query(
         )
         return (segment_key, result)
     
+    segment_videos = await _load_segment_videos(retrieved_segments, video_segments)
     rough_captions = {}
     for s_id in retrieved_segments:
         video_name = '_'.join(s_id.split('_')[:-1])
         index = s_id.split('_')[-1]
-        rough_captions[s_id] = video_segments._data[video_name][index]["content"]
+        rough_captions[s_id] = segment_videos[video_name][index]["content"]
     results = await asyncio.gather(
         *[_filter_single_segment(query, (s_id, rough_captions[s_id])) for s_id in rough_captions]
     )
@@ -755,8 +950,8 @@ async def videorag_query(
         caption_tokenizer,
         keywords_for_caption,
         remain_segments,
-        video_path_db,
-        video_segments,
+        dict(zip(segment_videos, await video_path_db.get_by_ids(list(segment_videos)))),
+        segment_videos,
         num_sampled_frames=global_config['fine_num_frames_per_segment']
     )
 
@@ -765,8 +960,8 @@ async def videorag_query(
     for s_id in caption_results:
         video_name = '_'.join(s_id.split('_')[:-1])
         index = s_id.split('_')[-1]
-        start_time = eval(video_segments._data[video_name][index]["time"].split('-')[0])
-        end_time = eval(video_segments._data[video_name][index]["time"].split('-')[1])
+        start_time = eval(segment_videos[video_name][index]["time"].split('-')[0])
+        end_time = eval(segment_videos[video_name][index]["time"].split('-')[1])
         start_time = f"{start_time // 3600}:{(start_time % 3600) // 60}:{start_time % 60}"
         end_time = f"{end_time // 3600}:{(end_time % 3600) // 60}:{end_time % 60}"
         text_units_section_list.append([video_name, start_time, end_time, caption_results[s_id]])
@@ -803,15 +998,22 @@ async def videorag_query_multiple_choice(
     caption_tokenizer,
     query_param: QueryParam,
     global_config: dict,
+    entity_chunk_index: EntityChunkIndex,
+    retrieval: dict = None,
 ) -> str:
     """_summary_
     A copy of the videorag_query function with several updates for handling multiple-choice queries.
     """
     use_model_func = global_config["llm"]["best_model_func"]
     query = query
+    if retrieval is None:
+        retrieval = (await videorag_retrieve(
+            [query], entities_vdb, chunks_vdb, video_segment_feature_vdb, query_param, global_config
+        ))[0]
     
     # naive chunks
-    results = await chunks_vdb.query(query, top_k=query_param.top_k)
+    results = retrieval["chunk_results"]
+    await open_storages(text_chunks_db, knowledge_graph_inst, video_segments, video_path_db, entity_chunk_index)
     # NOTE: I update here, not len results can also process
     if len(results):
         chunks_ids = [r["id"] for r in results]
@@ -829,38 +1031,32 @@ async def videorag_query_multiple_choice(
         retreived_chunk_context = "No Content"
         
     # visual retrieval
-    query_for_entity_retrieval = await _refine_entity_retrieval_query(
-        query,
-        query_param,
-        global_config,
-    )
-    entity_results = await entities_vdb.query(query_for_entity_retrieval, top_k=query_param.top_k)
+    query_for_entity_retrieval = retrieval["query_for_entity_retrieval"]
+    entity_results = retrieval["entity_results"]
     entity_retrieved_segments = set()
     if len(entity_results):
-        node_datas = await asyncio.gather(
-            *[knowledge_graph_inst.get_node(r["entity_name"]) for r in entity_results]
+        entity_names = [r["entity_name"] for r in entity_results]
+        node_datas, node_degrees = await asyncio.gather(
+            knowledge_graph_inst.get_nodes(entity_names),
+            knowledge_graph_inst.node_degrees(entity_names),
         )
         if not all([n is not None for n in node_datas]):
             logger.warning("Some nodes are missing, maybe the storage is damaged")
-        node_degrees = await asyncio.gather(
-            *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in entity_results]
-        )
         node_datas = [
             {**n, "entity_name": k["entity_name"], "rank": d}
             for k, n, d in zip(entity_results, node_datas, node_degrees)
             if n is not None
         ]
         entity_retrieved_segments = entity_retrieved_segments.union(await _find_most_related_segments_from_entities(
-            global_config["retrieval_topk_chunks"], node_datas, text_chunks_db, knowledge_graph_inst
+            global_config["retrieval_topk_chunks"], node_datas, text_chunks_db, knowledge_graph_inst, entity_chunk_index
         ))
+        entity_retrieved_segments = await _filter_segments_by_scope(
+            entity_retrieved_segments, query_param.scope, video_segments
+        )
     
     # visual retrieval
-    query_for_visual_retrieval = await _refine_visual_retrieval_query(
-        query,
-        query_param,
-        global_config,
-    )
-    segment_results = await video_segment_feature_vdb.query(query_for_visual_retrieval)
+    query_for_visual_retrieval = retrieval["query_for_visual_retrieval"]
+    segment_results = retrieval["segment_results"]
     visual_retrieved_segments = set()
     if len(segment_results):
         for n in segment_results:
@@ -899,11 +1095,12 @@ async def videorag_query_multiple_choice(
         )
         return (segment_key, result)
     
+    segment_videos = await _load_segment_videos(retrieved_segments, video_segments)
     rough_captions = {}
     for s_id in retrieved_segments:
         video_name = '_'.join(s_id.split('_')[:-1])
         index = s_id.split('_')[-1]
-        rough_captions[s_id] = video_segments._data[video_name][index]["content"]
+        rough_captions[s_id] = segment_videos[video_name][index]["content"]
     results = await asyncio.gather(
         *[_filter_single_segment(query, (s_id, rough_captions[s_id])) for s_id in rough_captions]
     )
@@ -926,8 +1123,8 @@ async def videorag_query_multiple_choice(
         caption_tokenizer,
         keywords_for_caption,
         remain_segments,
-        video_path_db,
-        video_segments,
+        dict(zip(segment_videos, await video_path_db.get_by_ids(list(segment_videos)))),
+        segment_videos,
         num_sampled_frames=global_config['fine_num_frames_per_segment']
     )
 
@@ -936,8 +1133,8 @@ async def videorag_query_multiple_choice(
     for s_id in caption_results:
         video_name = '_'.join(s_id.split('_')[:-1])
         index = s_id.split('_')[-1]
-        start_time = eval(video_segments._data[video_name][index]["time"].split('-')[0])
-        end_time = eval(video_segments._data[video_name][index]["time"].split('-')[1])
+        start_time = eval(segment_videos[video_name][index]["time"].split('-')[0])
+        end_time = eval(segment_videos[video_name][index]["time"].split('-')[1])
         start_time = f"{start_time // 3600}:{(start_time % 3600) // 60}:{start_time % 60}"
         end_time = f"{end_time // 3600}:{(end_time % 3600) // 60}:{end_time % 60}"
         text_units_section_list.append([video_name, start_time, end_time, caption_results[s_id]])
@@ -0,0 +1,314 @@
+"""
+LLM call scheduler shared by several processes.
+
+Every VideoRAG instance limits its own model calls (limit_async_func_call),
+so N worker processes send N times the intended load to the provider. An
+LLMScheduler runs once, typically inside the process that spawns the workers,
+and hands out call slots per pool (one pool per model) over a local socket:
+workers still make the provider calls themselves, but only once the
+scheduler grants a slot. Within a pool waiting calls are served by priority
+(see llm_priority), then round robin across sessions, so one large upload
+cannot starve the others.
+
+The protocol is one JSON object per line:
+    -> {"op": "acquire", "id": 1, "pool": "gpt-4o-mini", "session": "chat-1", "priority": 1, "max_async": 16}
+    <- {"id": 1}
+    -> {"op": "release", "id": 1}    (or "cancel" for a call given up while waiting)
+Slots held by a connection that drops are released.
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from ._utils import LLM_PRIORITY_BACKGROUND, current_llm_priority, logger
+
+
+class _Lease:
+    __slots__ = ("writer", "id", "session", "priority", "enqueued", "state")
+
+    def __init__(self, writer, id, session, priority):
+        self.writer = writer
+        self.id = id
+        self.session = session
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.state = "waiting"
+
+
+class _Pool:
+    def __init__(self, max_async: int):
+        self.max_async = max(1, max_async)
+        self.in_use = 0
+        # priority -> session -> leases in arrival order; sessions rotate
+        self.waiting: dict[int, OrderedDict] = {}
+        self.granted = 0
+        self.wait_seconds = defaultdict(float)
+
+    def push(self, lease: _Lease):
+        sessions = self.waiting.setdefault(lease.priority, OrderedDict())
+        sessions.setdefault(lease.session, deque()).append(lease)
+
+    def pop(self):
+        for priority in sorted(self.waiting):
+            sessions = self.waiting[priority]
+            while sessions:
+                session, queue = next(iter(sessions.items()))
+                lease = queue.popleft()
+                if queue:
+                    sessions.move_to_end(session)
+                else:
+                    del sessions[session]
+                if lease.state == "waiting":
+                    return lease
+            del self.waiting[priority]
+        return None
+
+
+class LLMScheduler:
+    """Grants model call slots to the processes connected to it.
+
+    `limits` maps pool names (model names, `embedding:<model>` for embedding
+    models) to their global concurrency; a pool without one takes the
+    `max_async` of the first call that names it."""
+
+    def __init__(self, limits: dict[str, int] = None):
+        self.limits = limits or {}
+        self._pools: dict[str, _Pool] = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self.address = None
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serve in a background thread; returns the "host:port" workers connect to"""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._serve, host, port)
+            )
+            bound_host, bound_port = self._server.sockets[0].getsockname()[:2]
+            self.address = f"{bound_host}:{bound_port}"
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="llm-scheduler", daemon=True)
+        self._thread.start()
+        started.wait()
+        logger.info(f"LLM scheduler listening on {self.address}")
+        return self.address
+
+    def stop(self):
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def stats(self) -> dict:
+        """Slots in use, waiting calls and queue wait per session, by pool"""
+        async def collect():
+            return {
+                name: {
+                    "max_async": pool.max_async,
+                    "in_use": pool.in_use,
+                    "waiting": sum(
+                        len(queue)
+                        for sessions in pool.waiting.values()
+                        for queue in sessions.values()
+                    ),
+                    "granted": pool.granted,
+                    "wait_seconds": dict(pool.wait_seconds),
+                }
+                for name, pool in self._pools.items()
+            }
+
+        return asyncio.run_coroutine_threadsafe(collect(), self._loop).result()
+
+    def _pool(self, name: str, max_async: int) -> _Pool:
+        if name not in self._pools:
+            self._pools[name] = _Pool(self.limits.get(name, max_async))
+        return self._pools[name]
+
+    def _dispatch(self, pool: _Pool):
+        while pool.in_use < pool.max_async:
+            lease = pool.pop()
+            if lease is None:
+                return
+            lease.state = "granted"
+            pool.in_use += 1
+            pool.granted += 1
+            pool.wait_seconds[lease.session] += time.monotonic() - lease.enqueued
+            lease.writer.write(json.dumps({"id": lease.id}).encode("utf-8") + b"\n")
+
+    def _finish(self, pool: _Pool, lease: _Lease):
+        granted = lease.state == "granted"
+        # waiting leases are dropped from the queue when they come up
+        lease.state = "done"
+        if granted:
+            pool.in_use -= 1
+            self._dispatch(pool)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        leases: dict[int, tuple[_Pool, _Lease]] = {}
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                if message["op"] == "acquire":
+                    pool = self._pool(message["pool"], message.get("max_async", 1))
+                    lease = _Lease(
+                        writer,
+                        message["id"],
+                        message.get("session", ""),
+                        message.get("priority", LLM_PRIORITY_BACKGROUND),
+                    )
+                    leases[lease.id] = (pool, lease)
+                    pool.push(lease)
+                    self._dispatch(pool)
+                elif message["id"] in leases:
+                    self._finish(*leases.pop(message["id"]))
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"LLM scheduler dropped a connection: {e}")
+        finally:
+            for pool, lease in leases.values():
+                self._finish(pool, lease)
+            writer.close()
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.pending: dict[int, asyncio.Future] = {}
+        self.closed = False
+        self._reader_task = asyncio.ensure_future(self._read(reader))
+
+    async def _read(self, reader: asyncio.StreamReader):
+        try:
+            async for line in reader:
+                waiter = self.pending.pop(json.loads(line)["id"], None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(True)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            # calls still waiting go ahead under their process-local limits
+            for waiter in self.pending.values():
+                if not waiter.done():
+                    waiter.set_result(False)
+            self.pending.clear()
+
+    def send(self, message: dict):
+        if not self.closed:
+            self.writer.write(json.dumps(message).encode("utf-8") + b"\n")
+
+
+class SchedulerClient:
+    """A process's link to an LLMScheduler, one connection per event loop.
+    If the scheduler cannot be reached calls are let through (the caller's own
+    limits still apply) and a warning is logged."""
+
+    def __init__(self, address: str, session: str):
+        host, port = address.rsplit(":", 1)
+        self.host, self.port = host, int(port)
+        self.session = session
+        self._connections = weakref.WeakKeyDictionary()
+        self._connecting = weakref.WeakKeyDictionary()
+        self._ids = itertools.count(1)
+        self._warned = False
+
+    async def _connection(self) -> _Connection:
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is not None and not connection.closed:
+            return connection
+        # concurrent first calls share the connection the first one opens
+        lock = self._connecting.get(loop)
+        if lock is None:
+            lock = self._connecting[loop] = asyncio.Lock()
+        async with lock:
+            connection = self._connections.get(loop)
+            if connection is None or connection.closed:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                connection = self._connections[loop] = _Connection(reader, writer)
+        return connection
+
+    async def acquire(self, pool: str, max_async: int, priority: int):
+        """Wait for a slot in `pool`; returns the lease to release, None when
+        the scheduler is unavailable"""
+        try:
+            connection = await self._connection()
+        except OSError as e:
+            if not self._warned:
+                logger.warning(f"LLM scheduler at {self.host}:{self.port} unavailable, using local limits only: {e}")
+                self._warned = True
+            return None
+        lease_id = next(self._ids)
+        waiter = asyncio.get_running_loop().create_future()
+        connection.pending[lease_id] = waiter
+        connection.send(
+            {
+                "op": "acquire",
+                "id": lease_id,
+                "pool": pool,
+                "session": self.session,
+                "priority": priority,
+                "max_async": max_async,
+            }
+        )
+        try:
+            granted = await waiter
+        except asyncio.CancelledError:
+            connection.pending.pop(lease_id, None)
+            connection.send({"op": "cancel", "id": lease_id})
+            raise
+        return (connection, lease_id) if granted else None
+
+    def release(self, lease):
+        if lease is not None:
+            connection, lease_id = lease
+            connection.send({"op": "release", "id": lease_id})
+
+
+class SchedulerSlot:
+    """One pool of the scheduler `client` is connected to. Passed to the
+    completion functions like their rate limiter, so a slot is only taken
+    once the response cache has missed."""
+
+    def __init__(self, client: SchedulerClient, pool: str, max_async: int):
+        self.client = client
+        self.pool = pool
+        self.max_async = max_async
+
+    @asynccontextmanager
+    async def held(self):
+        lease = await self.client.acquire(self.pool, self.max_async, current_llm_priority())
+        try:
+            yield
+        finally:
+            self.client.release(lease)
+
+
+def schedule_async_func_call(client: SchedulerClient, pool: str, max_async: int):
+    """Make every call of an async func wait for a slot of `pool` from the
+    scheduler `client` is connected to"""
+    slot = SchedulerSlot(client, pool, max_async)
+
+    def final_decro(func):
+        @wraps(func)
+        async def wait_func(*args, **kwargs):
+            async with slot.held():
+                return await func(*args, **kwargs)
+
+        return wait_func
+
+    return final_decro
@@ -1,6 +1,11 @@
 from .gdb_networkx import NetworkXStorage
 from .gdb_neo4j import Neo4jStorage
-from .vdb_hnswlib import HNSWVectorStorage
 from .vdb_nanovectordb import NanoVectorDBStorage, NanoVectorDBVideoSegmentStorage
+from .vdb_mmap import MmapVectorStorage, MmapVideoSegmentStorage
+from .vdb_hnswlib import HNSWVectorStorage, HNSWVideoSegmentStorage
 from .kv_json import JsonKVStorage
+from .kv_log import LogKVStorage
+from .kv_sqlite import SqliteKVStorage
+from .lexical_bm25 import BM25Storage
+from .entity_chunk_index import EntityChunkIndex
 from .intermediate_storage import IntermediateStorageManager
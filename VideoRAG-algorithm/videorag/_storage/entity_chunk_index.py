@@ -0,0 +1,240 @@
+import asyncio
+import fcntl
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from .._utils import logger
+from ..base import StorageNameSpace
+
+
+def _pack_strings(strings: list[str]) -> np.ndarray:
+    return np.frombuffer("\x00".join(strings).encode("utf-8"), dtype=np.uint8)
+
+
+def _unpack_strings(blob: np.ndarray, count: int) -> list[str]:
+    return blob.tobytes().decode("utf-8").split("\x00") if count else []
+
+
+def _pack_lists(lists: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """CSR layout: indptr and concatenated indices"""
+    indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(a) for a in lists])
+    indices = np.concatenate(lists).astype(np.int32) if lists else np.zeros(0, dtype=np.int32)
+    return indptr, indices
+
+
+def _unpack_lists(indptr: np.ndarray, indices: np.ndarray) -> list[np.ndarray]:
+    return np.split(indices, indptr[1:-1]) if len(indptr) > 1 else []
+
+
+@dataclass
+class EntityChunkIndex(StorageNameSpace):
+    """Entity -> chunk ids and chunk -> video segment ids, as sorted int32
+    arrays over interned keys, maintained while entities are extracted so
+    that ranking chunks for retrieved entities needs no source_id parsing or
+    per-chunk lookups. Persisted as `entity_chunk_index_<namespace>.npz`."""
+
+    def __post_init__(self):
+        self._file_name = os.path.join(
+            self.global_config["working_dir"], f"entity_chunk_index_{self.namespace}.npz"
+        )
+        # serialises the commits of indexing and querying processes
+        self._lock_file = os.path.join(
+            self.global_config["working_dir"], f"entity_chunk_index_{self.namespace}.lock"
+        )
+        self._load()
+        logger.info(
+            f"Load entity-chunk index {self.namespace} with {len(self._entity_names)} entities, {len(self._chunk_keys)} chunks"
+        )
+
+    def _load(self):
+        (
+            self._entity_names,
+            self._chunk_keys,
+            self._segment_keys,
+            # position in the lists above -> sorted ids into the next table
+            self._entity_chunks,
+            self._chunk_segments,
+            # whether a chunk's segments were indexed, possibly as an empty list
+            self._chunk_indexed,
+        ) = self._read_file()
+        self._entity_ids = {k: i for i, k in enumerate(self._entity_names)}
+        self._chunk_ids = {k: i for i, k in enumerate(self._chunk_keys)}
+        self._segment_ids = {k: i for i, k in enumerate(self._segment_keys)}
+        # keys this instance changed since the file was read or written
+        self._changed_entities: set[str] = set()
+        self._changed_chunks: set[str] = set()
+
+    def _read_file(self):
+        self._file_mtime = None
+        if not os.path.exists(self._file_name):
+            return [], [], [], [], [], []
+        self._file_mtime = os.stat(self._file_name).st_mtime_ns
+        with np.load(self._file_name) as data:
+            counts = data["counts"].tolist()
+            chunk_segments = _unpack_lists(data["chunk_segments_indptr"], data["chunk_segments"])
+            if "chunk_indexed" in data:
+                chunk_indexed = np.unpackbits(data["chunk_indexed"], count=counts[1]).astype(bool).tolist()
+            else:
+                # files written before the flag existed only held non-empty lists
+                chunk_indexed = [len(segments) > 0 for segments in chunk_segments]
+            return (
+                _unpack_strings(data["entity_names"], counts[0]),
+                _unpack_strings(data["chunk_keys"], counts[1]),
+                _unpack_strings(data["segment_keys"], counts[2]),
+                _unpack_lists(data["entity_chunks_indptr"], data["entity_chunks"]),
+                chunk_segments,
+                chunk_indexed,
+            )
+
+    def __len__(self):
+        return len(self._entity_names)
+
+    def _chunk_id(self, chunk_key: str) -> int:
+        i = self._chunk_ids.get(chunk_key)
+        if i is None:
+            i = self._chunk_ids[chunk_key] = len(self._chunk_keys)
+            self._chunk_keys.append(chunk_key)
+            self._chunk_segments.append(np.zeros(0, dtype=np.int32))
+            self._chunk_indexed.append(False)
+        return i
+
+    def _segment_id(self, segment_key: str) -> int:
+        i = self._segment_ids.get(segment_key)
+        if i is None:
+            i = self._segment_ids[segment_key] = len(self._segment_keys)
+            self._segment_keys.append(segment_key)
+        return i
+
+    async def upsert_chunks(self, chunk_segments: dict[str, list[str]]):
+        self._changed_chunks.update(chunk_segments)
+        self._set_chunks(chunk_segments)
+
+    def _set_chunks(self, chunk_segments: dict[str, list[str]]):
+        for chunk_key, segment_keys in chunk_segments.items():
+            i = self._chunk_id(chunk_key)
+            self._chunk_segments[i] = np.unique(
+                np.array([self._segment_id(s) for s in segment_keys], dtype=np.int32)
+            )
+            self._chunk_indexed[i] = True
+
+    async def upsert_entities(self, entity_chunks: dict[str, list[str]]):
+        """`entity_chunks` holds each entity's full (merged) chunk list"""
+        self._changed_entities.update(entity_chunks)
+        self._set_entities(entity_chunks)
+
+    def _set_entities(self, entity_chunks: dict[str, list[str]]):
+        for name, chunk_keys in entity_chunks.items():
+            chunk_ids = np.unique(np.array([self._chunk_id(c) for c in chunk_keys], dtype=np.int32))
+            i = self._entity_ids.get(name)
+            if i is None:
+                self._entity_ids[name] = len(self._entity_names)
+                self._entity_names.append(name)
+                self._entity_chunks.append(chunk_ids)
+            else:
+                self._entity_chunks[i] = chunk_ids
+
+    def entity_chunks(self, names: list[str]) -> list[np.ndarray]:
+        """Sorted chunk ids per entity, None for entities not indexed"""
+        return [
+            self._entity_chunks[self._entity_ids[n]] if n in self._entity_ids else None
+            for n in names
+        ]
+
+    def chunk_keys(self, chunk_ids) -> list[str]:
+        return [self._chunk_keys[i] for i in chunk_ids]
+
+    def chunk_segments(self, chunk_ids) -> list[list[str]]:
+        """Segment keys per chunk id, None for chunks whose segments were never indexed"""
+        return [
+            [self._segment_keys[s] for s in self._chunk_segments[i].tolist()]
+            if self._chunk_indexed[i]
+            else None
+            for i in chunk_ids
+        ]
+
+    def _save(self):
+        entity_chunks_indptr, entity_chunks = _pack_lists(self._entity_chunks)
+        chunk_segments_indptr, chunk_segments = _pack_lists(self._chunk_segments)
+        tmp_file_name = self._file_name + ".tmp"
+        with open(tmp_file_name, "wb") as f:
+            np.savez(
+                f,
+                counts=np.array(
+                    [len(self._entity_names), len(self._chunk_keys), len(self._segment_keys)],
+                    dtype=np.int64,
+                ),
+                entity_names=_pack_strings(self._entity_names),
+                chunk_keys=_pack_strings(self._chunk_keys),
+                segment_keys=_pack_strings(self._segment_keys),
+                entity_chunks_indptr=entity_chunks_indptr,
+                entity_chunks=entity_chunks,
+                chunk_segments_indptr=chunk_segments_indptr,
+                chunk_segments=chunk_segments,
+                chunk_indexed=np.packbits(np.array(self._chunk_indexed, dtype=bool)),
+            )
+        os.replace(tmp_file_name, self._file_name)
+        self._file_mtime = os.stat(self._file_name).st_mtime_ns
+        self._changed_entities = set()
+        self._changed_chunks = set()
+
+    def _merge_file_if_changed(self, keep_ours: bool):
+        """Fold in what another process committed since we read the file,
+        keeping the ids running queries already hold. With `keep_ours` the
+        keys this instance changed win, otherwise the file's entries do."""
+        current = os.stat(self._file_name).st_mtime_ns if os.path.exists(self._file_name) else None
+        if current == self._file_mtime:
+            return
+        entity_names, chunk_keys, segment_keys, entity_chunks, chunk_segments, chunk_indexed = self._read_file()
+        skip_chunks = self._changed_chunks if keep_ours else set()
+        skip_entities = self._changed_entities if keep_ours else set()
+        self._set_chunks({
+            chunk_keys[i]: [segment_keys[s] for s in segments.tolist()]
+            for i, (segments, indexed) in enumerate(zip(chunk_segments, chunk_indexed))
+            if indexed and chunk_keys[i] not in skip_chunks
+        })
+        self._set_entities({
+            name: [chunk_keys[c] for c in chunks.tolist()]
+            for name, chunks in zip(entity_names, entity_chunks)
+            if name not in skip_entities
+        })
+
+    def _acquire_lock(self, blocking: bool = True):
+        lock = open(self._lock_file, "ab")
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock.close()
+            return None
+        except BaseException:
+            lock.close()
+            raise
+        return lock
+
+    async def index_done_callback(self):
+        lock = await asyncio.to_thread(self._acquire_lock)
+        try:
+            # entities this ingest merged are the newest; keep the rest of
+            # what other processes committed meanwhile
+            self._merge_file_if_changed(keep_ours=True)
+            self._save()
+        finally:
+            lock.close()
+
+    async def query_done_callback(self):
+        """Persist what queries backfilled for sessions indexed before this
+        index existed, so later processes do not read the graph for it again.
+        Skipped while another process commits; the next query retries."""
+        if not self._changed_entities and not self._changed_chunks:
+            return
+        lock = self._acquire_lock(blocking=False)
+        if lock is None:
+            return
+        try:
+            # a committed ingest knows better than what we backfilled
+            self._merge_file_if_changed(keep_ours=False)
+            self._save()
+        finally:
+            lock.close()
@@ -17,7 +17,12 @@ def make_path_idable(path):
 
 @dataclass
 class Neo4jStorage(BaseGraphStorage):
+    # rows per UNWIND transaction in upsert_nodes / upsert_edges
+    upsert_batch_size: int = 1000
+
     def __post_init__(self):
+        params = self.global_config.get("graph_storage_cls_kwargs", {})
+        self.upsert_batch_size = params.get("upsert_batch_size", self.upsert_batch_size)
         self.neo4j_url = self.global_config["addon_params"].get("neo4j_url", None)
         self.neo4j_auth = self.global_config["addon_params"].get("neo4j_auth", None)
         self.namespace = (
@@ -59,6 +64,9 @@ class Neo4jStorage(BaseGraphStorage):
     async def _init_workspace(self):
         await self.async_driver.verify_authentication()
         await self.async_driver.verify_connectivity()
+        # every lookup and MERGE matches on n.id
+        async with self.async_driver.session() as session:
+            await session.run(f"CREATE INDEX IF NOT EXISTS FOR (n:{self.namespace}) ON (n.id)")
         # TODOLater: create database if not exists always cause an error when async
         # await self.create_database()
 
@@ -117,6 +125,10 @@ class Neo4jStorage(BaseGraphStorage):
             )
             record = await result.single()
             raw_node_data = record["node_data"] if record else None
+        return self._with_clusters(raw_node_data)
+
+    @staticmethod
+    def _with_clusters(raw_node_data: Union[dict, None]) -> Union[dict, None]:
         if raw_node_data is None:
             return None
         raw_node_data["clusters"] = json.dumps(
@@ -160,6 +172,58 @@ class Neo4jStorage(BaseGraphStorage):
                 edges.append((record["source"], record["target"]))
             return edges
 
+    # the batch reads below send every id in one UNWIND query
+
+    async def get_nodes(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        async with self.async_driver.session() as session:
+            result = await session.run(
+                f"UNWIND $node_ids AS node_id MATCH (n:{self.namespace}) WHERE n.id = node_id "
+                "RETURN node_id, properties(n) AS node_data",
+                node_ids=list(node_ids),
+            )
+            found = {record["node_id"]: record["node_data"] async for record in result}
+        return [self._with_clusters(found.get(n)) for n in node_ids]
+
+    async def node_degrees(self, node_ids: list[str]) -> list[int]:
+        async with self.async_driver.session() as session:
+            result = await session.run(
+                f"UNWIND $node_ids AS node_id MATCH (n:{self.namespace}) WHERE n.id = node_id "
+                f"RETURN node_id, COUNT {{(n)-[]-(:{self.namespace})}} AS degree",
+                node_ids=list(node_ids),
+            )
+            found = {record["node_id"]: record["degree"] async for record in result}
+        return [found.get(n, 0) for n in node_ids]
+
+    async def get_nodes_edges(
+        self, source_node_ids: list[str]
+    ) -> list[list[tuple[str, str]]]:
+        edges = {n: [] for n in source_node_ids}
+        async with self.async_driver.session() as session:
+            result = await session.run(
+                f"UNWIND $source_ids AS source_id MATCH (s:{self.namespace})-[r]->(t:{self.namespace}) "
+                "WHERE s.id = source_id RETURN s.id AS source, t.id AS target",
+                source_ids=list(edges),
+            )
+            async for record in result:
+                edges[record["source"]].append((record["source"], record["target"]))
+        return [edges[n] for n in source_node_ids]
+
+    async def get_edges(
+        self, edge_pairs: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        async with self.async_driver.session() as session:
+            result = await session.run(
+                f"UNWIND $pairs AS pair MATCH (s:{self.namespace})-[r]->(t:{self.namespace}) "
+                "WHERE s.id = pair[0] AND t.id = pair[1] "
+                "RETURN s.id AS source, t.id AS target, properties(r) AS edge_data",
+                pairs=[list(pair) for pair in edge_pairs],
+            )
+            found = {
+                (record["source"], record["target"]): record["edge_data"]
+                async for record in result
+            }
+        return [found.get(tuple(pair)) for pair in edge_pairs]
+
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         node_type = node_data.get("entity_type", "UNKNOWN").strip('"')
         async with self.async_driver.session() as session:
@@ -185,6 +249,40 @@ class Neo4jStorage(BaseGraphStorage):
                 edge_data=edge_data,
             )
 
+    async def _write_batches(self, query: str, rows: list[dict]):
+        async def _write(tx, batch):
+            await tx.run(query, rows=batch)
+
+        async with self.async_driver.session() as session:
+            for start in range(0, len(rows), self.upsert_batch_size):
+                await session.execute_write(_write, rows[start : start + self.upsert_batch_size])
+
+    async def upsert_nodes(self, nodes: dict[str, dict]):
+        # labels cannot be parameters, so there is one statement per entity type
+        by_type = defaultdict(list)
+        for node_id, node_data in nodes.items():
+            node_type = node_data.get("entity_type", "UNKNOWN").strip('"')
+            by_type[node_type].append({"id": node_id, "node_data": node_data})
+        for node_type, rows in by_type.items():
+            await self._write_batches(
+                f"UNWIND $rows AS row MERGE (n:{self.namespace}:{node_type} {{id: row.id}}) "
+                "SET n += row.node_data",
+                rows,
+            )
+
+    async def upsert_edges(self, edges: dict[tuple[str, str], dict]):
+        rows = []
+        for (source_node_id, target_node_id), edge_data in edges.items():
+            edge_data.setdefault("weight", 0.0)
+            rows.append({"source": source_node_id, "target": target_node_id, "edge_data": edge_data})
+        await self._write_batches(
+            f"UNWIND $rows AS row MATCH (s:{self.namespace}), (t:{self.namespace}) "
+            "WHERE s.id = row.source AND t.id = row.target "
+            "MERGE (s)-[r:RELATED]->(t) "
+            "SET r += row.edge_data",
+            rows,
+        )
+
     async def clustering(self, algorithm: str):
         if algorithm != "leiden":
             raise ValueError(
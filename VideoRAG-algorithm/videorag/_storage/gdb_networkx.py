@@ -1,7 +1,12 @@
+import asyncio
+import fcntl
 import html
 import json
 import os
+import threading
+import time
 from collections import defaultdict
+from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import Any, Union, cast
 import networkx as nx
@@ -14,9 +19,87 @@ from ..base import (
 )
 from ..prompt import GRAPH_FIELD_SEP
 
+SNAPSHOT_VERSION = 1
+# kinds of attribute values in a snapshot
+_STR, _INT, _FLOAT, _BOOL = 0, 1, 2, 3
+
+
+class _StringTable:
+    """Interns strings to indexes; stored as one NUL-joined UTF-8 blob"""
+
+    def __init__(self):
+        self._index: dict[str, int] = {}
+        self.strings: list[str] = []
+
+    def __call__(self, s: str) -> int:
+        i = self._index.get(s)
+        if i is None:
+            if "\x00" in s:
+                raise ValueError(f"Cannot store a string containing NUL in a graph snapshot: {s[:50]!r}")
+            i = self._index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def to_array(self) -> np.ndarray:
+        return np.frombuffer("\x00".join(self.strings).encode("utf-8"), dtype=np.uint8)
+
+
+def _attribute_table(prefix: str, attrs_list: list[dict], strings: _StringTable) -> dict:
+    """Flatten per-node / per-edge attribute dicts into parallel arrays"""
+    owner, key, kind, ival, fval = [], [], [], [], []
+    for i, attrs in enumerate(attrs_list):
+        for k, v in attrs.items():
+            owner.append(i)
+            key.append(strings(k))
+            if isinstance(v, bool):
+                kind.append(_BOOL)
+                ival.append(int(v))
+            elif isinstance(v, (int, np.integer)):
+                kind.append(_INT)
+                ival.append(int(v))
+            elif isinstance(v, (float, np.floating)):
+                kind.append(_FLOAT)
+                fval.append(float(v))
+            else:
+                kind.append(_STR)
+                ival.append(strings(str(v)))
+    return {
+        f"{prefix}_owner": np.array(owner, dtype=np.int32),
+        f"{prefix}_key": np.array(key, dtype=np.int32),
+        f"{prefix}_kind": np.array(kind, dtype=np.int8),
+        f"{prefix}_ival": np.array(ival, dtype=np.int64),
+        f"{prefix}_fval": np.array(fval, dtype=np.float64),
+    }
+
+
+def _attribute_dicts(prefix: str, count: int, data, strings: list[str]) -> list[dict]:
+    attrs_list = [{} for _ in range(count)]
+    ival = iter(data[f"{prefix}_ival"].tolist())
+    fval = iter(data[f"{prefix}_fval"].tolist())
+    for owner, key, kind in zip(
+        data[f"{prefix}_owner"].tolist(),
+        data[f"{prefix}_key"].tolist(),
+        data[f"{prefix}_kind"].tolist(),
+    ):
+        if kind == _FLOAT:
+            value = next(fval)
+        elif kind == _STR:
+            value = strings[next(ival)]
+        elif kind == _BOOL:
+            value = bool(next(ival))
+        else:
+            value = next(ival)
+        attrs_list[owner][strings[key]] = value
+    return attrs_list
+
 
 @dataclass
 class NetworkXStorage(BaseGraphStorage):
+    # also write graph_<namespace>.graphml on every commit, for external tools
+    graphml_export: bool = False
+    # fold the mutation log into the snapshot once it reaches this share of it
+    compact_ratio: float = 0.5
+
     @staticmethod
     def load_nx_graph(file_name) -> nx.Graph:
         if os.path.exists(file_name):
@@ -30,6 +113,52 @@ class NetworkXStorage(BaseGraphStorage):
         )
         nx.write_graphml(graph, file_name)
 
+    @staticmethod
+    def load_nx_snapshot(file_name) -> nx.Graph:
+        if not os.path.exists(file_name):
+            return None
+        with np.load(file_name) as data:
+            version, directed = data["header"].tolist()
+            if version != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported graph snapshot version {version} in {file_name}")
+            strings = data["strings"].tobytes().decode("utf-8").split("\x00")
+            node_names = [strings[i] for i in data["node_ids"].tolist()]
+            node_attrs = _attribute_dicts("node", len(node_names), data, strings)
+            edge_src = data["edge_src"].tolist()
+            edge_tgt = data["edge_tgt"].tolist()
+            edge_attrs = _attribute_dicts("edge", len(edge_src), data, strings)
+        graph = nx.DiGraph() if directed else nx.Graph()
+        graph.add_nodes_from(zip(node_names, node_attrs))
+        graph.add_edges_from(
+            (node_names[s], node_names[t], attrs)
+            for s, t, attrs in zip(edge_src, edge_tgt, edge_attrs)
+        )
+        return graph
+
+    @staticmethod
+    def write_nx_snapshot(graph: nx.Graph, file_name):
+        """Binary node / edge tables with every string interned once"""
+        logger.info(
+            f"Writing graph snapshot with {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges"
+        )
+        strings = _StringTable()
+        node_names = list(graph.nodes)
+        node_position = {n: i for i, n in enumerate(node_names)}
+        edges = list(graph.edges(data=True))
+        arrays = {
+            "header": np.array([SNAPSHOT_VERSION, int(graph.is_directed())], dtype=np.int32),
+            "node_ids": np.array([strings(str(n)) for n in node_names], dtype=np.int32),
+            "edge_src": np.array([node_position[s] for s, _, _ in edges], dtype=np.int32),
+            "edge_tgt": np.array([node_position[t] for _, t, _ in edges], dtype=np.int32),
+            **_attribute_table("node", [graph.nodes[n] for n in node_names], strings),
+            **_attribute_table("edge", [attrs for _, _, attrs in edges], strings),
+        }
+        arrays["strings"] = strings.to_array()
+        tmp_file_name = file_name + ".tmp"
+        with open(tmp_file_name, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file_name, file_name)
+
     @staticmethod
     def stable_largest_connected_component(graph: nx.Graph) -> nx.Graph:
         """Refer to https://github.com/microsoft/graphrag/index/graph/utils/stable_lcc.py
@@ -80,12 +209,48 @@ class NetworkXStorage(BaseGraphStorage):
         self._graphml_xml_file = os.path.join(
             self.global_config["working_dir"], f"graph_{self.namespace}.graphml"
         )
-        preloaded_graph = NetworkXStorage.load_nx_graph(self._graphml_xml_file)
+        self._snapshot_file = os.path.join(
+            self.global_config["working_dir"], f"graph_{self.namespace}.npz"
+        )
+        # written in full before it replaces the snapshot
+        self._next_snapshot_file = self._snapshot_file + ".next"
+        # upserts since the last snapshot, one JSON record per line
+        self._log_file = os.path.join(
+            self.global_config["working_dir"], f"graph_{self.namespace}.log"
+        )
+        # the log being folded into the snapshot by a running compaction
+        self._compacting_log_file = self._log_file + ".old"
+        params = self.global_config.get("graph_storage_cls_kwargs", {})
+        self.graphml_export = params.get("graphml_export", self.graphml_export)
+        self.compact_ratio = params.get("compact_ratio", self.compact_ratio)
+        # held shared while the snapshot and logs are read, and exclusively
+        # while a writer swaps the snapshot or moves the logs
+        self._files_lock_file = os.path.join(
+            self.global_config["working_dir"], f"graph_{self.namespace}.files.lock"
+        )
+        with self._files_locked(fcntl.LOCK_SH):
+            # GraphML is only read for sessions saved before snapshots existed
+            loaded_from = self._snapshot_file
+            preloaded_graph = NetworkXStorage.load_nx_snapshot(self._snapshot_file)
+            if preloaded_graph is None:
+                loaded_from = self._graphml_xml_file
+                preloaded_graph = NetworkXStorage.load_nx_graph(self._graphml_xml_file)
+            self._graph = preloaded_graph or nx.Graph()
+            # only the process holding the writer lock may fold in or cut the
+            # logs; everyone else reads them as they are
+            replayed = self._replay_log(self._compacting_log_file) + self._replay_log(self._log_file)
         if preloaded_graph is not None:
             logger.info(
-                f"Loaded graph from {self._graphml_xml_file} with {preloaded_graph.number_of_nodes()} nodes, {preloaded_graph.number_of_edges()} edges"
+                f"Loaded graph from {loaded_from} with {preloaded_graph.number_of_nodes()} nodes, {preloaded_graph.number_of_edges()} edges"
             )
-        self._graph = preloaded_graph or nx.Graph()
+        if replayed:
+            logger.info(f"Replayed {replayed} graph mutations from {self._log_file}")
+        self._lock_file = os.path.join(
+            self.global_config["working_dir"], f"graph_{self.namespace}.lock"
+        )
+        self._writer_lock = None
+        self._log = None
+        self._compaction: threading.Thread = None
         self._clustering_algorithms = {
             "leiden": self._leiden_clustering,
         }
@@ -93,8 +258,137 @@ class NetworkXStorage(BaseGraphStorage):
             "node2vec": self._node2vec_embed,
         }
 
+    def _replay_log(self, file_name, truncate_torn: bool = False) -> int:
+        if not os.path.exists(file_name):
+            return 0
+        replayed, valid_size = 0, 0
+        with open(file_name, "rb+" if truncate_torn else "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if truncate_torn:
+                        # torn last append, cut it off so new records start on a fresh line
+                        logger.warning(f"Dropping a torn record at the end of {file_name}")
+                        f.truncate(valid_size)
+                    # otherwise it may be a record the writer is still appending
+                    break
+                # upserts merge attributes, so replaying records the snapshot
+                # already holds is harmless
+                if record[0] == "n":
+                    self._graph.add_node(record[1], **record[2])
+                else:
+                    self._graph.add_edge(record[1], record[2], **record[3])
+                replayed += 1
+                valid_size += len(line)
+        return replayed
+
+    @contextmanager
+    def _files_locked(self, operation: int):
+        with open(self._files_lock_file, "ab") as lock:
+            fcntl.flock(lock.fileno(), operation)
+            yield
+
+    def _acquire_writer_lock(self):
+        lock = open(self._lock_file, "ab")
+        try:
+            # blocks while another process is indexing or compacting this graph
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            lock.close()
+            raise
+        return lock
+
+    def _release_writer_lock(self):
+        if self._writer_lock is not None:
+            self._writer_lock.close()
+            self._writer_lock = None
+
+    async def index_start_callback(self):
+        if self._compaction is not None:
+            # our own compaction still holds the lock until its snapshot is written
+            await asyncio.to_thread(self._compaction.join)
+        if self._writer_lock is not None:
+            return
+        self._writer_lock = await asyncio.to_thread(self._acquire_writer_lock)
+        # another writer may have committed since this instance loaded
+        graph = NetworkXStorage.load_nx_snapshot(self._snapshot_file)
+        if graph is None:
+            graph = NetworkXStorage.load_nx_graph(self._graphml_xml_file)
+        self._graph = graph or nx.Graph()
+        interrupted = os.path.exists(self._compacting_log_file)
+        self._replay_log(self._compacting_log_file, truncate_torn=True)
+        self._replay_log(self._log_file, truncate_torn=True)
+        if interrupted:
+            # the last compaction did not finish; fold both logs in right away
+            logger.info(f"Folding {self._compacting_log_file} left from a failed compaction")
+            NetworkXStorage.write_nx_snapshot(self._graph, self._next_snapshot_file)
+            with self._files_locked(fcntl.LOCK_EX):
+                os.replace(self._next_snapshot_file, self._snapshot_file)
+                os.remove(self._compacting_log_file)
+                open(self._log_file, "wb").close()
+        self._log = open(self._log_file, "ab")
+
+    def _append_to_log(self, record: list):
+        if self._log is None:
+            raise RuntimeError(
+                f"{self._log_file} is not open for writing, call index_start_callback before upserting"
+            )
+        self._log.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+
     async def index_done_callback(self):
-        NetworkXStorage.write_nx_graph(self._graph, self._graphml_xml_file)
+        if self._log is None:
+            # opened for querying only, there is nothing of ours to commit
+            return
+        # the commit itself only costs as much as the mutations since the last one
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        if self.graphml_export:
+            self.export_graphml()
+        log_size = os.fstat(self._log.fileno()).st_size
+        if not os.path.exists(self._snapshot_file) or (
+            log_size and log_size >= self.compact_ratio * os.path.getsize(self._snapshot_file)
+        ):
+            self._start_compaction()
+        else:
+            self._log.close()
+            self._log = None
+            self._release_writer_lock()
+
+    def _start_compaction(self):
+        graph = self._graph.copy()
+        self._log.close()
+        self._log = None
+        with self._files_locked(fcntl.LOCK_EX):
+            os.replace(self._log_file, self._compacting_log_file)
+        # hand the lock to the thread so no other process folds the rotated
+        # log in while the snapshot is being written
+        writer_lock, self._writer_lock = self._writer_lock, None
+
+        def compact():
+            start = time.perf_counter()
+            try:
+                NetworkXStorage.write_nx_snapshot(graph, self._next_snapshot_file)
+                # a reader sees the old snapshot with the rotated log or the
+                # new snapshot without it, never a mix of the two
+                with self._files_locked(fcntl.LOCK_EX):
+                    os.replace(self._next_snapshot_file, self._snapshot_file)
+                    try:
+                        os.remove(self._compacting_log_file)
+                    except FileNotFoundError:
+                        pass
+                logger.info(
+                    f"Compacted the {self.namespace} graph log into {self._snapshot_file} in {time.perf_counter() - start:.2f}s"
+                )
+            finally:
+                writer_lock.close()
+
+        # not a daemon, so an exiting process still finishes the snapshot
+        self._compaction = threading.Thread(target=compact, name=f"compact-graph-{self.namespace}")
+        self._compaction.start()
+
+    def export_graphml(self, file_name: str = None):
+        NetworkXStorage.write_nx_graph(self._graph, file_name or self._graphml_xml_file)
 
     async def has_node(self, node_id: str) -> bool:
         return self._graph.has_node(node_id)
@@ -124,13 +418,33 @@ class NetworkXStorage(BaseGraphStorage):
             return list(self._graph.edges(source_node_id))
         return None
 
+    async def get_nodes(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        nodes = self._graph.nodes
+        return [nodes.get(n) for n in node_ids]
+
+    async def node_degrees(self, node_ids: list[str]) -> list[int]:
+        degree = self._graph.degree
+        return [degree(n) if n in self._graph else 0 for n in node_ids]
+
+    async def get_nodes_edges(self, source_node_ids: list[str]):
+        edges = self._graph.edges
+        return [list(edges(n)) if n in self._graph else None for n in source_node_ids]
+
+    async def get_edges(
+        self, edge_pairs: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        edges = self._graph.edges
+        return [edges.get(pair) for pair in edge_pairs]
+
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         self._graph.add_node(node_id, **node_data)
+        self._append_to_log(["n", node_id, node_data])
 
     async def upsert_edge(
         self, source_node_id: str, target_node_id: str, edge_data: dict[str, str]
     ):
         self._graph.add_edge(source_node_id, target_node_id, **edge_data)
+        self._append_to_log(["e", source_node_id, target_node_id, edge_data])
 
     async def clustering(self, algorithm: str):
         if algorithm not in self._clustering_algorithms:
@@ -196,6 +510,7 @@ class NetworkXStorage(BaseGraphStorage):
     def _cluster_data_to_subgraphs(self, cluster_data: dict[str, list[dict[str, str]]]):
         for node_id, clusters in cluster_data.items():
             self._graph.nodes[node_id]["clusters"] = json.dumps(clusters)
+            self._append_to_log(["n", node_id, {"clusters": json.dumps(clusters)}])
 
     async def _leiden_clustering(self):
         from graspologic.partition import hierarchical_leiden
@@ -0,0 +1,213 @@
+import json
+import os
+import time
+from dataclasses import dataclass
+
+from .._utils import load_json, logger, write_json
+from ..base import (
+    BaseKVStorage,
+)
+
+
+def _encode_record(key: str, value) -> bytes:
+    return (json.dumps([key, value], ensure_ascii=False) + "\n").encode("utf-8")
+
+
+@dataclass
+class LogKVStorage(BaseKVStorage):
+    """Append-only key-value store for write-heavy namespaces such as the LLM
+    response cache.
+
+    Upserts are appended to a write-ahead log (`kv_log_<namespace>.wal`) and
+    kept in memory; everything older lives in a compacted data file
+    (`kv_log_<namespace>.data`, one `[key, value]` JSON line per record) that
+    is read on demand through an offset index (`kv_log_<namespace>.index`).
+    index_done_callback only flushes the log, fsyncs it in batches and folds it
+    into the data file once it has grown past `compact_ratio` of it.
+    """
+
+    fsync_every: int = 64
+    fsync_interval: float = 1.0
+    compact_ratio: float = 0.5
+    compact_min_bytes: int = 4 << 20
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        prefix = os.path.join(working_dir, f"kv_log_{self.namespace}")
+        self._data_file_name = prefix + ".data"
+        self._index_file_name = prefix + ".index"
+        self._wal_file_name = prefix + ".wal"
+        params = self.global_config.get("llm_cache_storage_cls_kwargs", {})
+        self.fsync_every = params.get("fsync_every", self.fsync_every)
+        self.fsync_interval = params.get("fsync_interval", self.fsync_interval)
+        self.compact_ratio = params.get("compact_ratio", self.compact_ratio)
+        self.compact_min_bytes = params.get("compact_min_bytes", self.compact_min_bytes)
+
+        # key -> (offset, length) in the data file
+        self._offsets: dict[str, tuple[int, int]] = {}
+        # records written since the last compaction
+        self._recent: dict = {}
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        if not os.path.exists(self._data_file_name) and not os.path.exists(self._wal_file_name):
+            self._import_json_store(os.path.join(working_dir, f"kv_store_{self.namespace}.json"))
+        self._load_index()
+        self._replay_wal()
+        self._reader = open(self._data_file_name, "rb") if os.path.exists(self._data_file_name) else None
+        self._wal = open(self._wal_file_name, "ab")
+        logger.info(
+            f"Load log KV {self.namespace} with {len(self._offsets.keys() | self._recent.keys())} data"
+        )
+
+    def _import_json_store(self, legacy_file_name: str):
+        legacy = load_json(legacy_file_name)
+        if not legacy:
+            return
+        logger.info(f"Importing {len(legacy)} records of {legacy_file_name} into the log KV store")
+        self._recent = legacy
+        self._write_data_file({})
+        self._recent = {}
+
+    def _load_index(self):
+        if not os.path.exists(self._data_file_name):
+            return
+        index = load_json(self._index_file_name) or {}
+        if index.get("data_size") == os.path.getsize(self._data_file_name):
+            self._offsets = {k: tuple(v) for k, v in index["offsets"].items()}
+            return
+        # missing or stale index, e.g. after a crash mid-compaction
+        logger.warning(f"Rebuilding the offset index of {self._data_file_name}")
+        offset = 0
+        with open(self._data_file_name, "rb") as f:
+            for line in f:
+                key = json.loads(line)[0]
+                self._offsets[key] = (offset, len(line))
+                offset += len(line)
+        self._write_index()
+
+    def _write_index(self):
+        write_json(
+            {"data_size": os.path.getsize(self._data_file_name), "offsets": self._offsets},
+            self._index_file_name,
+        )
+
+    def _replay_wal(self):
+        if not os.path.exists(self._wal_file_name):
+            return
+        valid_size = 0
+        with open(self._wal_file_name, "rb+") as f:
+            for line in f:
+                try:
+                    key, value = json.loads(line)
+                except ValueError:
+                    # torn last append, cut it off so new records start on a fresh line
+                    logger.warning(f"Dropping a torn record at the end of {self._wal_file_name}")
+                    f.truncate(valid_size)
+                    break
+                self._recent[key] = value
+                valid_size += len(line)
+
+    def _read(self, id: str):
+        if id in self._recent:
+            return self._recent[id]
+        location = self._offsets.get(id)
+        if location is None:
+            return None
+        self._reader.seek(location[0])
+        return json.loads(self._reader.read(location[1]))[1]
+
+    async def all_keys(self) -> list[str]:
+        return list(self._offsets.keys() | self._recent.keys())
+
+    async def get_by_id(self, id):
+        return self._read(id)
+
+    async def get_by_ids(self, ids, fields=None):
+        values = [self._read(id) for id in ids]
+        if fields is None:
+            return values
+        return [
+            {k: v for k, v in value.items() if k in fields} if value else None
+            for value in values
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        return set([s for s in data if s not in self._recent and s not in self._offsets])
+
+    async def upsert(self, data: dict[str, dict]):
+        self._wal.write(b"".join(_encode_record(k, v) for k, v in data.items()))
+        self._recent.update(data)
+        self._unsynced += len(data)
+
+    def _sync(self):
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    async def index_done_callback(self):
+        # called after every cached completion, so this has to stay cheap
+        self._wal.flush()
+        if self._unsynced and (
+            self._unsynced >= self.fsync_every
+            or time.monotonic() - self._last_sync >= self.fsync_interval
+        ):
+            self._sync()
+        data_size = os.fstat(self._reader.fileno()).st_size if self._reader is not None else 0
+        wal_size = self._wal.tell()
+        if wal_size >= self.compact_min_bytes and wal_size >= self.compact_ratio * data_size:
+            self._compact()
+
+    def _write_data_file(self, offsets: dict):
+        """Rewrite the data file from `offsets` (read through the current data
+        file) plus the in-memory records"""
+        new_offsets = {}
+        offset = 0
+        tmp_file_name = self._data_file_name + ".tmp"
+        with open(tmp_file_name, "wb") as f:
+            for key, (start, length) in offsets.items():
+                if key in self._recent:
+                    continue
+                self._reader.seek(start)
+                f.write(self._reader.read(length))
+                new_offsets[key] = (offset, length)
+                offset += length
+            for key, value in self._recent.items():
+                record = _encode_record(key, value)
+                f.write(record)
+                new_offsets[key] = (offset, len(record))
+                offset += len(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_name, self._data_file_name)
+        self._offsets = new_offsets
+        self._write_index()
+
+    def _compact(self):
+        start = time.perf_counter()
+        self._sync()
+        self._write_data_file(self._offsets)
+        if self._reader is not None:
+            self._reader.close()
+        self._reader = open(self._data_file_name, "rb")
+        # the log is only dropped once the data file holds all of it
+        self._wal.close()
+        self._wal = open(self._wal_file_name, "wb")
+        self._recent = {}
+        logger.info(
+            f"Compacted log KV {self.namespace} to {len(self._offsets)} records in {time.perf_counter() - start:.2f}s"
+        )
+
+    async def drop(self):
+        self._offsets = {}
+        self._recent = {}
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        for file_name in (self._data_file_name, self._index_file_name):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        self._wal.close()
+        self._wal = open(self._wal_file_name, "wb")
+        self._unsynced = 0
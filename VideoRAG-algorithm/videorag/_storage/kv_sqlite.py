@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+
+from .._utils import load_json, logger
+from ..base import (
+    BaseKVStorage,
+)
+
+# the namespaces VideoRAG keeps in key_string_value_json_storage_cls
+KV_NAMESPACES = ("video_path", "video_segments", "text_chunks", "inserted_videos")
+
+
+def _connect(file_name: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(file_name, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID"
+    )
+    conn.commit()
+    return conn
+
+
+def _upsert_rows(conn: sqlite3.Connection, data: dict):
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+            ((k, json.dumps(v, ensure_ascii=False)) for k, v in data.items()),
+        )
+
+
+def migrate_json_kv_store(working_dir: str, namespace: str) -> int:
+    """Copy kv_store_<namespace>.json into kv_store_<namespace>.sqlite, returns
+    the number of records copied. The JSON file is left in place."""
+    legacy = load_json(os.path.join(working_dir, f"kv_store_{namespace}.json"))
+    if not legacy:
+        return 0
+    file_name = os.path.join(working_dir, f"kv_store_{namespace}.sqlite")
+    # built aside so that an interrupted migration never looks finished
+    conn = _connect(file_name + ".tmp")
+    try:
+        _upsert_rows(conn, legacy)
+    finally:
+        conn.close()
+    os.replace(file_name + ".tmp", file_name)
+    return len(legacy)
+
+
+@dataclass
+class SqliteKVStorage(BaseKVStorage):
+    """Key-value namespace in `kv_store_<namespace>.sqlite` (WAL mode). Values
+    are stored as JSON text and only loaded when asked for, so a session's
+    segments and chunks no longer have to sit in memory."""
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.sqlite")
+        if not os.path.exists(self._file_name):
+            migrated = migrate_json_kv_store(working_dir, self.namespace)
+            if migrated:
+                logger.info(f"Imported {migrated} records of kv_store_{self.namespace}.json")
+        self._lock = threading.Lock()
+        self._conn = _connect(self._file_name)
+        self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS probe_keys (key TEXT PRIMARY KEY)")
+        count = self._conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+        logger.info(f"Load KV {self.namespace} with {count} data")
+
+    async def all_keys(self) -> list[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT key FROM kv")]
+
+    async def index_done_callback(self):
+        # every upsert is already committed; fold the WAL back into the database
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    async def get_by_id(self, id):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM kv WHERE key = ?", (id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    async def get_by_ids(self, ids, fields=None):
+        # the ids go in as one JSON array, so any number of them is a single query
+        with self._lock:
+            found = dict(
+                self._conn.execute(
+                    "SELECT key, value FROM kv WHERE key IN (SELECT value FROM json_each(?))",
+                    (json.dumps(list(ids)),),
+                ).fetchall()
+            )
+        values = [json.loads(found[id]) if id in found else None for id in ids]
+        if fields is None:
+            return values
+        return [
+            {k: v for k, v in value.items() if k in fields} if value else None
+            for value in values
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM probe_keys")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO probe_keys (key) VALUES (?)", ((k,) for k in data)
+            )
+            return {
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT p.key FROM probe_keys p LEFT JOIN kv ON kv.key = p.key WHERE kv.key IS NULL"
+                )
+            }
+
+    async def upsert(self, data: dict[str, dict]):
+        with self._lock:
+            _upsert_rows(self._conn, data)
+
+    async def drop(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM kv")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Copy kv_store_*.json files into SQLite KV stores, searching the given directories recursively"
+    )
+    parser.add_argument("dirs", nargs="+")
+    parser.add_argument("--namespaces", nargs="+", default=list(KV_NAMESPACES))
+    parser.add_argument("--remove-json", action="store_true", help="delete each JSON file once copied")
+    args = parser.parse_args()
+
+    for root_dir in args.dirs:
+        for working_dir, _, files in os.walk(root_dir):
+            for namespace in args.namespaces:
+                json_file = f"kv_store_{namespace}.json"
+                if json_file not in files:
+                    continue
+                if os.path.exists(os.path.join(working_dir, f"kv_store_{namespace}.sqlite")):
+                    print(f"skip {working_dir}/{json_file}: already migrated")
+                    continue
+                count = migrate_json_kv_store(working_dir, namespace)
+                print(f"{working_dir}/{json_file}: {count} records")
+                if args.remove_json:
+                    os.remove(os.path.join(working_dir, json_file))
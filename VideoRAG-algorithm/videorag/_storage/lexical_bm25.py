@@ -0,0 +1,196 @@
+import asyncio
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+
+from .._utils import logger
+from ..base import StorageNameSpace, VideoScope, value_videos
+
+# latin words / identifiers / numbers as a whole, CJK one character at a time
+TOKEN_PATTERN = re.compile(r"[0-9a-z_]+|[\u4e00-\u9fff]")
+
+
+# function words that would otherwise match nearly every chunk
+STOPWORDS = frozenset(
+    """a an and are as at be been but by can could did do does for from had has
+    have how i if in into is it its me my no not of on or our she so than that
+    the their them then there these they this those to was we were what when
+    where which who why will with would you your
+    的 了 是 在 和 有 我 你 他 她 它 这 那 就 也 都 而 及 与 吗 呢 吧 啊 么 什 个 们 之 着 被 把""".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+def _encode_doc(doc_id: str, counts: dict[str, int], videos) -> bytes:
+    return (json.dumps([doc_id, counts, videos], ensure_ascii=False) + "\n").encode("utf-8")
+
+
+@dataclass
+class BM25Storage(StorageNameSpace):
+    """Incremental BM25 inverted index over the 'content' of upserted records.
+
+    Each upserted document's term counts are appended to
+    `bm25_<namespace>.jsonl` in the working dir (a later line for the same id
+    supersedes the earlier one) and the postings are rebuilt from it on load;
+    the log is rewritten once superseded lines outnumber live documents.
+
+    Stopwords are not indexed, and hits matching less than `min_match` of the
+    query's IDF mass are dropped, so a query that shares only incidental words
+    with the chunks gets no lexical hits."""
+
+    k1: float = 1.2
+    b: float = 0.75
+    min_match: float = 0.3
+
+    def __post_init__(self):
+        self._file_name = os.path.join(
+            self.global_config["working_dir"], f"bm25_{self.namespace}.jsonl"
+        )
+        params = self.global_config.get("lexical_storage_cls_kwargs", {})
+        self.k1 = params.get("k1", self.k1)
+        self.b = params.get("b", self.b)
+        self.min_match = params.get("min_match", self.min_match)
+        # term -> {doc id: term frequency}
+        self._postings: dict[str, dict[str, int]] = {}
+        self._doc_len: dict[str, int] = {}
+        self._doc_videos: dict[str, list[str]] = {}
+        self._total_len = 0
+        # lines in the log, superseded ones included
+        self._log_records = 0
+        # doc id -> (term counts, videos) not written to the log yet
+        self._unsaved: dict[str, tuple[dict[str, int], list[str]]] = {}
+        # queries score in a worker thread while upserts run on the event loop
+        self._lock = threading.Lock()
+        if os.path.exists(self._file_name):
+            self._replay()
+        logger.info(f"Load BM25 {self.namespace} with {len(self._doc_len)} documents")
+
+    def _replay(self):
+        valid_size = 0
+        with open(self._file_name, "rb+") as f:
+            for line in f:
+                try:
+                    doc_id, counts, videos = json.loads(line)
+                except ValueError:
+                    # torn last append, cut it off so new records start on a fresh line
+                    logger.warning(f"Dropping a torn record at the end of {self._file_name}")
+                    f.truncate(valid_size)
+                    break
+                self._add(doc_id, counts, videos)
+                self._log_records += 1
+                valid_size += len(line)
+
+    def __len__(self):
+        return len(self._doc_len)
+
+    def _remove(self, doc_id: str):
+        # chunk ids are content hashes, so replacing a document is rare
+        for term in [t for t, postings in self._postings.items() if doc_id in postings]:
+            del self._postings[term][doc_id]
+            if not self._postings[term]:
+                del self._postings[term]
+        self._total_len -= self._doc_len.pop(doc_id, 0)
+        self._doc_videos.pop(doc_id, None)
+
+    def _add(self, doc_id: str, counts: dict[str, int], videos):
+        if doc_id in self._doc_len:
+            self._remove(doc_id)
+        for term, tf in counts.items():
+            self._postings.setdefault(term, {})[doc_id] = tf
+        doc_len = sum(counts.values())
+        self._doc_len[doc_id] = doc_len
+        self._total_len += doc_len
+        if videos is not None:
+            self._doc_videos[doc_id] = videos
+
+    async def upsert(self, data: dict[str, dict]):
+        for doc_id, value in data.items():
+            counts = dict(Counter(tokenize(value["content"])))
+            videos = value_videos(value)
+            with self._lock:
+                self._add(doc_id, counts, videos)
+            self._unsaved[doc_id] = (counts, videos)
+
+    def _in_scope(self, doc_id: str, scope: VideoScope) -> bool:
+        videos = self._doc_videos.get(doc_id)
+        return videos is None or any(scope.allows_video(v) for v in videos)
+
+    def _score(self, query: str, top_k: int, scope: VideoScope) -> list[dict]:
+        with self._lock:
+            return self._score_locked(query, top_k, scope)
+
+    def _score_locked(self, query: str, top_k: int, scope: VideoScope) -> list[dict]:
+        if not self._doc_len:
+            return []
+        n_docs = len(self._doc_len)
+        avg_len = self._total_len / n_docs
+        scores: dict[str, float] = {}
+        # score of an average-length document holding every query term once,
+        # terms absent from the index included
+        full_match = 0.0
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term, {})
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            full_match += idf
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self._doc_len[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        min_score = self.min_match * full_match
+        scores = {k: v for k, v in scores.items() if v >= min_score}
+        if scope is not None:
+            scores = {k: v for k, v in scores.items() if self._in_scope(k, scope)}
+        best = heapq.nlargest(top_k, scores.items(), key=lambda x: x[1])
+        return [{"id": doc_id, "score": score} for doc_id, score in best]
+
+    async def query(
+        self, query: str, top_k: int = 20, scope: VideoScope = None
+    ) -> list[dict]:
+        return (await self.query_batch([query], top_k, scope=scope))[0]
+
+    async def query_batch(
+        self, queries: list[str], top_k: int = 20, scope: VideoScope = None
+    ) -> list[list[dict]]:
+        # scoring is pure CPU work, keep it off the event loop so the dense,
+        # entity and segment searches proceed meanwhile
+        return await asyncio.to_thread(
+            lambda: [self._score(query, top_k, scope) for query in queries]
+        )
+
+    def _rewrite_log(self):
+        doc_counts: dict[str, dict[str, int]] = {doc_id: {} for doc_id in self._doc_len}
+        for term, postings in self._postings.items():
+            for doc_id, tf in postings.items():
+                doc_counts[doc_id][term] = tf
+        with open(self._file_name + ".tmp", "wb") as f:
+            for doc_id, counts in doc_counts.items():
+                f.write(_encode_doc(doc_id, counts, self._doc_videos.get(doc_id)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._file_name + ".tmp", self._file_name)
+        self._log_records = len(doc_counts)
+
+    async def index_done_callback(self):
+        if not self._unsaved:
+            return
+        if self._log_records + len(self._unsaved) > 2 * len(self._doc_len):
+            self._rewrite_log()
+        else:
+            with open(self._file_name, "ab") as f:
+                f.write(
+                    b"".join(
+                        _encode_doc(doc_id, counts, videos)
+                        for doc_id, (counts, videos) in self._unsaved.items()
+                    )
+                )
+                f.flush()
+                os.fsync(f.fileno())
+            self._log_records += len(self._unsaved)
+        self._unsaved = {}
@@ -1,4 +1,3 @@
-import asyncio
 import os
 from dataclasses import dataclass, field
 from typing import Any
@@ -7,17 +6,22 @@ import hnswlib
 import numpy as np
 import xxhash
 
-from .._utils import logger
-from ..base import BaseVectorStorage
+from .._utils import load_json, logger, write_json
+from ..base import BaseVectorStorage, VideoScope, record_videos, value_videos
+from .vdb_mmap import MmapVectorDB, _normalize
+from .vdb_nanovectordb import NanoVectorDBVideoSegmentStorage
 
 
 @dataclass
 class HNSWVectorStorage(BaseVectorStorage):
     ef_construction: int = 100
     M: int = 16
-    max_elements: int = 1000000
+    # initial capacity; the index doubles whenever it fills up
+    max_elements: int = 10000
     ef_search: int = 50
     num_threads: int = -1
+    # rebuild the index once this share of its slots is marked deleted
+    compact_deleted_ratio: float = 0.25
     _index: Any = field(init=False)
     _metadata: dict[str, dict] = field(default_factory=dict)
     _current_elements: int = 0
@@ -27,9 +31,11 @@ class HNSWVectorStorage(BaseVectorStorage):
             self.global_config["working_dir"], f"{self.namespace}_hnsw.index"
         )
         self._metadata_file_name = os.path.join(
+            self.global_config["working_dir"], f"{self.namespace}_hnsw_metadata.json"
+        )
+        self._legacy_metadata_file_name = os.path.join(
             self.global_config["working_dir"], f"{self.namespace}_hnsw_metadata.pkl"
         )
-        self._embedding_batch_num = self.global_config.get("embedding_batch_num", 100)
 
         hnsw_params = self.global_config.get("vector_db_storage_cls_kwargs", {})
         self.ef_construction = hnsw_params.get("ef_construction", self.ef_construction)
@@ -37,83 +43,170 @@ class HNSWVectorStorage(BaseVectorStorage):
         self.max_elements = hnsw_params.get("max_elements", self.max_elements)
         self.ef_search = hnsw_params.get("ef_search", self.ef_search)
         self.num_threads = hnsw_params.get("num_threads", self.num_threads)
+        self.compact_deleted_ratio = hnsw_params.get(
+            "compact_deleted_ratio", self.compact_deleted_ratio
+        )
         self._index = hnswlib.Index(
             space="cosine", dim=self.embedding_func.embedding_dim
         )
 
-        if os.path.exists(self._index_file_name) and os.path.exists(
-            self._metadata_file_name
-        ):
+        # id -> label; labels are 64-bit hashes of the id, probed on collision
+        self._id2label: dict[str, int] = {}
+        self._label2id: dict[int, str] = {}
+        self._metadata = {}
+        # labels per video, plus labels stored without video names
+        self._video_labels: dict[str, set[int]] = {}
+        self._unattributed_labels: set[int] = set()
+        stored = self._load_metadata()
+        if stored is not None and os.path.exists(self._index_file_name):
+            self._id2label, self._metadata = stored
+            self._label2id = {label: id_ for id_, label in self._id2label.items()}
+            for id_, label in self._id2label.items():
+                self._track_videos(label, self._metadata.get(id_, {}))
             self._index.load_index(
-                self._index_file_name, max_elements=self.max_elements
+                self._index_file_name,
+                max_elements=max(self.max_elements, len(self._id2label)),
             )
-            with open(self._metadata_file_name, "rb") as f:
-                self._metadata, self._current_elements = pickle.load(f)
+            self._index.set_ef(self.ef_search)
+            self._current_elements = len(self._id2label)
             logger.info(
                 f"Loaded existing index for {self.namespace} with {self._current_elements} elements"
             )
         else:
-            self._index.init_index(
-                max_elements=self.max_elements,
-                ef_construction=self.ef_construction,
-                M=self.M,
-            )
-            self._index.set_ef(self.ef_search)
-            self._metadata = {}
+            self._init_empty_index(self.max_elements)
             self._current_elements = 0
             logger.info(f"Created new index for {self.namespace}")
 
+    def _init_empty_index(self, max_elements: int):
+        self._index = hnswlib.Index(
+            space="cosine", dim=self.embedding_func.embedding_dim
+        )
+        self._index.init_index(
+            max_elements=max_elements,
+            ef_construction=self.ef_construction,
+            M=self.M,
+        )
+        self._index.set_ef(self.ef_search)
+
+    def _load_metadata(self):
+        stored = load_json(self._metadata_file_name)
+        if stored is not None:
+            return stored["labels"], stored["metadata"]
+        if not os.path.exists(self._legacy_metadata_file_name):
+            return None
+        # indexes written before the JSON format keyed metadata by xxh32 label
+        with open(self._legacy_metadata_file_name, "rb") as f:
+            legacy_metadata, _ = pickle.load(f)
+        logger.info(f"Migrating {self._legacy_metadata_file_name} to JSON metadata")
+        id2label, metadata = {}, {}
+        for label, meta in legacy_metadata.items():
+            id2label[meta["id"]] = int(label)
+            metadata[meta["id"]] = {k: v for k, v in meta.items() if k != "id"}
+        return id2label, metadata
+
+    def _label_for(self, id_: str) -> int:
+        if id_ in self._id2label:
+            return self._id2label[id_]
+        label = xxhash.xxh64_intdigest(id_.encode())
+        while label in self._label2id:
+            label = (label + 1) % (1 << 64)
+        self._id2label[id_] = label
+        self._label2id[label] = id_
+        return label
+
+    def _track_videos(self, label: int, metadata: dict):
+        videos = record_videos(metadata)
+        if videos is None:
+            self._unattributed_labels.add(label)
+        for video_name in videos or []:
+            self._video_labels.setdefault(video_name, set()).add(label)
+
+    def _untrack_videos(self, label: int, metadata: dict):
+        self._unattributed_labels.discard(label)
+        for video_name in record_videos(metadata) or []:
+            self._video_labels.get(video_name, set()).discard(label)
+
+    def _scope_labels(self, scope: VideoScope) -> set[int]:
+        if scope.video_names is None:
+            labels = set(self._label2id)
+        else:
+            labels = set(self._unattributed_labels)
+            for video_name in scope.video_names:
+                labels |= self._video_labels.get(video_name, set())
+        if scope.time_range is not None:
+            labels = {
+                label
+                for label in labels
+                if scope.allows_time(self._metadata[self._label2id[label]].get("__time__"))
+            }
+        return labels
+
+    def _ensure_capacity(self, new_labels: int):
+        # slots of deleted elements stay occupied until the next compaction
+        needed = self._index.get_current_count() + new_labels
+        capacity = self._index.get_max_elements()
+        if needed > capacity:
+            new_capacity = max(needed, 2 * capacity)
+            logger.info(
+                f"Growing {self.namespace} index from {capacity} to {new_capacity} elements"
+            )
+            self._index.resize_index(new_capacity)
+
     async def upsert(self, data: dict[str, dict]) -> np.ndarray:
         logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
         if not data:
             logger.warning("You insert an empty data to vector DB")
             return []
 
-        if self._current_elements + len(data) > self.max_elements:
-            raise ValueError(
-                f"Cannot insert {len(data)} elements. Current: {self._current_elements}, Max: {self.max_elements}"
-            )
-
-        list_data = [
-            {
-                "id": k,
-                **{k1: v1 for k1, v1 in v.items() if k1 in self.meta_fields},
-            }
-            for k, v in data.items()
-        ]
         contents = [v["content"] for v in data.values()]
-        batch_size = min(self._embedding_batch_num, len(contents))
-        embeddings = np.concatenate(
-            await asyncio.gather(
-                *[
-                    self.embedding_func(contents[i : i + batch_size])
-                    for i in range(0, len(contents), batch_size)
-                ]
-            )
-        )
+        embeddings = await self.embedding_func(contents)
 
+        self._ensure_capacity(sum(1 for k in data if k not in self._id2label))
         ids = np.fromiter(
-            (xxhash.xxh32_intdigest(d["id"].encode()) for d in list_data),
-            dtype=np.uint32,
-            count=len(list_data),
-        )
-        self._metadata.update(
-            {
-                id_int: {
-                    k: v for k, v in d.items() if k in self.meta_fields or k == "id"
-                }
-                for id_int, d in zip(ids, list_data)
-            }
+            (self._label_for(k) for k in data), dtype=np.uint64, count=len(data)
         )
+        for label, (k, v) in zip(ids, data.items()):
+            self._untrack_videos(int(label), self._metadata.get(k, {}))
+            metadata = {k1: v1 for k1, v1 in v.items() if k1 in self.meta_fields}
+            videos = value_videos(v)
+            if videos is not None:
+                metadata["__videos__"] = videos
+            self._metadata[k] = metadata
+            self._track_videos(int(label), metadata)
+        # re-adding a label that was marked deleted revives it in place
         self._index.add_items(data=embeddings, ids=ids, num_threads=self.num_threads)
-        self._current_elements = self._index.get_current_count()
+        self._current_elements = len(self._id2label)
         return ids
 
-    async def query(self, query: str, top_k: int = 5) -> list[dict]:
+    async def delete(self, ids: list[str]):
+        for id_ in ids:
+            label = self._id2label.pop(id_, None)
+            if label is None:
+                continue
+            del self._label2id[label]
+            self._untrack_videos(label, self._metadata.pop(id_, {}))
+            self._index.mark_deleted(label)
+        self._current_elements = len(self._id2label)
+
+    async def query(
+        self, query: str, top_k: int = 5, scope: VideoScope = None
+    ) -> list[dict]:
+        return (await self.query_batch([query], top_k, scope=scope))[0]
+
+    async def query_batch(
+        self, queries: list[str], top_k: int = 5, scope: VideoScope = None
+    ) -> list[list[dict]]:
         if self._current_elements == 0:
-            return []
+            return [[] for _ in queries]
 
+        search_filter = None
         top_k = min(top_k, self._current_elements)
+        if scope is not None:
+            allowed = self._scope_labels(scope)
+            if not allowed:
+                return [[] for _ in queries]
+            search_filter = allowed.__contains__
+            top_k = min(top_k, len(allowed))
 
         if top_k > self.ef_search:
             logger.warning(
@@ -121,21 +214,272 @@ class HNSWVectorStorage(BaseVectorStorage):
             )
             self._index.set_ef(top_k)
 
-        embedding = await self.embedding_func([query])
+        embeddings = await self.embedding_func(queries)
         labels, distances = self._index.knn_query(
-            data=embedding[0], k=top_k, num_threads=self.num_threads
+            data=embeddings,
+            k=top_k,
+            num_threads=self.num_threads,
+            filter=search_filter,
         )
+        batch_results = []
+        for query_labels, query_distances in zip(labels, distances):
+            results = []
+            for label, distance in zip(query_labels, query_distances):
+                id_ = self._label2id[int(label)]
+                results.append(
+                    {
+                        "id": id_,
+                        **self._metadata.get(id_, {}),
+                        "distance": distance,
+                        "similarity": 1 - distance,
+                    }
+                )
+            batch_results.append(results)
+        return batch_results
 
-        return [
-            {
-                **self._metadata.get(label, {}),
-                "distance": distance,
-                "similarity": 1 - distance,
-            }
-            for label, distance in zip(labels[0], distances[0])
-        ]
+    def _compact(self):
+        """Rebuild the index without the elements marked deleted, keeping labels"""
+        labels = list(self._label2id)
+        deleted = self._index.get_current_count() - len(labels)
+        logger.info(
+            f"Compacting {self.namespace} index: dropping {deleted} deleted elements"
+        )
+        vectors = self._index.get_items(labels) if labels else None
+        self._init_empty_index(max(self.max_elements, 2 * len(labels)))
+        if labels:
+            self._index.add_items(
+                data=np.asarray(vectors, dtype=np.float32),
+                ids=np.asarray(labels, dtype=np.uint64),
+                num_threads=self.num_threads,
+            )
 
     async def index_done_callback(self):
+        deleted = self._index.get_current_count() - len(self._id2label)
+        if deleted and deleted >= self.compact_deleted_ratio * self._index.get_current_count():
+            self._compact()
         self._index.save_index(self._index_file_name)
-        with open(self._metadata_file_name, "wb") as f:
-            pickle.dump((self._metadata, self._current_elements), f)
+        write_json(
+            {"labels": self._id2label, "metadata": self._metadata},
+            self._metadata_file_name,
+        )
+
+
+class HNSWLabelIndex:
+    """hnswlib index over string ids; labels are handed out sequentially and
+    the capacity doubles whenever it runs out."""
+
+    def __init__(
+        self,
+        embedding_dim: int,
+        storage_prefix: str,
+        M: int = 16,
+        ef_construction: int = 100,
+        ef_search: int = 50,
+        num_threads: int = -1,
+        initial_capacity: int = 1024,
+        load: bool = True,
+    ):
+        self._index_file = f"{storage_prefix}.hnsw.index"
+        self._labels_file = f"{storage_prefix}.hnsw.labels.json"
+        self.ef_search = ef_search
+        self.num_threads = num_threads
+        self._index = hnswlib.Index(space="cosine", dim=embedding_dim)
+        labels = load_json(self._labels_file) if load else None
+        if labels is not None and os.path.exists(self._index_file):
+            self._index.load_index(
+                self._index_file, max_elements=max(len(labels), initial_capacity)
+            )
+            self._labels: list[str] = labels
+        else:
+            self._index.init_index(
+                max_elements=initial_capacity, ef_construction=ef_construction, M=M
+            )
+            self._labels = []
+        self._index.set_ef(ef_search)
+        self._id2label = {id_: label for label, id_ in enumerate(self._labels)}
+
+    def __len__(self):
+        return len(self._labels)
+
+    def add(self, ids: list[str], vectors: np.ndarray):
+        labels = []
+        for id_ in ids:
+            if id_ not in self._id2label:
+                self._id2label[id_] = len(self._labels)
+                self._labels.append(id_)
+            labels.append(self._id2label[id_])
+        capacity = self._index.get_max_elements()
+        if len(self._labels) > capacity:
+            self._index.resize_index(max(len(self._labels), 2 * capacity))
+        self._index.add_items(
+            vectors, np.asarray(labels, dtype=np.int64), num_threads=self.num_threads
+        )
+
+    def search(
+        self, query: np.ndarray, top_k: int, allowed_ids: list[str] = None
+    ) -> list[tuple[str, float]]:
+        return self.search_batch(query[None, :], top_k, allowed_ids)[0]
+
+    def search_batch(
+        self, queries: np.ndarray, top_k: int, allowed_ids: list[str] = None
+    ) -> list[list[tuple[str, float]]]:
+        search_filter = None
+        top_k = min(top_k, len(self))
+        if allowed_ids is not None:
+            allowed = {self._id2label[i] for i in allowed_ids if i in self._id2label}
+            search_filter = allowed.__contains__
+            top_k = min(top_k, len(allowed))
+        if top_k <= 0:
+            return [[] for _ in queries]
+        self._index.set_ef(max(self.ef_search, top_k))
+        labels, distances = self._index.knn_query(
+            queries, k=top_k, num_threads=self.num_threads, filter=search_filter
+        )
+        return [
+            [
+                (self._labels[label], 1 - float(distance))
+                for label, distance in zip(query_labels, query_distances)
+            ]
+            for query_labels, query_distances in zip(labels, distances)
+        ]
+
+    def save(self):
+        self._index.save_index(self._index_file)
+        write_json(self._labels, self._labels_file)
+
+
+class AdaptiveVectorDB:
+    """NanoVectorDB-compatible client that answers with exact search while the
+    collection is small and switches to HNSW once it reaches `min_vectors`.
+
+    The memory-mapped exact store stays the source of truth for vectors and
+    metadata, so the HNSW index can always be rebuilt from it.
+    """
+
+    def __init__(self, exact: MmapVectorDB, make_hnsw: callable, min_vectors: int):
+        self._exact = exact
+        self._make_hnsw = make_hnsw
+        self.min_vectors = min_vectors
+        self._hnsw = None
+        self._hnsw_dirty = False
+        if len(exact) and len(exact) >= min_vectors:
+            self._hnsw = self._open_hnsw()
+
+    def _open_hnsw(self) -> HNSWLabelIndex:
+        hnsw = self._make_hnsw(load=True)
+        if len(hnsw) != len(self._exact):
+            logger.info(f"Building HNSW index over {len(self._exact)} vectors")
+            hnsw = self._make_hnsw(load=False)
+            for ids, vectors in self._exact.iter_live():
+                hnsw.add(ids, vectors)
+            self._hnsw_dirty = True
+        return hnsw
+
+    def __len__(self):
+        return len(self._exact)
+
+    def get(self, ids: list[str]) -> list[dict]:
+        return self._exact.get(ids)
+
+    def upsert(self, datas: list[dict]):
+        report = self._exact.upsert(datas)
+        if self._hnsw is not None:
+            self._hnsw.add(
+                [d["__id__"] for d in datas],
+                _normalize(np.array([d["__vector__"] for d in datas], dtype=np.float32)),
+            )
+            self._hnsw_dirty = True
+        elif len(self._exact) >= self.min_vectors:
+            self._hnsw = self._open_hnsw()
+        return report
+
+    def query(
+        self,
+        query: np.ndarray,
+        top_k: int = 10,
+        better_than_threshold: float = None,
+        scope: VideoScope = None,
+    ):
+        return self.query_batch(
+            np.asarray(query)[None, :], top_k, better_than_threshold, scope
+        )[0]
+
+    def query_batch(
+        self,
+        queries: np.ndarray,
+        top_k: int = 10,
+        better_than_threshold: float = None,
+        scope: VideoScope = None,
+    ) -> list[list[dict]]:
+        allowed_ids = None
+        if scope is not None and self._hnsw is not None:
+            rows = self._exact.scope_rows(scope)
+            # a narrow scope is cheaper to scan exactly than to filter in the graph
+            if len(rows) >= self.min_vectors:
+                allowed_ids = self._exact.row_ids(rows)
+        if self._hnsw is None or (scope is not None and allowed_ids is None):
+            return self._exact.query_batch(
+                queries, top_k, better_than_threshold, scope=scope
+            )
+        queries = _normalize(np.asarray(queries, dtype=np.float32))
+        batch_results = []
+        for hits in self._hnsw.search_batch(queries, top_k, allowed_ids=allowed_ids):
+            # get() skips unknown ids, so a stale graph label (e.g. after a
+            # crash between the two saves) must not shift the other records
+            records = {r["__id__"]: r for r in self._exact.get([id_ for id_, _ in hits])}
+            batch_results.append(
+                [
+                    {**records[id_], "__metrics__": similarity}
+                    for id_, similarity in hits
+                    if id_ in records
+                    and (better_than_threshold is None or similarity >= better_than_threshold)
+                ]
+            )
+        return batch_results
+
+    def save(self):
+        self._exact.save()
+        if self._hnsw is not None and self._hnsw_dirty:
+            self._hnsw.save()
+            self._hnsw_dirty = False
+
+
+@dataclass
+class HNSWVideoSegmentStorage(NanoVectorDBVideoSegmentStorage):
+    ef_construction: int = 100
+    M: int = 16
+    ef_search: int = 50
+    num_threads: int = -1
+    # below this many segments queries are answered by exact search
+    hnsw_min_vectors: int = 20000
+
+    def _init_client(self, embedding_dim: int):
+        params = self.global_config.get("vs_vector_db_storage_cls_kwargs", {})
+        self.ef_construction = params.get("ef_construction", self.ef_construction)
+        self.M = params.get("M", self.M)
+        self.ef_search = params.get("ef_search", self.ef_search)
+        self.num_threads = params.get("num_threads", self.num_threads)
+        self.hnsw_min_vectors = params.get("hnsw_min_vectors", self.hnsw_min_vectors)
+
+        storage_prefix = os.path.join(
+            self.global_config["working_dir"], f"vdb_{self.namespace}"
+        )
+        exact = MmapVectorDB(
+            embedding_dim,
+            storage_prefix,
+            dtype=params.get("storage_dtype", "float32"),
+            rescore_factor=params.get("rescore_factor", 0),
+        )
+        return AdaptiveVectorDB(
+            exact,
+            lambda load: HNSWLabelIndex(
+                embedding_dim,
+                storage_prefix,
+                M=self.M,
+                ef_construction=self.ef_construction,
+                ef_search=self.ef_search,
+                num_threads=self.num_threads,
+                load=load,
+            ),
+            self.hnsw_min_vectors,
+        )
@@ -0,0 +1,508 @@
+import json
+import os
+import re
+from dataclasses import dataclass
+
+import numpy as np
+from nano_vectordb.dbs import load_storage
+
+from .._utils import load_json, logger, write_json
+from ..base import VideoScope, record_videos
+from .vdb_nanovectordb import NanoVectorDBStorage, NanoVectorDBVideoSegmentStorage
+
+# rows scored per block, so float16 matrices are upcast a block at a time
+SCAN_BLOCK_ROWS = 65536
+# rewrite the files once superseded rows outnumber live ones
+COMPACT_DEAD_RATIO = 0.5
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize_int8(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Per-vector symmetric int8: returns the codes and a [rows, 1] float32 scale"""
+    scales = np.maximum(np.abs(vectors).max(axis=1, keepdims=True), 1e-12) / 127
+    codes = np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class _RowFile:
+    """Append-only [rows, width] matrix file, memory-mapped up to the committed
+    rows; rows added since the last save are held in memory."""
+
+    def __init__(self, file_name: str, dtype, width: int):
+        self.file_name = file_name
+        self.dtype = np.dtype(dtype)
+        self.width = width
+        self.committed_rows = 0
+        self.matrix = None
+        self.pending: list[np.ndarray] = []
+
+    def open(self, committed_rows: int):
+        self.committed_rows = committed_rows
+        self.matrix = (
+            np.memmap(self.file_name, dtype=self.dtype, mode="r", shape=(committed_rows, self.width))
+            if committed_rows
+            else None
+        )
+
+    def blocks(self):
+        if self.matrix is not None:
+            for start in range(0, self.committed_rows, SCAN_BLOCK_ROWS):
+                yield self.matrix[start : start + SCAN_BLOCK_ROWS]
+        yield from self.pending
+
+    def take(self, rows: np.ndarray) -> np.ndarray:
+        """Rows by (sorted) index across the file and the pending blocks"""
+        parts = []
+        committed = rows[rows < self.committed_rows]
+        if len(committed):
+            parts.append(np.asarray(self.matrix[committed]))
+        if len(committed) < len(rows):
+            pending = np.concatenate(self.pending)
+            parts.append(pending[rows[len(committed) :] - self.committed_rows])
+        return np.concatenate(parts) if parts else np.zeros((0, self.width), self.dtype)
+
+    def append_pending(self):
+        rows = self.committed_rows + sum(len(p) for p in self.pending)
+        with open(self.file_name, "ab") as f:
+            # drop leftovers of an interrupted save before appending
+            f.truncate(self.committed_rows * self.width * self.dtype.itemsize)
+            for block in self.pending:
+                f.write(np.ascontiguousarray(block).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+        self.open(rows)
+
+    def write_rows(self, keep_rows: np.ndarray, file_name: str):
+        """Write the kept rows to a new file, leaving this one untouched"""
+        with open(file_name, "wb") as f:
+            start = 0
+            for block in self.blocks():
+                keep = keep_rows[(keep_rows >= start) & (keep_rows < start + len(block))]
+                f.write(np.ascontiguousarray(block[keep - start]).tobytes())
+                start += len(block)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class MmapVectorDB:
+    """Drop-in for the NanoVectorDB client backed by an append-only matrix file.
+
+    For a storage prefix `vdb_<namespace>` these files are kept:
+      - `.mmap.vec`: row-major matrix of normalized vectors, memory-mapped for
+        queries; float32, float16 or int8
+      - `.mmap.scale`: per-row float32 scale of the int8 matrix
+      - `.mmap.f32`: float32 copy used to rescore the top candidates of a
+        compressed matrix (only with `rescore_factor`); it is memory-mapped
+        too, so only candidate rows are read, but it costs the disk saving
+      - `.mmap.jsonl`: one metadata record per row; a later row with the same
+        `__id__` supersedes the earlier one
+      - `.mmap.json`: header with dim, dtype, the committed row/byte counts
+        and the file generation; anything past these counts is an interrupted
+        write and is discarded
+
+    Compaction writes the live rows to the next generation of files
+    (`.mmap.<generation>.vec`, ...) and switches to them by replacing the
+    header, so a crash leaves either the old or the new generation complete.
+    Older generations are removed once a compaction has switched away from
+    them. A store opened without a header imports `vdb_<namespace>.json`
+    written by NanoVectorDB, if there is one; the JSON file is left in place.
+    """
+
+    def __init__(
+        self,
+        embedding_dim: int,
+        storage_prefix: str,
+        dtype: str = "float32",
+        rescore_factor: int = 0,
+    ):
+        self.embedding_dim = embedding_dim
+        self.dtype = np.dtype(dtype)
+        # score top_k * rescore_factor candidates again in float32
+        self.rescore_factor = rescore_factor
+        self._storage_prefix = storage_prefix
+        self._header_file = f"{storage_prefix}.mmap.json"
+        self._generation = 0
+        self._reset()
+        self._load()
+
+    def _reset(self):
+        self._records: list[dict] = []
+        self._id2row: dict[str, int] = {}
+        self._alive = np.zeros(0, dtype=bool)
+        # rows per video, plus rows written without video names
+        self._video_rows: dict[str, list[int]] = {}
+        self._unattributed_rows: list[int] = []
+        self._committed_rows = 0
+        self._committed_meta_bytes = 0
+        self._init_row_files()
+
+    def _file_name(self, suffix: str, generation: int) -> str:
+        # generation 0 keeps the names written before compaction was versioned
+        if generation == 0:
+            return f"{self._storage_prefix}.mmap.{suffix}"
+        return f"{self._storage_prefix}.mmap.{generation}.{suffix}"
+
+    def _make_row_files(self, generation: int) -> tuple:
+        vectors = _RowFile(self._file_name("vec", generation), self.dtype, self.embedding_dim)
+        scales = (
+            _RowFile(self._file_name("scale", generation), np.float32, 1)
+            if self.dtype == np.int8
+            else None
+        )
+        full = (
+            _RowFile(self._file_name("f32", generation), np.float32, self.embedding_dim)
+            if self.rescore_factor and self.dtype != np.float32
+            else None
+        )
+        return vectors, scales, full
+
+    def _init_row_files(self):
+        self._vector_file = self._file_name("vec", self._generation)
+        self._meta_file = self._file_name("jsonl", self._generation)
+        self._vectors, self._scales, self._full = self._make_row_files(self._generation)
+
+    def _remove_stale_generations(self):
+        directory, prefix = os.path.split(self._storage_prefix)
+        pattern = re.compile(rf"{re.escape(prefix)}\.mmap\.(?:(\d+)\.)?(?:vec|scale|f32|jsonl)$")
+        for name in os.listdir(directory or "."):
+            match = pattern.match(name)
+            # a newer generation may be one a compaction is still writing
+            if match is not None and int(match.group(1) or 0) < self._generation:
+                os.remove(os.path.join(directory, name))
+
+    @property
+    def _row_files(self) -> list[_RowFile]:
+        return [f for f in (self._vectors, self._scales, self._full) if f is not None]
+
+    def _import_nano_vectordb(self):
+        legacy_file = f"{self._storage_prefix}.json"
+        legacy = load_storage(legacy_file)
+        if legacy is None or not legacy["data"]:
+            return
+        if legacy["embedding_dim"] != self.embedding_dim:
+            raise ValueError(
+                f"{legacy_file} holds {legacy['embedding_dim']}-d vectors, expected {self.embedding_dim}"
+            )
+        self.upsert(
+            [
+                {**record, "__vector__": vector}
+                for record, vector in zip(legacy["data"], legacy["matrix"])
+            ]
+        )
+        self._append_pending()
+        logger.info(f"Imported {len(legacy['data'])} vectors of {legacy_file}")
+
+    def _load(self):
+        header = load_json(self._header_file)
+        if header is None:
+            self._import_nano_vectordb()
+            return
+        if header["dim"] != self.embedding_dim:
+            raise ValueError(
+                f"{self._vector_file} holds {header['dim']}-d vectors, expected {self.embedding_dim}"
+            )
+        # the file's own layout wins over the configured one
+        self.dtype = np.dtype(header["dtype"])
+        self._generation = header.get("generation", 0)
+        if not header.get("full_precision", False) and header["rows"]:
+            if self.rescore_factor and self.dtype != np.float32:
+                logger.warning(
+                    f"{self._vector_file} was written without float32 copies, rescoring disabled"
+                )
+            self.rescore_factor = 0
+        elif header.get("full_precision", False) and not self.rescore_factor:
+            self.rescore_factor = header.get("rescore_factor", 4)
+        self._init_row_files()
+        with open(self._meta_file, "rb") as f:
+            raw = f.read(header["meta_bytes"])
+        for line in raw.splitlines()[: header["rows"]]:
+            self._append_record(json.loads(line))
+        self._alive = np.zeros(len(self._records), dtype=bool)
+        self._alive[list(self._id2row.values())] = True
+        self._committed_rows = header["rows"]
+        self._committed_meta_bytes = header["meta_bytes"]
+        for row_file in self._row_files:
+            row_file.open(self._committed_rows)
+
+    def _append_record(self, record: dict):
+        """Register a row and return the row it supersedes, if any"""
+        superseded = self._id2row.get(record["__id__"])
+        row = len(self._records)
+        self._id2row[record["__id__"]] = row
+        self._records.append(record)
+        videos = record_videos(record)
+        if videos is None:
+            self._unattributed_rows.append(row)
+        for video_name in videos or []:
+            self._video_rows.setdefault(video_name, []).append(row)
+        return superseded
+
+    def __len__(self):
+        return len(self._id2row)
+
+    def get(self, ids: list[str]) -> list[dict]:
+        return [self._records[self._id2row[i]] for i in ids if i in self._id2row]
+
+    def row_ids(self, rows) -> list[str]:
+        return [self._records[r]["__id__"] for r in rows]
+
+    def iter_live(self):
+        """Yield (ids, float32 vectors) of the live rows, block by block"""
+        for start, block, scales in self._iter_blocks():
+            rows = np.flatnonzero(self._alive[start : start + len(block)])
+            if len(rows):
+                yield (
+                    [self._records[start + r]["__id__"] for r in rows],
+                    self._decode(block[rows], None if scales is None else scales[rows]),
+                )
+
+    def upsert(self, datas: list[dict]):
+        report = dict(update=[], insert=[])
+        if not datas:
+            return report
+        vectors = _normalize(
+            np.array([d["__vector__"] for d in datas], dtype=np.float32)
+        )
+        superseded = []
+        for d in datas:
+            record = {k: v for k, v in d.items() if k != "__vector__"}
+            previous = self._append_record(record)
+            if previous is None:
+                report["insert"].append(record["__id__"])
+            else:
+                report["update"].append(record["__id__"])
+                superseded.append(previous)
+        if self._scales is not None:
+            codes, scales = quantize_int8(vectors)
+            self._vectors.pending.append(codes)
+            self._scales.pending.append(scales)
+        else:
+            self._vectors.pending.append(vectors.astype(self.dtype))
+        if self._full is not None:
+            self._full.pending.append(vectors)
+        self._alive = np.concatenate([self._alive, np.ones(len(datas), dtype=bool)])
+        self._alive[superseded] = False
+        return report
+
+    def _iter_blocks(self):
+        """Yield (first row, stored block, int8 scales or None)"""
+        scale_blocks = self._scales.blocks() if self._scales is not None else None
+        start = 0
+        for block in self._vectors.blocks():
+            yield start, block, next(scale_blocks) if scale_blocks is not None else None
+            start += len(block)
+
+    @staticmethod
+    def _decode(block: np.ndarray, scales: np.ndarray = None) -> np.ndarray:
+        vectors = np.asarray(block, dtype=np.float32)
+        if scales is not None:
+            vectors *= scales
+        return vectors
+
+    def _scores(self, query: np.ndarray) -> np.ndarray:
+        """`query` is a [dim, n_queries] matrix"""
+        parts = []
+        for _, block, scales in self._iter_blocks():
+            scores = np.asarray(block, dtype=np.float32) @ query
+            # scaling the scores is cheaper than decoding the block
+            parts.append(scores * scales if scales is not None else scores)
+        if not parts:
+            return np.zeros((0, *query.shape[1:]), dtype=np.float32)
+        return np.concatenate(parts)
+
+    def _scores_of_rows(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Scores of the given (sorted) rows only, -inf everywhere else"""
+        scores = np.full((len(self._records), *query.shape[1:]), -np.inf, dtype=np.float32)
+        for start, block, scales in self._iter_blocks():
+            in_block = rows[(rows >= start) & (rows < start + len(block))]
+            if len(in_block):
+                local = in_block - start
+                scores[in_block] = self._decode(
+                    block[local], None if scales is None else scales[local]
+                ) @ query
+        return scores
+
+    def scope_rows(self, scope: VideoScope) -> np.ndarray:
+        """Live rows inside `scope`, resolved through the per-video row lists"""
+        if scope.video_names is None:
+            mask = self._alive.copy()
+        else:
+            mask = np.zeros(len(self._records), dtype=bool)
+            for video_name in scope.video_names:
+                mask[self._video_rows.get(video_name, [])] = True
+            mask[self._unattributed_rows] = True
+            mask &= self._alive
+        rows = np.flatnonzero(mask)
+        if scope.time_range is not None and len(rows):
+            keep = [scope.allows_time(self._records[r].get("__time__")) for r in rows]
+            rows = rows[np.asarray(keep, dtype=bool)]
+        return rows
+
+    def query(
+        self,
+        query: np.ndarray,
+        top_k: int = 10,
+        better_than_threshold: float = None,
+        scope: VideoScope = None,
+    ):
+        return self.query_batch(
+            np.asarray(query)[None, :], top_k, better_than_threshold, scope
+        )[0]
+
+    def query_batch(
+        self,
+        queries: np.ndarray,
+        top_k: int = 10,
+        better_than_threshold: float = None,
+        scope: VideoScope = None,
+    ) -> list[list[dict]]:
+        """One result list per row of `queries`, scored with a single matrix
+        product per block"""
+        queries = _normalize(np.asarray(queries, dtype=np.float32)).T
+        if scope is None:
+            scores = self._scores(queries)
+            scores[~self._alive] = -np.inf
+            n_rows = len(self)
+        else:
+            rows = self.scope_rows(scope)
+            scores = self._scores_of_rows(queries, rows)
+            n_rows = len(rows)
+        top_k = min(top_k, n_rows)
+        if top_k <= 0:
+            return [[] for _ in range(queries.shape[1])]
+        n_candidates = (
+            min(top_k * self.rescore_factor, n_rows) if self._full is not None else top_k
+        )
+        candidates = np.argpartition(-scores, n_candidates - 1, axis=0)[:n_candidates]
+        rescored = None
+        if self._full is not None:
+            candidate_rows = np.unique(candidates)
+            rescored = (self._full.take(candidate_rows) @ queries, candidate_rows)
+        results = []
+        for column in range(queries.shape[1]):
+            rows = candidates[:, column]
+            column_scores = scores[rows, column]
+            if rescored is not None:
+                exact, candidate_rows = rescored
+                column_scores = np.where(
+                    np.isfinite(column_scores),
+                    exact[np.searchsorted(candidate_rows, rows), column],
+                    -np.inf,
+                )
+            if better_than_threshold is not None:
+                column_scores[column_scores < better_than_threshold] = -np.inf
+            order = np.argsort(-column_scores)[:top_k]
+            results.append(
+                [
+                    {**self._records[rows[i]], "__metrics__": float(column_scores[i])}
+                    for i in order
+                    if np.isfinite(column_scores[i])
+                ]
+            )
+        return results
+
+    def _write_header(self):
+        write_json(
+            {
+                "dim": self.embedding_dim,
+                "dtype": self.dtype.str,
+                "full_precision": self._full is not None,
+                "rescore_factor": self.rescore_factor,
+                "rows": self._committed_rows,
+                "meta_bytes": self._committed_meta_bytes,
+                "generation": self._generation,
+            },
+            f"{self._header_file}.tmp",
+        )
+        os.replace(f"{self._header_file}.tmp", self._header_file)
+
+    def _append_pending(self):
+        new_records = self._records[self._committed_rows :]
+        meta_blob = b"".join(
+            json.dumps(r, ensure_ascii=False).encode("utf-8") + b"\n" for r in new_records
+        )
+        for row_file in self._row_files:
+            row_file.append_pending()
+        with open(self._meta_file, "ab") as f:
+            f.truncate(self._committed_meta_bytes)
+            f.write(meta_blob)
+            f.flush()
+            os.fsync(f.fileno())
+        self._committed_rows = len(self._records)
+        self._committed_meta_bytes += len(meta_blob)
+        self._write_header()
+
+    def _compact(self):
+        live_rows = np.flatnonzero(self._alive)
+        logger.info(
+            f"Compacting {self._vector_file}: keeping {len(live_rows)} of {len(self._records)} rows"
+        )
+        generation = self._generation + 1
+        new_row_files = [f for f in self._make_row_files(generation) if f is not None]
+        for row_file, new_row_file in zip(self._row_files, new_row_files):
+            row_file.write_rows(live_rows, new_row_file.file_name)
+        meta_blob = b"".join(
+            json.dumps(self._records[row], ensure_ascii=False).encode("utf-8") + b"\n"
+            for row in live_rows
+        )
+        with open(self._file_name("jsonl", generation), "wb") as mf:
+            mf.write(meta_blob)
+            mf.flush()
+            os.fsync(mf.fileno())
+        # the header switches to the new generation in a single replace
+        self._generation = generation
+        self._committed_rows = len(live_rows)
+        self._committed_meta_bytes = len(meta_blob)
+        self._write_header()
+        # readers that already mapped the old files keep them until they close
+        self._remove_stale_generations()
+        self._reset()
+        self._load()
+
+    def save(self):
+        dead_rows = len(self._records) - len(self)
+        if dead_rows and dead_rows >= COMPACT_DEAD_RATIO * len(self._records):
+            self._compact()
+        elif self._vectors.pending:
+            self._append_pending()
+
+
+@dataclass
+class MmapVectorStorage(NanoVectorDBStorage):
+    # "float32", "float16" or "int8"
+    storage_dtype: str = "float32"
+    rescore_factor: int = 0
+
+    def _init_client(self, embedding_dim: int):
+        params = self.global_config.get("vector_db_storage_cls_kwargs", {})
+        self.storage_dtype = params.get("storage_dtype", self.storage_dtype)
+        self.rescore_factor = params.get("rescore_factor", self.rescore_factor)
+        return MmapVectorDB(
+            embedding_dim,
+            os.path.join(self.global_config["working_dir"], f"vdb_{self.namespace}"),
+            dtype=self.storage_dtype,
+            rescore_factor=self.rescore_factor,
+        )
+
+
+@dataclass
+class MmapVideoSegmentStorage(NanoVectorDBVideoSegmentStorage):
+    # "float32", "float16" or "int8"
+    storage_dtype: str = "float32"
+    rescore_factor: int = 0
+
+    def _init_client(self, embedding_dim: int):
+        params = self.global_config.get("vs_vector_db_storage_cls_kwargs", {})
+        self.storage_dtype = params.get("storage_dtype", self.storage_dtype)
+        self.rescore_factor = params.get("rescore_factor", self.rescore_factor)
+        return MmapVectorDB(
+            embedding_dim,
+            os.path.join(self.global_config["working_dir"], f"vdb_{self.namespace}"),
+            dtype=self.storage_dtype,
+            rescore_factor=self.rescore_factor,
+        )
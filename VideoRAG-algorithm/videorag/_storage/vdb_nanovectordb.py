@@ -1,4 +1,3 @@
-import asyncio
 import os
 import torch
 from dataclasses import dataclass
@@ -9,7 +8,13 @@ from imagebind.models import imagebind_model
 from imagebind.models.imagebind_model import ImageBindModel
 
 from .._utils import logger
-from ..base import BaseVectorStorage
+from ..base import BaseVectorStorage, VideoScope, value_videos
+
+
+def get_imagebind_model_file() -> str:
+    """本地ImageBind权重文件路径（由IMAGEBIND_MODEL_PATH配置）"""
+    model_path = os.getenv('IMAGEBIND_MODEL_PATH', '/app/models')
+    return os.path.join(model_path, 'imagebind.pth')
 
 
 def get_imagebind_model() -> ImageBindModel:
@@ -17,26 +22,15 @@ def get_imagebind_model() -> ImageBindModel:
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     # 1. 首先尝试从环境变量配置的路径加载
-    model_path = os.getenv('IMAGEBIND_MODEL_PATH', '/app/models')
-    local_model_file = os.path.join(model_path, 'imagebind.pth')
+    local_model_file = get_imagebind_model_file()
 
     if os.path.exists(local_model_file):
         try:
             logger.info(f"🔄 从本地加载ImageBind模型: {local_model_file}")
-            embedder = ImageBindModel(
-                vision_embed_dim=1280,
-                vision_num_blocks=32,
-                vision_num_heads=16,
-                text_embed_dim=1024,
-                text_num_blocks=24,
-                text_num_heads=16,
-                out_embed_dim=1024,
-                audio_drop_path=0.1,
-                imu_drop_path=0.7,
-            )
-            embedder.load_state_dict(torch.load(local_model_file, map_location=device))
-            embedder = embedder.to(device)
-            embedder.eval()
+            # 延迟导入以避免循环依赖
+            from .._videoutil import load_imagebind_huge
+
+            embedder = load_imagebind_huge(local_model_file, device)
             logger.info(f"✅ 本地ImageBind模型加载成功，设备: {device}")
             return embedder
         except Exception as e:
@@ -55,6 +49,23 @@ def get_imagebind_model() -> ImageBindModel:
         raise
 
 
+def scope_query_kwargs(client, scope: VideoScope) -> dict:
+    """Extra client.query() arguments that restrict the search to `scope`"""
+    if scope is None:
+        return {}
+    if isinstance(client, NanoVectorDB):
+        # nano-vectordb drops rows failing the predicate before scoring
+        return {"filter_lambda": scope.allows}
+    return {"scope": scope}
+
+
+def client_query_batch(client, embeddings: np.ndarray, **kwargs) -> list[list[dict]]:
+    """Score all query embeddings at once when the client supports it"""
+    if hasattr(client, "query_batch"):
+        return client.query_batch(embeddings, **kwargs)
+    return [client.query(query=embedding, **kwargs) for embedding in embeddings]
+
+
 @dataclass
 class NanoVectorDBStorage(BaseVectorStorage):
     cosine_better_than_threshold: float = 0.2
@@ -64,14 +75,14 @@ class NanoVectorDBStorage(BaseVectorStorage):
         self._client_file_name = os.path.join(
             self.global_config["working_dir"], f"vdb_{self.namespace}.json"
         )
-        self._max_batch_size = self.global_config["llm"]["embedding_batch_num"]
-        self._client = NanoVectorDB(
-            self.embedding_func.embedding_dim, storage_file=self._client_file_name
-        )
+        self._client = self._init_client(self.embedding_func.embedding_dim)
         self.cosine_better_than_threshold = self.global_config.get(
             "query_better_than_threshold", self.cosine_better_than_threshold
         )
 
+    def _init_client(self, embedding_dim: int):
+        return NanoVectorDB(embedding_dim, storage_file=self._client_file_name)
+
     async def upsert(self, data: dict[str, dict]):
         logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
         if not len(data):
@@ -85,31 +96,34 @@ class NanoVectorDBStorage(BaseVectorStorage):
             for k, v in data.items()
         ]
         contents = [v["content"] for v in data.values()]
-        batches = [
-            contents[i : i + self._max_batch_size]
-            for i in range(0, len(contents), self._max_batch_size)
-        ]
-        embeddings_list = await asyncio.gather(
-            *[self.embedding_func(batch) for batch in batches]
-        )
-        embeddings = np.concatenate(embeddings_list)
-        for i, d in enumerate(list_data):
+        # the embedding func splits this into provider-sized requests itself
+        embeddings = await self.embedding_func(contents)
+        for i, (d, v) in enumerate(zip(list_data, data.values())):
             d["__vector__"] = embeddings[i]
+            videos = value_videos(v)
+            if videos is not None:
+                d["__videos__"] = videos
         results = self._client.upsert(datas=list_data)
         return results
 
-    async def query(self, query: str, top_k=5):
-        embedding = await self.embedding_func([query])
-        embedding = embedding[0]
-        results = self._client.query(
-            query=embedding,
+    async def query(self, query: str, top_k=5, scope: VideoScope = None):
+        return (await self.query_batch([query], top_k, scope=scope))[0]
+
+    async def query_batch(
+        self, queries: list[str], top_k=5, scope: VideoScope = None
+    ) -> list[list[dict]]:
+        embeddings = await self.embedding_func(queries)
+        batch_results = client_query_batch(
+            self._client,
+            embeddings,
             top_k=top_k,
             better_than_threshold=self.cosine_better_than_threshold,
+            **scope_query_kwargs(self._client, scope),
         )
-        results = [
-            {**dp, "id": dp["__id__"], "distance": dp["__metrics__"]} for dp in results
+        return [
+            [{**dp, "id": dp["__id__"], "distance": dp["__metrics__"]} for dp in results]
+            for results in batch_results
         ]
-        return results
 
     async def index_done_callback(self):
         self._client.save()
@@ -119,6 +133,11 @@ class NanoVectorDBStorage(BaseVectorStorage):
 class NanoVectorDBVideoSegmentStorage(BaseVectorStorage):
     embedding_func = None
     segment_retrieval_top_k: float = 2
+    # "eager" (fp32 PyTorch) or "quantized" (int8 TorchScript, CPU only)
+    imagebind_backend: str = "eager"
+    # real video clips the int8 encoders are validated on, required for "quantized"
+    quantized_validation_clips: list = None
+    quantized_min_cosine: float = 0.98
     
     def __post_init__(self):
         
@@ -126,15 +145,55 @@ class NanoVectorDBVideoSegmentStorage(BaseVectorStorage):
             self.global_config["working_dir"], f"vdb_{self.namespace}.json"
         )
         self._max_batch_size = self.global_config["video_embedding_batch_num"]
-        self._client = NanoVectorDB(
-            self.global_config["video_embedding_dim"], storage_file=self._client_file_name
-        )
+        self._client = self._init_client(self.global_config["video_embedding_dim"])
         self.top_k = self.global_config.get(
             "segment_retrieval_top_k", self.segment_retrieval_top_k
         )
+
+        vs_params = self.global_config.get("vs_vector_db_storage_cls_kwargs", {})
+        self.imagebind_backend = vs_params.get("imagebind_backend", self.imagebind_backend)
+        self.quantized_validation_clips = vs_params.get(
+            "quantized_validation_clips", self.quantized_validation_clips
+        )
+        self.quantized_min_cosine = vs_params.get(
+            "quantized_min_cosine", self.quantized_min_cosine
+        )
+        self._embedder = None
+
+    def _init_client(self, embedding_dim: int):
+        return NanoVectorDB(embedding_dim, storage_file=self._client_file_name)
+
+    def _load_embedder(self):
+        # loaded once per storage, upsert and query_batch reuse it
+        if self._embedder is None:
+            self._embedder = self._load_quantized_embedder() or get_imagebind_model()
+        return self._embedder
+
+    def _load_quantized_embedder(self):
+        if self.imagebind_backend != "quantized":
+            return None
+        model_file = get_imagebind_model_file()
+        if not os.path.exists(model_file):
+            logger.warning(
+                f"Quantized ImageBind needs a local checkpoint, {model_file} not found"
+            )
+            return None
+        # 延迟导入以避免循环依赖
+        from .._videoutil.feature_quantized import load_quantized_imagebind
+
+        try:
+            return load_quantized_imagebind(
+                model_file,
+                get_imagebind_model,
+                validation_clips=self.quantized_validation_clips,
+                min_cosine=self.quantized_min_cosine,
+            )
+        except Exception as e:
+            logger.warning(f"Could not prepare int8 ImageBind ({e}), using eager inference")
+            return None
     
     async def upsert(self, video_name, segment_index2name, video_output_format):
-        embedder = get_imagebind_model()
+        embedder = self._load_embedder()
         
         logger.info(f"Inserting {len(segment_index2name)} segments to {self.namespace}")
         if not len(segment_index2name):
@@ -144,12 +203,13 @@ class NanoVectorDBVideoSegmentStorage(BaseVectorStorage):
         cache_path = os.path.join(self.global_config["working_dir"], '_cache', video_name)
         index_list = list(segment_index2name.keys())
         for index in index_list:
+            segment_name = segment_index2name[index]
             list_data.append({
                 "__id__": f"{video_name}_{index}",
                 "__video_name__": video_name,
                 "__index__": index,
+                "__time__": '-'.join(segment_name.split('-')[-2:]),
             })
-            segment_name = segment_index2name[index]
             video_file = os.path.join(cache_path, f"{segment_name}.{video_output_format}")
             video_paths.append(video_file)
         batches = [
@@ -170,23 +230,29 @@ class NanoVectorDBVideoSegmentStorage(BaseVectorStorage):
         results = self._client.upsert(datas=list_data)
         return results
     
-    async def query(self, query: str):
+    async def query(self, query: str, scope: VideoScope = None):
+        return (await self.query_batch([query], scope=scope))[0]
+
+    async def query_batch(
+        self, queries: list[str], scope: VideoScope = None
+    ) -> list[list[dict]]:
         # 延迟导入以避免循环依赖
-        from .._videoutil import encode_string_query
+        from .._videoutil import encode_string_queries
 
-        embedder = get_imagebind_model()
+        embedder = self._load_embedder()
 
-        embedding = encode_string_query(query, embedder)
-        embedding = embedding[0]
-        results = self._client.query(
-            query=embedding,
+        embeddings = encode_string_queries(queries, embedder).numpy()
+        batch_results = client_query_batch(
+            self._client,
+            embeddings,
             top_k=self.top_k,
             better_than_threshold=-1,
+            **scope_query_kwargs(self._client, scope),
         )
-        results = [
-            {**dp, "id": dp["__id__"], "distance": dp["__metrics__"]} for dp in results
+        return [
+            [{**dp, "id": dp["__id__"], "distance": dp["__metrics__"]} for dp in results]
+            for results in batch_results
         ]
-        return results
     
     async def index_done_callback(self):
         self._client.save()
@@ -1,10 +1,18 @@
 import asyncio
+import contextvars
+import heapq
 import html
+import itertools
 import json
 import logging
 import os
 import re
 import numbers
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from dataclasses import dataclass
 from functools import wraps
 from hashlib import md5
@@ -150,12 +158,87 @@ def clean_str(input: Any) -> str:
 
 
 # Utils types -----------------------------------------------------------------------
+class EmbeddingCache:
+    """Content-addressed embedding store shared by all sessions.
+
+    Vectors are kept as float32 blobs in one SQLite file, keyed by
+    (model name, md5 of the text), so the same text is only ever sent to the
+    provider once per model. The methods block on SQLite; EmbeddingFunc calls
+    them from worker threads.
+    """
+
+    def __init__(self, file_name: str):
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file_name, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash BLOB NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, text_hash)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        return md5(text.encode("utf-8")).digest()
+
+    def get_many(self, model: str, texts: list[str], dim: int) -> dict[int, np.ndarray]:
+        """Cached vectors by position in `texts`"""
+        hashes = [self._hash(t) for t in texts]
+        found = {}
+        with self._lock:
+            # stay below SQLite's bound-parameter limit
+            for i in range(0, len(hashes), 500):
+                part = hashes[i : i + 500]
+                found.update(
+                    self._conn.execute(
+                        f"SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                        f"AND text_hash IN ({','.join('?' * len(part))})",
+                        [model, *part],
+                    ).fetchall()
+                )
+        result = {}
+        for i, h in enumerate(hashes):
+            vector = found.get(h)
+            if vector is not None and len(vector) == dim * 4:
+                result[i] = np.frombuffer(vector, dtype=np.float32)
+        with self._lock:
+            self.hits += len(result)
+            self.misses += len(texts) - len(result)
+        return result
+
+    def put_many(self, model: str, texts: list[str], vectors: np.ndarray):
+        rows = [
+            (model, self._hash(t), np.asarray(v, dtype=np.float32).tobytes())
+            for t, v in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
 @dataclass
 class EmbeddingFunc:
     embedding_dim: int
     max_token_size: int
     model_name: str
     func: callable
+    cache: EmbeddingCache = None
 
     async def __call__(self, *args, **kwargs) -> np.ndarray:
         # Had to fix this as the embedding function took only one named argument put it's passed in
@@ -169,33 +252,383 @@ class EmbeddingFunc:
                 kwargs['texts'] = args[0]
             else:
                 raise ValueError("Unexpected positional arguments. Expected a single list of texts")
-        # Call the function with the updated keyword arguments
-        return await self.func(**kwargs)        
+        if self.cache is None or not kwargs.get('texts'):
+            # Call the function with the updated keyword arguments
+            return await self.func(**kwargs)
+
+        # Only the texts missing from the cache go to the provider; the SQLite
+        # reads and commits run off the event loop
+        texts = kwargs['texts']
+        cached = await asyncio.to_thread(
+            self.cache.get_many, self.model_name, texts, self.embedding_dim
+        )
+        missing = [i for i in range(len(texts)) if i not in cached]
+        if missing:
+            kwargs['texts'] = [texts[i] for i in missing]
+            fresh = np.asarray(await self.func(**kwargs), dtype=np.float32)
+            await asyncio.to_thread(self.cache.put_many, self.model_name, kwargs['texts'], fresh)
+            cached.update(zip(missing, fresh))
+        logger.debug(
+            f"Embedding cache: {len(texts) - len(missing)}/{len(texts)} hits, "
+            f"{self.cache.stats()['hit_rate']:.1%} overall"
+        )
+        return np.stack([cached[i] for i in range(len(texts))])
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """HTTP 429 from openai-compatible clients as well as raw httpx responses"""
+    if getattr(e, "status_code", None) == 429:
+        return True
+    return getattr(getattr(e, "response", None), "status_code", None) == 429
+
+
+def _retry_after_seconds(e: Exception) -> Union[float, None]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class EmbeddingBatcher:
+    """Schedules embedding requests within a provider's per-request limits.
+
+    Texts are packed in order into requests of at most `max_inputs` texts and
+    `max_tokens` tokens. The number of requests in flight starts at
+    `max_async`, is halved whenever the provider answers 429 and grows back by
+    one after as many successful requests as the current limit (AIMD). A 429
+    also pauses every request for the Retry-After delay (or an exponential
+    backoff) instead of each one backing off on its own.
+    """
+
+    def __init__(
+        self,
+        func: callable,
+        max_inputs: int,
+        max_tokens: int,
+        max_async: int,
+        count_tokens: callable = None,
+        max_retries: int = 8,
+        base_wait: float = 1.0,
+        max_wait: float = 30.0,
+    ):
+        self.func = func
+        self.max_inputs = max(1, max_inputs)
+        self.max_tokens = max(1, max_tokens)
+        self.max_async = max(1, max_async)
+        self.count_tokens = count_tokens or (lambda text: len(encode_string_by_tiktoken(text)))
+        self.max_retries = max_retries
+        self.base_wait = base_wait
+        self.max_wait = max_wait
+        self.limit = self.max_async
+        self._in_flight = 0
+        self._successes = 0
+        self._waiters = deque()
+        self._paused_until = 0.0
+        self.rate_limited = 0
+
+    def pack(self, texts: list[str]) -> list[tuple[int, int]]:
+        """[start, end) ranges of `texts`, one per request"""
+        ranges, start, tokens = [], 0, 0
+        for i, text in enumerate(texts):
+            n = self.count_tokens(text)
+            if i > start and (i - start >= self.max_inputs or tokens + n > self.max_tokens):
+                ranges.append((start, i))
+                start, tokens = i, 0
+            tokens += n
+        if start < len(texts):
+            ranges.append((start, len(texts)))
+        return ranges
+
+    async def _acquire(self):
+        while self._in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self._in_flight += 1
+
+    def _release(self):
+        self._in_flight -= 1
+        free = self.limit - self._in_flight
+        while self._waiters and free > 0:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def _on_success(self):
+        self._successes += 1
+        if self.limit < self.max_async and self._successes >= self.limit:
+            self.limit += 1
+            self._successes = 0
+
+    def _on_rate_limit(self, e: Exception, attempt: int):
+        self.rate_limited += 1
+        self._successes = 0
+        loop = asyncio.get_running_loop()
+        # requests already in flight when the first 429 arrived count once
+        if self.limit > 1 and loop.time() >= self._paused_until:
+            self.limit = max(1, self.limit // 2)
+            logger.warning(f"Embedding provider rate limited, concurrency lowered to {self.limit}")
+        wait = _retry_after_seconds(e)
+        if wait is None:
+            wait = min(self.max_wait, self.base_wait * 2**attempt)
+        self._paused_until = max(self._paused_until, loop.time() + wait)
+
+    async def _request(self, texts: list[str], **kwargs) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            while loop.time() < self._paused_until:
+                await asyncio.sleep(self._paused_until - loop.time())
+            await self._acquire()
+            try:
+                result = await self.func(texts=texts, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                self._on_rate_limit(e, attempt)
+                continue
+            finally:
+                self._release()
+            self._on_success()
+            return result
+
+    async def stream(self, texts: list[str], **kwargs):
+        """Yield the embeddings of each packed request, in input order"""
+        ranges = iter(self.pack(texts))
+        pending = deque()
+
+        def schedule():
+            # keep only as many requests ahead as could run at once
+            while len(pending) < self.max_async:
+                r = next(ranges, None)
+                if r is None:
+                    return
+                pending.append(
+                    asyncio.ensure_future(self._request(texts[r[0] : r[1]], **kwargs))
+                )
+
+        schedule()
+        try:
+            while pending:
+                result = await pending.popleft()
+                schedule()
+                yield np.asarray(result)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def __call__(self, texts: list[str], **kwargs) -> np.ndarray:
+        batches = [batch async for batch in self.stream(texts, **kwargs)]
+        if not batches:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.concatenate(batches)
+
+
+class TokenBucketLimiter:
+    """Requests-per-minute and tokens-per-minute budget of one model.
+
+    Each call reserves one request and its estimated tokens up front and
+    sleeps until both buckets cover the reservation; reservations are taken in
+    arrival order, so callers are admitted first come first served without
+    polling. Buckets refill at `headroom` of the quota and hold at most
+    `burst_seconds` of it, which keeps throughput just under the quota instead
+    of bursting a minute's budget at once. Like PriorityLimiter it can be
+    shared across event loops."""
+
+    def __init__(
+        self,
+        rpm: int = None,
+        tpm: int = None,
+        expected_completion_tokens: int = 512,
+        headroom: float = 0.95,
+        burst_seconds: float = 10.0,
+    ):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.expected_completion_tokens = expected_completion_tokens
+        self._lock = threading.Lock()
+        # [level, refill per second, capacity] per metered dimension
+        self._buckets = {}
+        for name, per_minute in (("requests", rpm), ("tokens", tpm)):
+            if per_minute:
+                rate = per_minute * headroom / 60
+                capacity = max(1.0, rate * burst_seconds)
+                self._buckets[name] = [capacity, rate, capacity]
+        self._last_refill = time.monotonic()
+        self.throttled_seconds = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self._last_refill = now - self._last_refill, now
+        for bucket in self._buckets.values():
+            bucket[0] = min(bucket[2], bucket[0] + elapsed * bucket[1])
+
+    def _take(self, amounts: dict) -> float:
+        """Deduct `amounts` (levels may go negative) and return how long the
+        caller has to wait for the debt to be paid back"""
+        with self._lock:
+            self._refill()
+            wait = 0.0
+            for name, amount in amounts.items():
+                bucket = self._buckets.get(name)
+                if bucket is None:
+                    continue
+                bucket[0] = min(bucket[2], bucket[0] - amount)
+                if bucket[0] < 0:
+                    wait = max(wait, -bucket[0] / bucket[1])
+            return wait
+
+    async def acquire(self, tokens: int):
+        wait = self._take({"requests": 1, "tokens": tokens})
+        if wait <= 0:
+            return
+        self.throttled_seconds += wait
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            self._take({"requests": -1, "tokens": -tokens})
+            raise
+
+    def settle(self, token_delta: int):
+        """Correct the reservation once the real token count is known"""
+        self._take({"tokens": token_delta})
+
+
+# LLM call priorities, lower is served first
+LLM_PRIORITY_QUERY = 0
+LLM_PRIORITY_BACKGROUND = 1
+LLM_PRIORITY_NAMES = {LLM_PRIORITY_QUERY: "query", LLM_PRIORITY_BACKGROUND: "background"}
+
+_llm_priority = contextvars.ContextVar("llm_priority", default=LLM_PRIORITY_BACKGROUND)
+
+
+class PriorityLimiter:
+    """At most `max_size` holders at a time. Waiters queue by priority, then in
+    arrival order, and are woken by the release that frees their slot rather
+    than by polling.
+
+    State sits behind a thread lock and waiters are woken on their own loop, so
+    one limiter can be shared by calls running on different event loops (as
+    asyncio.Semaphore cannot without nest-asyncio)."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._waiters = []  # heap of (priority, arrival, future)
+        self._arrivals = itertools.count()
+        # priority -> [calls, total wait, max wait] in seconds
+        self._waits = defaultdict(lambda: [0, 0.0, 0.0])
+
+    async def acquire(self, priority: int = LLM_PRIORITY_BACKGROUND):
+        start = time.monotonic()
+        with self._lock:
+            # cancelled waiters are only dropped lazily; a live one is always
+            # queued behind a full limiter
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if self._in_use < self.max_size:
+                self._in_use += 1
+                waiter = None
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                heapq.heappush(self._waiters, (priority, next(self._arrivals), waiter))
+        if waiter is not None:
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # the slot may have been handed over just before the cancel
+                if waiter.done() and not waiter.cancelled():
+                    self.release()
+                raise
+        wait = time.monotonic() - start
+        with self._lock:
+            stats = self._waits[priority]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                _, _, waiter = heapq.heappop(self._waiters)
+                if not waiter.done():
+                    # the slot passes straight to the waiter
+                    waiter.get_loop().call_soon_threadsafe(self._grant, waiter)
+                    return
+            self._in_use -= 1
+
+    def _grant(self, waiter: asyncio.Future):
+        if waiter.cancelled():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    def stats(self) -> dict:
+        """Queue wait per priority class"""
+        with self._lock:
+            return {
+                LLM_PRIORITY_NAMES.get(priority, str(priority)): {
+                    "calls": calls,
+                    "mean_wait": total / calls if calls else 0.0,
+                    "max_wait": longest,
+                }
+                for priority, (calls, total, longest) in sorted(self._waits.items())
+            }
+
+
+def current_llm_priority() -> int:
+    return _llm_priority.get()
+
+
+@contextmanager
+def llm_priority(priority: int):
+    """LLM calls made inside the block (and tasks started from it) queue with `priority`"""
+    token = _llm_priority.set(priority)
+    try:
+        yield
+    finally:
+        _llm_priority.reset(token)
 
 
 # Decorators ------------------------------------------------------------------------
-def limit_async_func_call(max_size: int, waitting_time: float = 0.0001):
-    """Add restriction of maximum async calling times for a async func"""
+def limit_async_func_call(max_size: int):
+    """Add restriction of maximum async calling times for a async func. Waiting
+    calls are served by their llm_priority, then first come first served; queue
+    waits are reported by `wait_func.limiter.stats()`."""
 
     def final_decro(func):
-        """Not using async.Semaphore to aovid use nest-asyncio"""
-        __current_size = 0
+        limiter = PriorityLimiter(max_size)
 
         @wraps(func)
         async def wait_func(*args, **kwargs):
-            nonlocal __current_size
-            while __current_size >= max_size:
-                await asyncio.sleep(waitting_time)
-            __current_size += 1
-            result = await func(*args, **kwargs)
-            __current_size -= 1
-            return result
+            await limiter.acquire(_llm_priority.get())
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                limiter.release()
 
+        wait_func.limiter = limiter
         return wait_func
 
     return final_decro
 
 
+def with_llm_priority(priority: int):
+    """Run an async function's LLM calls at `priority`"""
+
+    def final_decro(func):
+        @wraps(func)
+        async def wrapped(*args, **kwargs):
+            with llm_priority(priority):
+                return await func(*args, **kwargs)
+
+        return wrapped
+
+    return final_decro
+
+
 def wrap_embedding_func_with_attrs(**kwargs):
     """Wrap a function with attributes"""
 
@@ -399,18 +399,18 @@ def merge_segment_information(segment_index2name, segment_times_info, transcript
 
     return inserting_segments
         
-def retrieved_segment_caption(caption_model, caption_tokenizer, refine_knowledge, retrieved_segments, video_path_db, video_segments, num_sampled_frames):
+def retrieved_segment_caption(caption_model, caption_tokenizer, refine_knowledge, retrieved_segments, video_paths, segment_videos, num_sampled_frames):
     caption_result = {}
     for this_segment in tqdm(retrieved_segments, desc='Captioning Segments for Given Query'):
         video_name = '_'.join(this_segment.split('_')[:-1])
         index = this_segment.split('_')[-1]
-        video_path = video_path_db._data[video_name]
-        timestamp = video_segments._data[video_name][index]["time"].split('-')
+        video_path = video_paths[video_name]
+        timestamp = segment_videos[video_name][index]["time"].split('-')
         start, end = eval(timestamp[0]), eval(timestamp[1])
         video = VideoFileClip(video_path)
         frame_times = np.linspace(start, end, num_sampled_frames, endpoint=False)
         video_frames = encode_video(video, frame_times)
-        segment_transcript = video_segments._data[video_name][index]["transcript"]
+        segment_transcript = segment_videos[video_name][index]["transcript"]
         query = f"The transcript of the current video:\n{segment_transcript}.\nNow provide a very detailed description (caption) of the video in English and extract relevant information about: {refine_knowledge}'"
         msgs = [{'role': 'user', 'content': video_frames + [query]}]
         params = {}
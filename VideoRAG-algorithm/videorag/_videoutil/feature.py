@@ -1,6 +1,9 @@
 import os
 import torch
 import pickle
+import tempfile
+import threading
+from contextlib import contextmanager
 from tqdm import tqdm
 
 # Fix for torchvision compatibility before importing imagebind
@@ -16,9 +19,130 @@ from imagebind import data
 from imagebind.models import imagebind_model
 from imagebind.models.imagebind_model import ImageBindModel, ModalityType
 
+from .._utils import logger
+
+
+IMAGEBIND_HUGE_KWARGS = dict(
+    vision_embed_dim=1280,
+    vision_num_blocks=32,
+    vision_num_heads=16,
+    text_embed_dim=1024,
+    text_num_blocks=24,
+    text_num_heads=16,
+    out_embed_dim=1024,
+    audio_drop_path=0.1,
+    imu_drop_path=0.7,
+)
+
+
+def mmap_checkpoint_path(model_file: str) -> str:
+    return os.path.splitext(model_file)[0] + ".mmap.pt"
+
+
+def convert_imagebind_checkpoint(model_file: str, mmap_file: str = None) -> str:
+    """Re-save a checkpoint as a flat state dict of contiguous tensors that
+    torch.load(mmap=True) can map straight from the page cache."""
+    mmap_file = mmap_file or mmap_checkpoint_path(model_file)
+    state_dict = torch.load(model_file, map_location="cpu")
+    state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+    # a private temp file, so workers converting at the same time do not
+    # write into each other's output; the last replace wins with a whole file
+    fd, tmp_file = tempfile.mkstemp(
+        prefix=os.path.basename(mmap_file) + ".", suffix=".tmp", dir=os.path.dirname(mmap_file) or "."
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            torch.save(state_dict, f)
+        os.replace(tmp_file, mmap_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return mmap_file
+
+
+def _map_imagebind_state_dict(model_file: str) -> dict:
+    mmap_file = mmap_checkpoint_path(model_file)
+    if not os.path.exists(mmap_file) or os.path.getmtime(mmap_file) < os.path.getmtime(model_file):
+        try:
+            convert_imagebind_checkpoint(model_file, mmap_file)
+        except OSError:
+            # read-only model directory: map the original file if its format allows
+            mmap_file = model_file
+    try:
+        return torch.load(mmap_file, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError as e:
+        logger.warning(
+            f"Could not memory-map {mmap_file} ({e}), reading the whole checkpoint instead"
+        )
+        return torch.load(mmap_file, map_location="cpu")
+
+
+_meta_parameters = threading.local()
+_meta_hook_lock = threading.Lock()
+_meta_hook_users = 0
+_register_parameter = torch.nn.Module.register_parameter
+
+
+def _register_parameter_on_meta(module, name, param):
+    _register_parameter(module, name, param)
+    if param is not None and getattr(_meta_parameters, "active", False):
+        module._parameters[name] = torch.nn.Parameter(
+            param.to("meta"), requires_grad=param.requires_grad
+        )
+
+
+@contextmanager
+def _parameters_on_meta():
+    """Register new parameters on the meta device, so their random init costs
+    nothing, while buffers are still built for real: they are small and the
+    non-persistent ones are not in the checkpoint to be assigned from.
+
+    The hook is installed only while some thread is inside this context and
+    only acts for those threads; modules other threads build at the same time
+    get ordinary parameters. torch.device("meta") would not do, as ImageBind
+    reads values (drop path rates) back from tensors it builds.
+    """
+    global _meta_hook_users
+    with _meta_hook_lock:
+        if _meta_hook_users == 0:
+            torch.nn.Module.register_parameter = _register_parameter_on_meta
+        _meta_hook_users += 1
+    _meta_parameters.active = True
+    try:
+        yield
+    finally:
+        _meta_parameters.active = False
+        with _meta_hook_lock:
+            _meta_hook_users -= 1
+            if _meta_hook_users == 0:
+                torch.nn.Module.register_parameter = _register_parameter
+
+
+def load_imagebind_huge(model_file: str, device) -> ImageBindModel:
+    """Build ImageBind huge with weights memory-mapped from model_file.
+
+    Parameters are assigned from the mapped storage instead of being copied
+    into freshly initialised ones, so CPU processes share one physical copy
+    of the weights and cold start skips the random init.
+    """
+    state_dict = _map_imagebind_state_dict(model_file)
+    with _parameters_on_meta():
+        embedder = ImageBindModel(**IMAGEBIND_HUGE_KWARGS)
+    embedder.load_state_dict(state_dict, assign=True)
+    return embedder.to(device).eval()
+
+
+def _embedder_device(embedder) -> torch.device:
+    # TorchScript/quantized embedders expose no float parameters
+    device = getattr(embedder, "device", None)
+    if isinstance(device, torch.device):
+        return device
+    return next(embedder.parameters()).device
+
 
 def encode_video_segments(video_paths, embedder: ImageBindModel):
-    device = next(embedder.parameters()).device
+    device = _embedder_device(embedder)
     inputs = {
         ModalityType.VISION: data.load_and_transform_video_data(video_paths, device),
     }
@@ -28,9 +152,13 @@ def encode_video_segments(video_paths, embedder: ImageBindModel):
     return embeddings
 
 def encode_string_query(query:str, embedder: ImageBindModel):
-    device = next(embedder.parameters()).device
+    return encode_string_queries([query], embedder)
+
+
+def encode_string_queries(queries: list[str], embedder: ImageBindModel):
+    device = _embedder_device(embedder)
     inputs = {
-        ModalityType.TEXT: data.load_and_transform_text([query], device),
+        ModalityType.TEXT: data.load_and_transform_text(queries, device),
     }
     with torch.no_grad():
         embeddings = embedder(inputs)[ModalityType.TEXT]
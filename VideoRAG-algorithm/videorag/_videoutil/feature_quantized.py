@@ -0,0 +1,187 @@
+"""
+CPU inference backend for ImageBind.
+
+The vision and text encoders are dynamically quantized to int8 (nn.Linear
+layers only), traced to TorchScript and cached next to imagebind.pth. Before
+the cached artifacts are used they are checked against the eager fp32 model
+on a fixed set of real video clips (quantized_validation_clips) and texts; if
+no clips are configured or the cosine agreement is too low the caller falls
+back to the eager model.
+"""
+
+import copy
+import os
+
+import torch
+import torch.nn.functional as F
+
+from .._utils import load_json, logger, write_json
+from .feature import ModalityType, data
+
+VALIDATION_TEXTS = [
+    "a person is talking in front of a whiteboard",
+    "a car driving along a highway at night",
+    "a close-up of hands typing on a keyboard",
+    "a crowd of people watching a football match",
+]
+
+
+class _ModalityEncoder(torch.nn.Module):
+    def __init__(self, embedder: torch.nn.Module, modality: str):
+        super().__init__()
+        self.embedder = embedder
+        self.modality = modality
+
+    def forward(self, x):
+        return self.embedder({self.modality: x})[self.modality]
+
+
+class QuantizedImageBind(torch.nn.Module):
+    """Drop-in for ImageBindModel in encode_video_segments / encode_string_query"""
+
+    def __init__(self, vision: torch.nn.Module, text: torch.nn.Module):
+        super().__init__()
+        self.vision = vision
+        self.text = text
+        self.device = torch.device("cpu")
+
+    def forward(self, inputs: dict) -> dict:
+        outputs = {}
+        if ModalityType.VISION in inputs:
+            outputs[ModalityType.VISION] = self.vision(inputs[ModalityType.VISION])
+        if ModalityType.TEXT in inputs:
+            outputs[ModalityType.TEXT] = self.text(inputs[ModalityType.TEXT])
+        return outputs
+
+
+def quantized_artifact_paths(model_file: str) -> dict:
+    model_dir = os.path.dirname(os.path.abspath(model_file))
+    return {
+        ModalityType.VISION: os.path.join(model_dir, "imagebind_vision_int8.pt"),
+        ModalityType.TEXT: os.path.join(model_dir, "imagebind_text_int8.pt"),
+        "meta": os.path.join(model_dir, "imagebind_int8.json"),
+    }
+
+
+def _source_signature(model_file: str) -> str:
+    stat = os.stat(model_file)
+    return f"{stat.st_size}-{int(stat.st_mtime)}"
+
+
+def _validation_inputs(validation_clips):
+    vision = data.load_and_transform_video_data(validation_clips, "cpu")
+    text = data.load_and_transform_text(VALIDATION_TEXTS, "cpu")
+    return vision, text
+
+
+def export_quantized_imagebind(
+    embedder: torch.nn.Module, model_file: str, example_inputs
+) -> QuantizedImageBind:
+    """Quantize the Linear layers to int8, trace both encoders and save them"""
+    paths = quantized_artifact_paths(model_file)
+    # quantize a CPU copy so the caller's eager model stays where it was
+    quantized = torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(embedder).to("cpu").eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    vision_input, text_input = example_inputs
+    with torch.no_grad():
+        vision = torch.jit.trace(
+            _ModalityEncoder(quantized, ModalityType.VISION),
+            vision_input[:1],
+            check_trace=False,
+        )
+        text = torch.jit.trace(
+            _ModalityEncoder(quantized, ModalityType.TEXT),
+            text_input[:1],
+            check_trace=False,
+        )
+    torch.jit.save(vision, paths[ModalityType.VISION])
+    torch.jit.save(text, paths[ModalityType.TEXT])
+    logger.info(f"Exported int8 ImageBind encoders next to {model_file}")
+    return QuantizedImageBind(vision, text)
+
+
+def measure_cosine_agreement(
+    reference: torch.nn.Module, candidate: torch.nn.Module, inputs
+) -> dict[str, float]:
+    """Worst-case cosine similarity between two embedders, per modality"""
+    vision_input, text_input = inputs
+    device = next(reference.parameters()).device
+    with torch.no_grad():
+        expected = reference(
+            {
+                ModalityType.VISION: vision_input.to(device),
+                ModalityType.TEXT: text_input.to(device),
+            }
+        )
+        actual = candidate(
+            {ModalityType.VISION: vision_input, ModalityType.TEXT: text_input}
+        )
+    return {
+        modality: F.cosine_similarity(
+            expected[modality].cpu().float(), actual[modality].float(), dim=-1
+        ).min().item()
+        for modality in (ModalityType.VISION, ModalityType.TEXT)
+    }
+
+
+def load_quantized_imagebind(
+    model_file: str,
+    eager_loader: callable,
+    validation_clips: list[str] = None,
+    min_cosine: float = 0.98,
+):
+    """Return the cached int8 encoders for model_file, exporting and validating
+    them on first use. Returns None when no validation clips are configured or
+    the encoders disagree with the eager model."""
+    if not validation_clips:
+        logger.warning(
+            "int8 ImageBind needs quantized_validation_clips to validate against, using eager inference"
+        )
+        return None
+    missing = [clip for clip in validation_clips if not os.path.exists(clip)]
+    if missing:
+        logger.warning(
+            f"int8 ImageBind validation clips not found ({', '.join(missing)}), using eager inference"
+        )
+        return None
+    paths = quantized_artifact_paths(model_file)
+    signature = _source_signature(model_file)
+    meta = load_json(paths["meta"])
+    cached = (
+        meta is not None
+        and meta.get("source") == signature
+        and meta.get("validation_clips") == list(validation_clips)
+        and os.path.exists(paths[ModalityType.VISION])
+        and os.path.exists(paths[ModalityType.TEXT])
+    )
+
+    if cached:
+        scores = meta["scores"]
+        model = QuantizedImageBind(
+            torch.jit.load(paths[ModalityType.VISION], map_location="cpu"),
+            torch.jit.load(paths[ModalityType.TEXT], map_location="cpu"),
+        )
+    else:
+        inputs = _validation_inputs(validation_clips)
+        eager = eager_loader()
+        model = export_quantized_imagebind(eager, model_file, inputs)
+        scores = measure_cosine_agreement(eager, model, inputs)
+        del eager
+        write_json(
+            {
+                "source": signature,
+                "validation_clips": list(validation_clips),
+                "scores": scores,
+            },
+            paths["meta"],
+        )
+
+    worst = min(scores.values())
+    if worst < min_cosine:
+        logger.warning(
+            f"int8 ImageBind disagrees with the eager model (min cosine {worst:.4f} < {min_cosine}), using eager inference"
+        )
+        return None
+    logger.info(f"Using int8 ImageBind encoders (min cosine {worst:.4f})")
+    return model.eval()
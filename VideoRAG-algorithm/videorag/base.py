@@ -1,9 +1,58 @@
+import asyncio
+import threading
+import time
 from dataclasses import dataclass, field
 from typing import TypedDict, Union, Literal, Generic, TypeVar
 
 import numpy as np
 
-from ._utils import EmbeddingFunc
+from ._utils import EmbeddingFunc, logger
+
+
+@dataclass
+class VideoScope:
+    """Restricts retrieval to some videos of a session and, for video
+    segments, to a time window (seconds) within them."""
+
+    video_names: list[str] = None
+    time_range: tuple[float, float] = None
+
+    def allows_video(self, video_name: str) -> bool:
+        return self.video_names is None or video_name in self.video_names
+
+    def allows_time(self, time: str) -> bool:
+        """`time` is a segment's "start-end" string"""
+        if self.time_range is None or not time:
+            return True
+        start, end = (float(t) for t in time.split("-"))
+        return start < self.time_range[1] and end > self.time_range[0]
+
+    def allows(self, record: dict) -> bool:
+        """Whether a stored vector record is in scope; records written before
+        videos were tracked carry no video names and are always kept"""
+        videos = record_videos(record)
+        if videos is not None and not any(self.allows_video(v) for v in videos):
+            return False
+        return self.allows_time(record.get("__time__"))
+
+
+def record_videos(record: dict) -> Union[list[str], None]:
+    if "__videos__" in record:
+        return record["__videos__"]
+    if "__video_name__" in record:
+        return [record["__video_name__"]]
+    return None
+
+
+def segment_video_name(segment_id: str) -> str:
+    return "_".join(segment_id.split("_")[:-1])
+
+
+def value_videos(value: dict) -> Union[list[str], None]:
+    """Videos an upserted chunk (via its segment ids) or entity belongs to"""
+    if "video_segment_id" in value:
+        return sorted({segment_video_name(s) for s in value["video_segment_id"]})
+    return value.get("video_names")
 
 
 @dataclass
@@ -17,6 +66,7 @@ class QueryParam:
     naive_max_token_for_text_unit = 12000
     # videorag search
     only_need_context: bool = False
+    scope: VideoScope = None
 
 
 TextChunkSchema = TypedDict(
@@ -69,15 +119,29 @@ class BaseVectorStorage(StorageNameSpace):
     embedding_func: EmbeddingFunc
     meta_fields: set = field(default_factory=set)
 
-    async def query(self, query: str, top_k: int) -> list[dict]:
+    async def query(
+        self, query: str, top_k: int, scope: VideoScope = None
+    ) -> list[dict]:
         raise NotImplementedError
 
+    async def query_batch(
+        self, queries: list[str], top_k: int, scope: VideoScope = None
+    ) -> list[list[dict]]:
+        """One result list per query; storages override this to embed and
+        score all queries at once"""
+        return await asyncio.gather(
+            *[self.query(query, top_k, scope=scope) for query in queries]
+        )
+
     async def upsert(self, data: dict[str, dict]):
         """Use 'content' field from value for embedding, use key as id.
         If embedding_func is None, use 'embedding' field from value
         """
         raise NotImplementedError
 
+    async def delete(self, ids: list[str]):
+        raise NotImplementedError
+
 
 @dataclass
 class BaseKVStorage(Generic[T], StorageNameSpace):
@@ -130,6 +194,25 @@ class BaseGraphStorage(StorageNameSpace):
     ) -> Union[list[tuple[str, str]], None]:
         raise NotImplementedError
 
+    # batch reads, one result per requested id in the same order; backends
+    # that pay a round trip per call should override them
+
+    async def get_nodes(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        return await asyncio.gather(*[self.get_node(n) for n in node_ids])
+
+    async def node_degrees(self, node_ids: list[str]) -> list[int]:
+        return await asyncio.gather(*[self.node_degree(n) for n in node_ids])
+
+    async def get_nodes_edges(
+        self, source_node_ids: list[str]
+    ) -> list[Union[list[tuple[str, str]], None]]:
+        return await asyncio.gather(*[self.get_node_edges(n) for n in source_node_ids])
+
+    async def get_edges(
+        self, edge_pairs: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        return await asyncio.gather(*[self.get_edge(s, t) for s, t in edge_pairs])
+
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         raise NotImplementedError
 
@@ -138,6 +221,12 @@ class BaseGraphStorage(StorageNameSpace):
     ):
         raise NotImplementedError
 
+    async def upsert_nodes(self, nodes: dict[str, dict]):
+        await asyncio.gather(*[self.upsert_node(k, v) for k, v in nodes.items()])
+
+    async def upsert_edges(self, edges: dict[tuple[str, str], dict]):
+        await asyncio.gather(*[self.upsert_edge(s, t, v) for (s, t), v in edges.items()])
+
     async def clustering(self, algorithm: str):
         raise NotImplementedError
 
@@ -147,3 +236,60 @@ class BaseGraphStorage(StorageNameSpace):
 
     async def embed_nodes(self, algorithm: str) -> tuple[np.ndarray, list[str]]:
         raise NotImplementedError("Node embedding is not used in nano-graphrag.")
+
+
+class LazyStorage:
+    """Stands in for a storage and only constructs it on first use, so opening
+    a session does not pay for stores a request never touches. Commit
+    callbacks of a store that was never opened are no-ops."""
+
+    def __init__(self, name: str, factory: callable):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+        self.open_seconds = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._instance is not None
+
+    def open(self):
+        with self._lock:
+            if self._instance is None:
+                start = time.perf_counter()
+                self._instance = self._factory()
+                self.open_seconds = time.perf_counter() - start
+                logger.info(f"Opened {self._name} in {self.open_seconds * 1000:.1f} ms")
+        return self._instance
+
+    def __getattr__(self, name):
+        # only reached for attributes the proxy itself does not have
+        if name.startswith("__") or name in ("_name", "_factory", "_instance", "_lock"):
+            raise AttributeError(name)
+        return getattr(self.open(), name)
+
+    def __len__(self):
+        return len(self.open())
+
+    async def index_done_callback(self):
+        if self._instance is not None:
+            await self._instance.index_done_callback()
+
+    async def query_done_callback(self):
+        if self._instance is not None:
+            await self._instance.query_done_callback()
+
+
+async def open_storages(*storages):
+    """Open the given lazy storages concurrently in worker threads; anything
+    else (already opened, plain storages, None) is passed over"""
+    pending = [s for s in storages if isinstance(s, LazyStorage) and not s.is_open]
+    if not pending:
+        return
+    start = time.perf_counter()
+    await asyncio.gather(*[asyncio.to_thread(s.open) for s in pending])
+    logger.info(
+        f"Opened {len(pending)} storages in {(time.perf_counter() - start) * 1000:.1f} ms: "
+        + ", ".join(f"{s._name} {s.open_seconds * 1000:.1f} ms" for s in pending)
+    )
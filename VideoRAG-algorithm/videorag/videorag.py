@@ -4,7 +4,7 @@ import json
 import shutil
 import asyncio
 import multiprocessing
-from dataclasses import asdict, dataclass, field
+from dataclasses import asdict, dataclass, field, replace
 from datetime import datetime
 from functools import partial
 from typing import Callable, Dict, List, Optional, Type, Union, cast
@@ -14,6 +14,9 @@ import tiktoken
 
 from ._llm import (
     LLMConfig,
+    embedding_request_limits,
+    model_rate_limiters,
+    without_rate_limit_retry,
     openai_config,
     azure_openai_config,
     OLLAMA_AVAILABLE
@@ -24,23 +27,34 @@ if OLLAMA_AVAILABLE:
     from ._llm import ollama_config
 else:
     ollama_config = None
+from ._batch import BatchCompletion
+from ._scheduler import SchedulerClient, SchedulerSlot, schedule_async_func_call
 from ._op import (
     chunking_by_video_segments,
     extract_entities,
     get_chunks,
     videorag_query,
     videorag_query_multiple_choice,
+    videorag_retrieve,
 )
 from ._storage import (
+    BM25Storage,
+    EntityChunkIndex,
     JsonKVStorage,
+    LogKVStorage,
     NanoVectorDBStorage,
     NanoVectorDBVideoSegmentStorage,
     NetworkXStorage,
+    SqliteKVStorage,
 )
 from ._utils import (
+    EmbeddingBatcher,
+    EmbeddingCache,
     EmbeddingFunc,
     compute_mdhash_id,
     limit_async_func_call,
+    with_llm_priority,
+    LLM_PRIORITY_QUERY,
     wrap_embedding_func_with_attrs,
     convert_response_to_json,
     always_get_an_event_loop,
@@ -50,8 +64,11 @@ from .base import (
     BaseGraphStorage,
     BaseKVStorage,
     BaseVectorStorage,
+    LazyStorage,
     StorageNameSpace,
     QueryParam,
+    VideoScope,
+    open_storages,
 )
 from ._videoutil import(
     split_video,
@@ -128,6 +145,10 @@ class VideoRAG:
     # graph mode
     enable_local: bool = True
     enable_naive_rag: bool = True
+    # BM25 over chunk text, fused with the dense chunk search; off by default,
+    # lexical hits keep the chunk context non-empty for off-topic questions
+    # more often than the dense threshold alone
+    enable_lexical_retrieval: bool = False
 
     # text chunking
     chunk_func: Callable[
@@ -149,17 +170,39 @@ class VideoRAG:
 
     # Change to your LLM provider
     llm: LLMConfig = field(default_factory=openai_config)
+    # "host:port" of an LLMScheduler that limits model calls across processes
+    llm_scheduler_address: str = None
     
     # entity extraction
     entity_extraction_func: callable = extract_entities
+    # answer the extraction calls through an OpenAI-compatible batch API, for
+    # bulk ingestion that can wait for the jobs; the kwargs go to BatchCompletion
+    # (base_url, api_key, poll_interval, completion_window, ...)
+    entity_extract_batch_mode: bool = False
+    entity_extract_batch_kwargs: dict = field(default_factory=dict)
     
     # storage
-    key_string_value_json_storage_cls: Type[BaseKVStorage] = JsonKVStorage
+    key_string_value_json_storage_cls: Type[BaseKVStorage] = SqliteKVStorage
+    # written after every completion, so it gets an append-only store
+    llm_cache_storage_cls: Type[BaseKVStorage] = LogKVStorage
+    llm_cache_storage_cls_kwargs: dict = field(default_factory=dict)
     vector_db_storage_cls: Type[BaseVectorStorage] = NanoVectorDBStorage
     vs_vector_db_storage_cls: Type[BaseVectorStorage] = NanoVectorDBVideoSegmentStorage
     vector_db_storage_cls_kwargs: dict = field(default_factory=dict)
+    vs_vector_db_storage_cls_kwargs: dict = field(default_factory=dict)
     graph_storage_cls: Type[BaseGraphStorage] = NetworkXStorage
+    graph_storage_cls_kwargs: dict = field(default_factory=dict)
+    lexical_storage_cls: Type[StorageNameSpace] = BM25Storage
+    lexical_storage_cls_kwargs: dict = field(default_factory=dict)
     enable_llm_cache: bool = True
+    # shared by all sessions, so it lives outside working_dir
+    enable_embedding_cache: bool = True
+    embedding_cache_path: str = field(
+        default_factory=lambda: os.getenv(
+            "VIDEORAG_EMBEDDING_CACHE",
+            os.path.join(os.path.expanduser("~"), ".cache", "videorag", "embeddings.sqlite"),
+        )
+    )
 
     # extension
     always_create_working_dir: bool = True
@@ -201,67 +244,146 @@ class VideoRAG:
             logger.info(f"Creating working directory {self.working_dir}")
             os.makedirs(self.working_dir)
 
-        self.video_path_db = self.key_string_value_json_storage_cls(
+        # every store opens on first use (see LazyStorage), so a request only
+        # loads what it touches
+        self.video_path_db = LazyStorage("video_path", lambda: self.key_string_value_json_storage_cls(
             namespace="video_path", global_config=asdict(self)
-        )
+        ))
         
-        self.video_segments = self.key_string_value_json_storage_cls(
+        self.video_segments = LazyStorage("video_segments", lambda: self.key_string_value_json_storage_cls(
             namespace="video_segments", global_config=asdict(self)
-        )
+        ))
 
-        self.text_chunks = self.key_string_value_json_storage_cls(
+        self.text_chunks = LazyStorage("text_chunks", lambda: self.key_string_value_json_storage_cls(
             namespace="text_chunks", global_config=asdict(self)
-        )
+        ))
+
+        # videos whose chunks are committed, so later inserts can skip them
+        self.inserted_videos = LazyStorage("inserted_videos", lambda: self.key_string_value_json_storage_cls(
+            namespace="inserted_videos", global_config=asdict(self)
+        ))
 
         self.llm_response_cache = (
-            self.key_string_value_json_storage_cls(
+            LazyStorage("llm_response_cache", lambda: self.llm_cache_storage_cls(
                 namespace="llm_response_cache", global_config=asdict(self)
-            )
+            ))
             if self.enable_llm_cache
             else None
         )
 
-        self.chunk_entity_relation_graph = self.graph_storage_cls(
+        self.chunk_entity_relation_graph = LazyStorage("chunk_entity_relation", lambda: self.graph_storage_cls(
             namespace="chunk_entity_relation", global_config=asdict(self)
-        )
+        ))
+
+        self.entity_chunk_index = LazyStorage("entity_chunk", lambda: EntityChunkIndex(
+            namespace="entity_chunk", global_config=asdict(self)
+        ))
 
-        self.embedding_func = limit_async_func_call(self.llm.embedding_func_max_async)(wrap_embedding_func_with_attrs(
+        self.embedding_cache = (
+            EmbeddingCache(self.embedding_cache_path)
+            if self.enable_embedding_cache
+            else None
+        )
+        # cache hits never reach the batcher, which packs the misses into
+        # provider-sized requests and owns the embedding concurrency
+        max_inputs, max_tokens = embedding_request_limits(self.llm)
+        # with a shared scheduler, every process draws on the same model slots
+        self.llm_scheduler = (
+            SchedulerClient(
+                self.llm_scheduler_address,
+                session=os.path.basename(os.path.abspath(self.working_dir)),
+            )
+            if self.llm_scheduler_address
+            else None
+        )
+        # the batcher halves its concurrency on 429, so the provider call
+        # must not retry rate limits underneath it
+        embedding_func = replace(
+            self.llm.embedding_func, func=without_rate_limit_retry(self.llm.embedding_func.func)
+        )
+        if self.llm_scheduler is not None:
+            embedding_func = schedule_async_func_call(
+                self.llm_scheduler,
+                f"embedding:{self.llm.embedding_model_name}",
+                self.llm.embedding_func_max_async,
+            )(embedding_func)
+        self.embedding_batcher = EmbeddingBatcher(
+            embedding_func,
+            max_inputs=max_inputs,
+            max_tokens=max_tokens,
+            max_async=self.llm.embedding_func_max_async,
+        )
+        self.embedding_func = wrap_embedding_func_with_attrs(
                 embedding_dim = self.llm.embedding_dim,
                 max_token_size = self.llm.embedding_max_token_size,
-                model_name = self.llm.embedding_model_name)(self.llm.embedding_func))
+                model_name = self.llm.embedding_model_name,
+                cache = self.embedding_cache)(self.embedding_batcher)
         self.entities_vdb = (
-            self.vector_db_storage_cls(
+            LazyStorage("entities", lambda: self.vector_db_storage_cls(
                 namespace="entities",
                 global_config=asdict(self),
                 embedding_func=self.embedding_func,
                 meta_fields={"entity_name"},
-            )
+            ))
             if self.enable_local
             else None
         )
         self.chunks_vdb = (
-            self.vector_db_storage_cls(
+            LazyStorage("chunks", lambda: self.vector_db_storage_cls(
                 namespace="chunks",
                 global_config=asdict(self),
                 embedding_func=self.embedding_func,
-            )
+            ))
             if self.enable_naive_rag
             else None
         )
+        self.chunks_lexical = (
+            LazyStorage("chunks_lexical", lambda: self.lexical_storage_cls(
+                namespace="chunks",
+                global_config=asdict(self),
+            ))
+            if self.enable_naive_rag and self.enable_lexical_retrieval
+            else None
+        )
         
-        self.video_segment_feature_vdb = (
-            self.vs_vector_db_storage_cls(
+        self.video_segment_feature_vdb = LazyStorage("video_segment_feature", lambda: self.vs_vector_db_storage_cls(
                 namespace="video_segment_feature",
                 global_config=asdict(self),
                 embedding_func=None, # we code the embedding process inside the insert() function.
-            )
-        )
+            ))
         
-        self.llm.best_model_func = limit_async_func_call(self.llm.best_model_max_async)(
-            partial(self.llm.best_model_func, hashing_kv=self.llm_response_cache)
+        # models with an RPM/TPM quota are also paced by a token bucket, and
+        # with a shared scheduler every process draws on the same model slots;
+        # the completion functions consult both only after a cache miss
+        best_rate_limiter, cheap_rate_limiter = model_rate_limiters(self.llm)
+        best_model_func = partial(
+            self.llm.best_model_func,
+            hashing_kv=self.llm_response_cache,
+            **({"rate_limiter": best_rate_limiter} if best_rate_limiter else {}),
+            **({"scheduler_slot": SchedulerSlot(
+                self.llm_scheduler, self.llm.best_model_name, self.llm.best_model_max_async
+            )} if self.llm_scheduler is not None else {}),
+        )
+        cheap_model_func = partial(
+            self.llm.cheap_model_func,
+            hashing_kv=self.llm_response_cache,
+            **({"rate_limiter": cheap_rate_limiter} if cheap_rate_limiter else {}),
+            **({"scheduler_slot": SchedulerSlot(
+                self.llm_scheduler, self.llm.cheap_model_name, self.llm.cheap_model_max_async
+            )} if self.llm_scheduler is not None else {}),
         )
-        self.llm.cheap_model_func = limit_async_func_call(self.llm.cheap_model_max_async)(
-            partial(self.llm.cheap_model_func, hashing_kv=self.llm_response_cache)
+        self.llm.best_model_func = limit_async_func_call(self.llm.best_model_max_async)(best_model_func)
+        self.llm.cheap_model_func = limit_async_func_call(self.llm.cheap_model_max_async)(cheap_model_func)
+        self.entity_extract_batch = (
+            BatchCompletion(
+                self.llm.best_model_name,
+                self.working_dir,
+                hashing_kv=self.llm_response_cache,
+                fallback_func=self.llm.best_model_func,
+                **self.entity_extract_batch_kwargs,
+            )
+            if self.entity_extract_batch_mode
+            else None
         )
 
         # 初始化字幕模型 - 确保查询时有caption_model可用
@@ -272,7 +394,7 @@ class VideoRAG:
         for video_path in video_path_list:
             # Step0: check the existence
             video_name = os.path.basename(video_path).split('.')[0]
-            if video_name in self.video_segments._data:
+            if not loop.run_until_complete(self.video_segments.filter_keys([video_name])):
                 logger.info(f"Find the video named {os.path.basename(video_path)} in storage and skip it.")
                 if progress_callback:
                     progress_callback("Video Skipped", f"Video {video_name} already exists, skipping", video_path)
@@ -430,7 +552,13 @@ class VideoRAG:
             if progress_callback:
                 progress_callback("One Video Completed", f"Video processing completed: {video_name}", video_path)
         
-        loop.run_until_complete(self.ainsert(self.video_segments._data))
+        # only videos not inserted yet are chunked: the ones added above, and any
+        # whose insert did not finish in an earlier run
+        stored_videos = loop.run_until_complete(self.video_segments.all_keys())
+        video_names = sorted(loop.run_until_complete(self.inserted_videos.filter_keys(stored_videos)))
+        if video_names:
+            new_segments = loop.run_until_complete(self.video_segments.get_by_ids(video_names))
+            loop.run_until_complete(self.ainsert(dict(zip(video_names, new_segments))))
 
         # Final completion callback
         if progress_callback:
@@ -508,7 +636,80 @@ class VideoRAG:
         loop = always_get_an_event_loop()
         return loop.run_until_complete(self.aquery(query, param))
 
-    async def aquery(self, query: str, param: QueryParam = QueryParam()):
+    def query_batch(
+        self,
+        queries: list[str],
+        param: QueryParam = QueryParam(),
+        max_concurrent: int = 1,
+        on_response: Callable = None,
+    ):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(
+            self.aquery_batch(queries, param, max_concurrent, on_response)
+        )
+
+    @with_llm_priority(LLM_PRIORITY_QUERY)
+    async def _retrieve(self, queries: list[str], param: QueryParam):
+        await open_storages(
+            self.entities_vdb,
+            self.chunks_vdb,
+            self.chunks_lexical,
+            self.video_segment_feature_vdb,
+        )
+        if self.chunks_lexical is not None and not len(self.chunks_lexical):
+            # sessions ingested before the lexical index existed
+            chunk_keys = await self.text_chunks.all_keys()
+            if chunk_keys:
+                logger.info(f"Building the lexical index over {len(chunk_keys)} chunks")
+                chunks = await self.text_chunks.get_by_ids(chunk_keys)
+                await self.chunks_lexical.upsert(
+                    {k: v for k, v in zip(chunk_keys, chunks) if v is not None}
+                )
+                await self.chunks_lexical.index_done_callback()
+        return await videorag_retrieve(
+            queries,
+            self.entities_vdb,
+            self.chunks_vdb,
+            self.video_segment_feature_vdb,
+            param,
+            asdict(self),
+            chunks_lexical=self.chunks_lexical,
+        )
+
+    @with_llm_priority(LLM_PRIORITY_QUERY)
+    async def aquery_batch(
+        self,
+        queries: list[str],
+        param: QueryParam = QueryParam(),
+        max_concurrent: int = 1,
+        on_response: Callable = None,
+    ):
+        """Answer several queries, searching each vector storage once for all of them.
+
+        Answers (LLM calls and segment captioning) are generated
+        `max_concurrent` at a time and handed to `on_response(index, response)`
+        as each one finishes. A query that fails gets its exception in place
+        of its answer, the others are still answered."""
+        retrievals = await self._retrieve(queries, param)
+        semaphore = asyncio.Semaphore(max(1, max_concurrent))
+
+        async def answer(index: int):
+            async with semaphore:
+                try:
+                    response = await self.aquery(queries[index], param, retrieval=retrievals[index])
+                except Exception as e:
+                    logger.error(f"Query {index} failed: {e}")
+                    response = e
+            if on_response is not None:
+                on_response(index, response)
+            return response
+
+        return await asyncio.gather(*[answer(i) for i in range(len(queries))])
+
+    @with_llm_priority(LLM_PRIORITY_QUERY)
+    async def aquery(self, query: str, param: QueryParam = QueryParam(), retrieval: dict = None):
+        if retrieval is None:
+            retrieval = (await self._retrieve([query], param))[0]
         if param.mode == "videorag":
             response = await videorag_query(
                 query,
@@ -523,6 +724,8 @@ class VideoRAG:
                 self.caption_tokenizer,
                 param,
                 asdict(self),
+                self.entity_chunk_index,
+                retrieval,
             )
         # NOTE: update here
         elif param.mode == "videorag_multiple_choice":
@@ -539,6 +742,8 @@ class VideoRAG:
                 self.caption_tokenizer,
                 param,
                 asdict(self),
+                self.entity_chunk_index,
+                retrieval,
             )
         else:
             raise ValueError(f"Unknown mode {param.mode}")
@@ -546,6 +751,16 @@ class VideoRAG:
         return response
 
     async def ainsert(self, new_video_segment):
+        await open_storages(
+            self.text_chunks,
+            self.llm_response_cache,
+            self.entities_vdb,
+            self.chunks_vdb,
+            self.chunks_lexical,
+            self.chunk_entity_relation_graph,
+            self.entity_chunk_index,
+            self.inserted_videos,
+        )
         await self._insert_start()
         try:
             # ---------- chunking
@@ -562,11 +777,14 @@ class VideoRAG:
             }
             if not len(inserting_chunks):
                 logger.warning(f"All chunks are already in the storage")
+                await self._mark_inserted(new_video_segment)
                 return
             logger.info(f"[New Chunks] inserting {len(inserting_chunks)} chunks")
             if self.enable_naive_rag:
                 logger.info("Insert chunks for naive RAG")
                 await self.chunks_vdb.upsert(inserting_chunks)
+                if self.chunks_lexical is not None:
+                    await self.chunks_lexical.upsert(inserting_chunks)
 
             # TODO: no incremental update for communities now, so just drop all
             # await self.community_reports.drop()
@@ -582,6 +800,8 @@ class VideoRAG:
                 "cheap_model_func": self.llm.cheap_model_func,
                 "embedding_func": self.llm.embedding_func,
             }
+            if self.entity_extract_batch is not None:
+                global_config["llm"]["best_model_func"] = self.entity_extract_batch
 
             # 验证配置完整性并修复缺失字段
             global_config = self._validate_and_fix_global_config(global_config)
@@ -591,6 +811,7 @@ class VideoRAG:
                 knowledge_graph_inst=self.chunk_entity_relation_graph,
                 entity_vdb=self.entities_vdb,
                 global_config=global_config,
+                chunk_index=self.entity_chunk_index,
             )
             if maybe_new_kg is None:
                 logger.warning("No new entities found")
@@ -598,9 +819,18 @@ class VideoRAG:
             self.chunk_entity_relation_graph = maybe_new_kg
             # ---------- commit upsertings and indexing
             await self.text_chunks.upsert(inserting_chunks)
+            await self._mark_inserted(new_video_segment)
         finally:
             await self._insert_done()
 
+    async def _mark_inserted(self, new_video_segment):
+        await self.inserted_videos.upsert(
+            {
+                video_name: {"segments": len(segments)}
+                for video_name, segments in new_video_segment.items()
+            }
+        )
+
     async def _insert_start(self):
         tasks = []
         for storage_inst in [
@@ -627,10 +857,13 @@ class VideoRAG:
         tasks = []
         for storage_inst in [
             self.text_chunks,
+            self.inserted_videos,
             self.llm_response_cache,
             self.entities_vdb,
             self.chunks_vdb,
+            self.chunks_lexical,
             self.chunk_entity_relation_graph,
+            self.entity_chunk_index,
             self.video_segment_feature_vdb,
             self.video_segments,
             self.video_path_db,
@@ -639,6 +872,25 @@ class VideoRAG:
                 continue
             tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
         await asyncio.gather(*tasks)
+        if self.embedding_cache is not None:
+            stats = self.embedding_cache.stats()
+            logger.info(
+                f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)"
+            )
+        for name, func in [
+            ("best_model_func", self.llm.best_model_func),
+            ("cheap_model_func", self.llm.cheap_model_func),
+        ]:
+            for priority, stats in func.limiter.stats().items():
+                logger.info(
+                    f"{name} {priority} calls: {stats['calls']}, queue wait "
+                    f"mean {stats['mean_wait']:.2f}s max {stats['max_wait']:.2f}s"
+                )
+        if self.embedding_batcher.rate_limited:
+            logger.info(
+                f"Embedding requests rate limited {self.embedding_batcher.rate_limited} times, "
+                f"concurrency now {self.embedding_batcher.limit}/{self.embedding_batcher.max_async}"
+            )
 
     async def _query_done(self):
         tasks = []
@@ -646,6 +898,8 @@ class VideoRAG:
             if storage_inst is None:
                 continue
             tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
+        # keeps what the query backfilled into the entity-chunk index
+        tasks.append(cast(StorageNameSpace, self.entity_chunk_index).query_done_callback())
         await asyncio.gather(*tasks)
 
     def _validate_and_fix_global_config(self, global_config):
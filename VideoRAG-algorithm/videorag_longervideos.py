@@ -64,14 +64,19 @@ if __name__ == '__main__':
     
     collection_id = sub_category.split('-')[0]
     querys = longervideos[collection_id][0]['questions']
-    for i in range(len(querys)):
-        query_id = querys[i]['id']
-        query = querys[i]['question']
-        param = QueryParam(mode="videorag")
-        param.wo_reference = True
-        print("Query: ", query)
-        
-        response = videorag.query(query=query, param=param)
+    param = QueryParam(mode="videorag")
+    param.wo_reference = True
+
+    def write_answer(index, response):
+        q = querys[index]
+        print("Query: ", q['question'])
+        if isinstance(response, Exception):
+            print(f"Failed: {response}")
+            return
         print(response)
-        with open(os.path.join(answer_folder, f'answer_{query_id}.md'), 'w') as f:
+        with open(os.path.join(answer_folder, f'answer_{q["id"]}.md'), 'w') as f:
             f.write(response)
+
+    # the vector searches for all questions of the collection run as one batch,
+    # the answers are generated one by one and written as they finish
+    videorag.query_batch([q['question'] for q in querys], param=param, on_response=write_answer)
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark for the ImageBind embedding transport.
+
+Compares the legacy route (pickle -> base64 -> JSON) with the binary route
+(raw little-endian float32 body + shape headers) on bytes moved and
+serialize/deserialize latency. With --server-url and --video the same
+comparison is also run end-to-end against a live /api/imagebind/encode/video.
+
+    python benchmarks/bench_imagebind_transport.py
+    python benchmarks/bench_imagebind_transport.py --server-url http://localhost:64451 --video seg_0.mp4 seg_1.mp4
+"""
+
+import argparse
+import base64
+import json
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from videorag._utils import ndarray_from_bytes, ndarray_to_bytes
+
+
+def json_roundtrip(array):
+    body = json.dumps({
+        "success": True,
+        "result": base64.b64encode(pickle.dumps(array)).decode("utf-8"),
+        "shape": array.shape,
+        "dtype": str(array.dtype),
+    }).encode("utf-8")
+    decoded = pickle.loads(base64.b64decode(json.loads(body)["result"]))
+    return len(body), decoded
+
+
+def binary_roundtrip(array):
+    body, headers = ndarray_to_bytes(array)
+    decoded = ndarray_from_bytes(body, headers)
+    header_bytes = sum(len(k) + len(v) + 4 for k, v in headers.items())
+    return len(body) + header_bytes, decoded
+
+
+def bench_codec(shapes, repeat):
+    print(f"{'shape':>12} | {'json bytes':>10} {'json ms':>8} | {'bin bytes':>10} {'bin ms':>8}")
+    for shape in shapes:
+        array = np.random.rand(*shape).astype(np.float32)
+        row = [f"{str(shape):>12}"]
+        for roundtrip in (json_roundtrip, binary_roundtrip):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                size, decoded = roundtrip(array)
+            elapsed = (time.perf_counter() - start) / repeat * 1000
+            assert np.array_equal(decoded, array)
+            row.append(f"{size:>10} {elapsed:>8.3f}")
+        print(" | ".join(row))
+
+
+def bench_server(server_url, video_batch, repeat):
+    import requests
+
+    from videorag._utils import NDARRAY_CONTENT_TYPE
+
+    for transport, accept in (("json", "application/json"), ("binary", NDARRAY_CONTENT_TYPE)):
+        session = requests.Session()
+        session.headers.update({"Content-Type": "application/json", "Accept": accept})
+        timings, size = [], 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = session.post(
+                f"{server_url.rstrip('/')}/api/imagebind/encode/video",
+                json={"video_batch": video_batch},
+                timeout=1800,
+            )
+            response.raise_for_status()
+            if transport == "binary":
+                ndarray_from_bytes(response.content, response.headers)
+            else:
+                pickle.loads(base64.b64decode(response.json()["result"]))
+            timings.append(time.perf_counter() - start)
+            size = len(response.content)
+        print(f"{transport:>6}: {size} bytes, median {np.median(timings) * 1000:.1f} ms over {repeat} runs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--server-url", default=None)
+    parser.add_argument("--video", nargs="*", default=[])
+    args = parser.parse_args()
+
+    bench_codec([(1, 1024), (2, 1024), (32, 1024), (512, 1024)], args.repeat)
+    if args.server_url and args.video:
+        bench_server(args.server_url, args.video, max(1, args.repeat // 50))
@@ -15,13 +15,18 @@ try:
     videorag_module = importlib.util.module_from_spec(spec)
     sys.modules["videorag_algorithm_module"] = videorag_module
     spec.loader.exec_module(videorag_module)
+    # the resolved algorithm package, for modules here that share its code
+    algorithm_module = videorag_module
     VideoRAG = videorag_module.VideoRAG
     QueryParam = videorag_module.QueryParam
+    LLMScheduler = videorag_module.LLMScheduler
 except Exception as e:
     # Fallback: try importing directly
     try:
         import VideoRAG_algorithm.videorag
+        algorithm_module = VideoRAG_algorithm.videorag
         VideoRAG = VideoRAG_algorithm.videorag.VideoRAG
         QueryParam = VideoRAG_algorithm.videorag.QueryParam
+        LLMScheduler = VideoRAG_algorithm.videorag.LLMScheduler
     except Exception as e2:
         raise ImportError(f"Failed to import VideoRAG from algorithm implementation: {e}, fallback failed: {e2}")
\ No newline at end of file
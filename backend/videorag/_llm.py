@@ -10,8 +10,9 @@ from tenacity import (
     retry_if_exception_type,
 )
 import os
+from contextlib import asynccontextmanager
 
-from ._utils import compute_args_hash, wrap_embedding_func_with_attrs
+from ._utils import compute_args_hash, encode_string_by_tiktoken, wrap_embedding_func_with_attrs
 from .base import BaseKVStorage
 from ._utils import EmbeddingFunc
 
@@ -63,6 +64,15 @@ class LLMConfig:
     caption_model_name: str
     caption_model_max_async: int
 
+    # Provider quotas per model in requests / tokens per minute, None leaves
+    # that dimension unmetered (see the algorithm's model_rate_limiters)
+    best_model_rpm: int = None
+    best_model_tpm: int = None
+    cheap_model_rpm: int = None
+    cheap_model_tpm: int = None
+    # completion tokens reserved for a call that does not pass max_tokens
+    expected_completion_tokens: int = 512
+
     # Assigned in post init
     embedding_func: EmbeddingFunc  = None    
     best_model_func: callable = None    
@@ -89,6 +99,40 @@ class LLMConfig:
             self.caption_model_name, content_list, *args, **kwargs
         )
 
+async def _acquire_quota(rate_limiter, messages: list[dict], kwargs: dict):
+    """Wait until the model's quota admits the call; returns the reservation
+    for _settle_quota"""
+    if rate_limiter is None:
+        return None
+    prompt_tokens = sum(len(encode_string_by_tiktoken(str(m["content"]))) for m in messages)
+    reserved = prompt_tokens + kwargs.get("max_tokens", rate_limiter.expected_completion_tokens)
+    await rate_limiter.acquire(reserved)
+    return prompt_tokens, reserved
+
+
+def _settle_quota(rate_limiter, reservation, content: str):
+    if reservation is None:
+        return
+    prompt_tokens, reserved = reservation
+    rate_limiter.settle(prompt_tokens + len(encode_string_by_tiktoken(content or "")) - reserved)
+
+
+def _refund_quota(rate_limiter, reservation):
+    """Return the tokens of a failed call, which the retry reserves again"""
+    if reservation is None:
+        return
+    rate_limiter.settle(-reservation[1])
+
+
+@asynccontextmanager
+async def _scheduled(scheduler_slot):
+    """Hold a slot of the shared LLM scheduler, if any, for one provider call"""
+    if scheduler_slot is None:
+        yield
+        return
+    async with scheduler_slot.held():
+        yield
+
 ##### OpenAI Configuration
 @retry(
     stop=stop_after_attempt(5),
@@ -100,6 +144,10 @@ async def openai_complete_if_cache(
 ) -> str:
     openai_async_client = get_openai_async_client_instance(kwargs["global_config"])
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    # the model's TokenBucketLimiter, passed in by VideoRAG when it has a quota
+    rate_limiter = kwargs.pop("rate_limiter", None)
+    # the algorithm's SchedulerSlot, passed in by VideoRAG with a shared scheduler
+    scheduler_slot = kwargs.pop("scheduler_slot", None)
     # Remove global_config from kwargs as it's not needed for OpenAI API call
     kwargs.pop("global_config", None)
     
@@ -115,9 +163,16 @@ async def openai_complete_if_cache(
         if if_cache_return is not None and if_cache_return["return"] is not None:
             return if_cache_return["return"]
 
-    response = await openai_async_client.chat.completions.create(
-        model=model, messages=messages, **kwargs
-    )
+    async with _scheduled(scheduler_slot):
+        reservation = await _acquire_quota(rate_limiter, messages, kwargs)
+        try:
+            response = await openai_async_client.chat.completions.create(
+                model=model, messages=messages, **kwargs
+            )
+        except BaseException:
+            _refund_quota(rate_limiter, reservation)
+            raise
+        _settle_quota(rate_limiter, reservation, response.choices[0].message.content)
 
     if hashing_kv is not None:
         await hashing_kv.upsert(
@@ -150,7 +205,7 @@ async def openai_embedding(model_name: str, texts: list[str], **kwargs) -> np.nd
     response = await openai_async_client.embeddings.create(
         model=model_name, input=texts, encoding_format="float", **kwargs
     )
-    return np.array([dp.embedding for dp in response.data])
+    return np.array([dp.embedding for dp in response.data], dtype=np.float32)
 
 @retry(
     stop=stop_after_attempt(5),
@@ -165,16 +220,18 @@ async def dashscope_caption_complete(
     content_list: list of {"type": "image_url", "image_url": {"url": "..."}} and {"type": "text", "text": "..."}
     """
     dashscope_async_client = get_dashscope_async_client_instance(kwargs["global_config"])
+    scheduler_slot = kwargs.pop("scheduler_slot", None)
     
     messages = [
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": content_list}
     ]
     
-    response = await dashscope_async_client.chat.completions.create(
-        model=model_name, 
-        messages=messages, 
-    )
+    async with _scheduled(scheduler_slot):
+        response = await dashscope_async_client.chat.completions.create(
+            model=model_name, 
+            messages=messages, 
+        )
     
     return response.choices[0].message.content
 
@@ -250,7 +307,7 @@ async def dashscope_embedding(model_name: str, texts: list[str]) -> np.ndarray:
     )
 
     # 提取embeddings并返回numpy数组
-    return np.array([dp.embedding for dp in response.data])
+    return np.array([dp.embedding for dp in response.data], dtype=np.float32)
 
 # 全局配置设置函数
 def set_dashscope_embedding_config(config: dict):
@@ -272,3 +272,27 @@ class SerializableLLMWrapper:
         if self.hashing_kv is not None:
             kwargs['hashing_kv'] = self.hashing_kv
         return await self.llm_func(*args, **kwargs)
+
+
+# Binary array transport ------------------------------------------------------------
+NDARRAY_CONTENT_TYPE = "application/x-ndarray"
+
+
+def ndarray_to_bytes(array) -> tuple[bytes, dict]:
+    """Serialize an array as a raw little-endian float32 body plus shape headers"""
+    array = np.ascontiguousarray(array, dtype="<f4")
+    headers = {
+        "Content-Type": NDARRAY_CONTENT_TYPE,
+        "X-Array-Shape": ",".join(str(d) for d in array.shape),
+        "X-Array-Dtype": array.dtype.str,
+    }
+    return array.tobytes(), headers
+
+
+def ndarray_from_bytes(body: bytes, headers) -> np.ndarray:
+    """Inverse of ndarray_to_bytes. The array is copied out of the body:
+    np.frombuffer views over bytes are read-only, and callers normalise the
+    embeddings in place like the ones decoded from JSON."""
+    dtype = np.dtype(headers.get("X-Array-Dtype", "<f4"))
+    shape = tuple(int(d) for d in headers["X-Array-Shape"].split(",") if d)
+    return np.frombuffer(body, dtype=dtype).reshape(shape).copy()
@@ -1,3 +1,4 @@
+import importlib
 import os
 import torch
 import pickle
@@ -7,6 +8,17 @@ from imagebind.models import imagebind_model
 from imagebind.models.imagebind_model import ImageBindModel, ModalityType
 
 
+# the checkpoint loader is shared with the algorithm package, imported
+# under whichever name videorag/__init__.py resolved it
+from .. import algorithm_module
+
+_algorithm_feature = importlib.import_module(f"{algorithm_module.__name__}._videoutil.feature")
+IMAGEBIND_HUGE_KWARGS = _algorithm_feature.IMAGEBIND_HUGE_KWARGS
+convert_imagebind_checkpoint = _algorithm_feature.convert_imagebind_checkpoint
+load_imagebind_huge = _algorithm_feature.load_imagebind_huge
+mmap_checkpoint_path = _algorithm_feature.mmap_checkpoint_path
+
+
 def encode_video_segments(video_paths, embedder: ImageBindModel):
     device = next(embedder.parameters()).device
     inputs = {
@@ -17,7 +17,7 @@ import json
 import signal
 import atexit
 import psutil
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from moviepy import VideoFileClip
 import logging
@@ -98,7 +98,8 @@ def sync_config_to_env(config):
         raise
 
 from videorag._llm import LLMConfig, openai_embedding, dashscope_embedding, gpt_complete, dashscope_caption_complete, set_dashscope_embedding_config
-from videorag import VideoRAG, QueryParam
+from videorag._utils import NDARRAY_CONTENT_TYPE, ndarray_to_bytes, ndarray_from_bytes
+from videorag import VideoRAG, QueryParam, LLMScheduler
 
 # Configure supported video formats
 ALLOWED_EXTENSIONS = {'mp4', 'webm', 'ogg', 'mov', 'avi', 'mkv'}
@@ -556,25 +557,12 @@ class GlobalImageBindManager:
             try:
                 log_to_file("🔄 Loading ImageBind model...")
                 
-                import torch
-                from imagebind.models.imagebind_model import ImageBindModel
                 from videorag._utils import get_imagebind_device
+                from videorag._videoutil import load_imagebind_huge
                 
                 device = get_imagebind_device()
                 log_to_file(f"📍 Using device for ImageBind: {device}")
                 
-                self.embedder = ImageBindModel(
-                    vision_embed_dim=1280,
-                    vision_num_blocks=32,
-                    vision_num_heads=16,
-                    text_embed_dim=1024,
-                    text_num_blocks=24,
-                    text_num_heads=16,
-                    out_embed_dim=1024,
-                    audio_drop_path=0.1,
-                    imu_drop_path=0.7,
-                )
-                
                 # 处理模型路径：如果是目录，则拼接imagebind.pth；如果是文件，直接使用
                 model_file_path = self.model_path
                 if os.path.isdir(self.model_path):
@@ -584,10 +572,9 @@ class GlobalImageBindManager:
                 if not os.path.exists(model_file_path):
                     raise FileNotFoundError(f"ImageBind model not found at: {model_file_path}")
 
-                self.embedder.load_state_dict(torch.load(model_file_path, map_location=device))
-                log_to_file(f"📄 加载ImageBind模型文件: {model_file_path}")
-                self.embedder = self.embedder.to(device)
-                self.embedder.eval()
+                load_started = time.time()
+                self.embedder = load_imagebind_huge(model_file_path, device)
+                log_to_file(f"📄 加载ImageBind模型文件: {model_file_path} ({time.time() - load_started:.1f}s, memory-mapped)")
                 
                 self.model_config.update({
                     "device": str(device),
@@ -679,35 +666,55 @@ class GlobalImageBindManager:
             log_to_file("🧹 ImageBind manager cleaned up")
 
 class HTTPImageBindClient:
-    """HTTP client, used for subprocess access to ImageBind service"""
+    """HTTP client, used for subprocess access to ImageBind service
+
+    transport="binary" asks the service for raw little-endian float32 bodies
+    with shape headers; transport="json" keeps the legacy pickle+base64 route.
+    """
     
-    def __init__(self, base_url: str = "http://localhost:64451"):
+    def __init__(self, base_url: str = "http://localhost:64451", transport: str = "binary"):
+        if transport not in ("binary", "json"):
+            raise ValueError(f"Unknown ImageBind transport: {transport}")
         self.base_url = base_url.rstrip('/')
+        self.transport = transport
         self.session = requests.Session()
         self.session.headers.update({'Content-Type': 'application/json'})
+        if transport == "binary":
+            self.session.headers.update({'Accept': NDARRAY_CONTENT_TYPE})
+
+    def _post_encode(self, endpoint: str, payload: dict) -> np.ndarray:
+        response = self.session.post(
+            f"{self.base_url}/api/imagebind/encode/{endpoint}",
+            json=payload,
+            timeout=1800  # 30min timeout
+        )
+        
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text}")
+
+        if response.headers.get('Content-Type', '').startswith(NDARRAY_CONTENT_TYPE):
+            return ndarray_from_bytes(response.content, response.headers)
+
+        result = response.json()
+        if not result.get("success"):
+            raise RuntimeError(f"API error: {result.get('error')}")
+
+        # Client and service ship together, so never unpickle in binary mode
+        if self.transport == "binary":
+            raise RuntimeError(
+                f"Expected a {NDARRAY_CONTENT_TYPE} body, got "
+                f"{response.headers.get('Content-Type', 'no content type')}"
+            )
+        
+        # Decode base64 string back to numpy array
+        result_bytes = base64.b64decode(result["result"])
+        return pickle.loads(result_bytes)
         
     def encode_video_segments(self, video_batch: List[str]) -> np.ndarray:
         """Encode video segments"""
         try:
-            response = self.session.post(
-                f"{self.base_url}/api/imagebind/encode/video",
-                json={"video_batch": video_batch},
-                timeout=1800  # 30min timeout
-            )
-            
-            if response.status_code != 200:
-                raise RuntimeError(f"HTTP {response.status_code}: {response.text}")
-                
-            result = response.json()
-            if not result.get("success"):
-                raise RuntimeError(f"API error: {result.get('error')}")
-            
-            # Decode base64 string back to numpy array
-            result_b64 = result["result"]
-            result_bytes = base64.b64decode(result_b64)
-            embeddings = pickle.loads(result_bytes)
-            log_to_file(f"Received embeddings: {embeddings}")
-            
+            embeddings = self._post_encode("video", {"video_batch": video_batch})
+            log_to_file(f"Received embeddings: shape={embeddings.shape}, dtype={embeddings.dtype}")
             return embeddings
             
         except Exception as e:
@@ -717,25 +724,7 @@ class HTTPImageBindClient:
     def encode_string_query(self, query: str) -> np.ndarray:
         """Encode string query"""
         try:
-            response = self.session.post(
-                f"{self.base_url}/api/imagebind/encode/query",
-                json={"query": query},
-                timeout=1800  # 30min timeout
-            )
-            
-            if response.status_code != 200:
-                raise RuntimeError(f"HTTP {response.status_code}: {response.text}")
-                
-            result = response.json()
-            if not result.get("success"):
-                raise RuntimeError(f"API error: {result.get('error')}")
-            
-            # Decode base64 string back to numpy array
-            result_b64 = result["result"]
-            result_bytes = base64.b64decode(result_b64)
-            embeddings = pickle.loads(result_bytes)
-            
-            return embeddings
+            return self._post_encode("query", {"query": query})
             
         except Exception as e:
             log_to_file(f"❌ HTTP client query encoding error: {str(e)}")
@@ -768,6 +757,8 @@ class VideoRAGProcessManager:
     def __init__(self):
         self.global_config = None
         self.running_processes = {}
+        # Indexing and query workers share one set of LLM/embedding limits
+        self.llm_scheduler_address = get_llm_scheduler().address
         
     def set_global_config(self, config):
         """Set global configuration"""
@@ -775,6 +766,11 @@ class VideoRAGProcessManager:
         self.global_config = config
         return True
         
+    def _worker_config(self):
+        """Global config for a worker process, with the address of the LLM
+        scheduler all workers share"""
+        return {**self.global_config, "llm_scheduler_address": self.llm_scheduler_address}
+
     def start_video_indexing(self, chat_id, video_path_list):
         """Start video indexing process - using JSON status file"""
         try:
@@ -801,7 +797,7 @@ class VideoRAGProcessManager:
             # Create video indexing process
             process = multiprocessing.Process(
                 target=index_video_worker_process,
-                args=(chat_id, video_path_list, self.global_config, server_url)
+                args=(chat_id, video_path_list, self._worker_config(), server_url)
             )
             process.start()
             
@@ -838,7 +834,7 @@ class VideoRAGProcessManager:
             # Create query processing process
             process = multiprocessing.Process(
                 target=query_worker_process,
-                args=(chat_id, query, self.global_config, server_url)
+                args=(chat_id, query, self._worker_config(), server_url)
             )
             process.start()
             
@@ -998,6 +994,7 @@ class VideoRAGProcessManager:
 
 global_imagebind_manager = None
 process_manager = None
+llm_scheduler = None
 
 def get_imagebind_manager():
     """Get ImageBind manager, delayed initialization"""
@@ -1006,6 +1003,15 @@ def get_imagebind_manager():
         global_imagebind_manager = GlobalImageBindManager()
     return global_imagebind_manager
 
+def get_llm_scheduler():
+    """Get the LLM scheduler, started on first use in the server process"""
+    global llm_scheduler
+    if llm_scheduler is None:
+        llm_scheduler = LLMScheduler()
+        llm_scheduler.start()
+        log_to_file(f"🚦 LLM scheduler listening on {llm_scheduler.address}")
+    return llm_scheduler
+
 def get_process_manager():
     """Get process manager, delayed initialization"""
     global process_manager
@@ -1192,7 +1198,11 @@ def index_video_worker_process(chat_id, video_path_list, global_config, server_u
             cheap_model_max_async=16,
             caption_model_func_raw=dashscope_caption_complete,
             caption_model_name=global_config.get("caption_model"),
-            caption_model_max_async=3
+            caption_model_max_async=3,
+            best_model_rpm=global_config.get("analysisModelRpm"),
+            best_model_tpm=global_config.get("analysisModelTpm"),
+            cheap_model_rpm=global_config.get("processingModelRpm"),
+            cheap_model_tpm=global_config.get("processingModelTpm"),
         )
 
         # 将额外配置传递给addon_params，避免传递不支持的关键字参数
@@ -1213,6 +1223,7 @@ def index_video_worker_process(chat_id, video_path_list, global_config, server_u
             working_dir=session_working_dir,
             asr_config=asr_config,  # 使用ASR配置对象
             addon_params=addon_params,  # 传递额外配置
+            llm_scheduler_address=global_config.get("llm_scheduler_address"),
         )
 
         # Create module-level progress callback to fix pickle serialization issue
@@ -1315,7 +1326,11 @@ def query_worker_process(chat_id, query, global_config, server_url):
             cheap_model_max_async=16,
             caption_model_func_raw=dashscope_caption_complete,
             caption_model_name=global_config.get("caption_model"),
-            caption_model_max_async=3
+            caption_model_max_async=3,
+            best_model_rpm=global_config.get("analysisModelRpm"),
+            best_model_tpm=global_config.get("analysisModelTpm"),
+            cheap_model_rpm=global_config.get("processingModelRpm"),
+            cheap_model_tpm=global_config.get("processingModelTpm"),
         )
 
         # 设置DashScope嵌入配置
@@ -1348,6 +1363,7 @@ def query_worker_process(chat_id, query, global_config, server_url):
             working_dir=session_working_dir,
             asr_config=asr_config,  # 使用ASR配置对象
             addon_params=addon_params,  # 传递额外配置
+            llm_scheduler_address=global_config.get("llm_scheduler_address"),
         )
 
         log_to_file(f"✅ VideoRAG instance created successfully")
@@ -1410,6 +1426,10 @@ def create_app():
     
     return app
 
+def _wants_binary_response():
+    """Whether the caller asked for a raw float32 body instead of pickled JSON"""
+    return NDARRAY_CONTENT_TYPE in request.headers.get('Accept', '')
+
 def register_routes(app):
     """Register all routes to Flask application"""
     
@@ -1590,6 +1610,10 @@ def register_routes(app):
             # Encode video
             log_to_file(f"🎬 Encoding {video_batch} video segments")
             result = get_imagebind_manager().encode_video_segments(video_batch).numpy()
+            if _wants_binary_response():
+                body, headers = ndarray_to_bytes(result)
+                return Response(body, status=200, headers=headers)
+
             # Convert numpy array to base64 string for transmission
             result_bytes = pickle.dumps(result)
             result_b64 = base64.b64encode(result_bytes).decode('utf-8')
@@ -1624,6 +1648,9 @@ def register_routes(app):
             
             # Encode query
             result = get_imagebind_manager().encode_string_query(query).numpy()
+            if _wants_binary_response():
+                body, headers = ndarray_to_bytes(result)
+                return Response(body, status=200, headers=headers)
             
             # Convert numpy array to base64 string for transmission
             result_bytes = pickle.dumps(result)
@@ -1866,6 +1893,14 @@ def register_routes(app):
 
                     log_to_file(f"✅ ImageBind model downloaded successfully: {target_path}")
 
+                    # 预先转换为可内存映射的权重文件，避免首次加载时再转换
+                    try:
+                        from videorag._videoutil import convert_imagebind_checkpoint
+                        mmap_path = convert_imagebind_checkpoint(target_path)
+                        log_to_file(f"✅ ImageBind checkpoint converted for memory-mapped loading: {mmap_path}")
+                    except Exception as convert_error:
+                        log_to_file(f"⚠️ ImageBind checkpoint conversion skipped: {str(convert_error)}")
+
                 except Exception as e:
                     download_progress['error'] = str(e)
                     download_progress['status'] = 'error'
@@ -2739,6 +2774,8 @@ def cleanup_on_exit():
             process_manager.cleanup()
         if global_imagebind_manager:
             global_imagebind_manager.cleanup()
+        if llm_scheduler:
+            llm_scheduler.stop()
         log_to_file("✅ Cleanup completed")
     except Exception as e:
         log_to_file(f"❌ Error during cleanup: {str(e)}")
@@ -2802,7 +2839,7 @@ if __name__ == '__main__':
 
         # Now it is safe to set multiprocessing start method
         multiprocessing.set_start_method('spawn')
-        
+
         # Note: startup logs are handled by videorag_web_api.py to avoid duplication
         # Validate ASR configuration before starting
         log_to_file("🎤 验证ASR配置...")
@@ -0,0 +1,32 @@
+"""
+Both VideoRAG-algorithm/ and backend/ ship a top-level `videorag` package, and
+the test scripts put either of them on sys.path. These fixtures make `import
+videorag` resolve to the one a test needs, whatever an earlier test imported.
+"""
+
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _use_videorag_from(monkeypatch, root: str):
+    for name in list(sys.modules):
+        if name == "videorag" or name.startswith("videorag."):
+            monkeypatch.delitem(sys.modules, name)
+    monkeypatch.syspath_prepend(os.path.join(HERE, root))
+
+
+@pytest.fixture
+def algorithm_videorag(monkeypatch):
+    """`videorag` is the package in VideoRAG-algorithm/"""
+    _use_videorag_from(monkeypatch, "VideoRAG-algorithm")
+
+
+@pytest.fixture
+def backend_videorag(monkeypatch):
+    """`videorag` is the backend/ package, which loads VideoRAG from the algorithm"""
+    monkeypatch.syspath_prepend(os.path.join(HERE, "VideoRAG-algorithm"))
+    _use_videorag_from(monkeypatch, "backend")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+The backend's LLMConfig under VideoRAG with a shared LLM scheduler, as the API
+server starts its workers: completions go through a scheduler slot and never
+pass it on to the provider client
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, model, messages, **kwargs):
+        self.calls.append(kwargs)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=f"answer from {model}"))]
+        )
+
+
+async def fake_embedding(model_name, texts, **kwargs):
+    return np.zeros((len(texts), 8), dtype=np.float32)
+
+
+def test_backend_completions_take_a_scheduler_slot(tmp_path, monkeypatch, backend_videorag):
+    import videorag._llm as backend_llm
+    from videorag import VideoRAG, LLMScheduler
+    from videorag._llm import LLMConfig, gpt_complete, dashscope_caption_complete
+
+    completions = FakeCompletions()
+    monkeypatch.setattr(
+        backend_llm,
+        "global_openai_async_client",
+        SimpleNamespace(chat=SimpleNamespace(completions=completions)),
+    )
+    monkeypatch.setattr(VideoRAG, "load_caption_model", lambda self, debug=False: None)
+
+    scheduler = LLMScheduler()
+    scheduler.start()
+    try:
+        rag = VideoRAG(
+            llm=LLMConfig(
+                embedding_func_raw=fake_embedding,
+                embedding_model_name="fake-embedding",
+                embedding_dim=8,
+                embedding_max_token_size=8192,
+                embedding_batch_num=32,
+                embedding_func_max_async=4,
+                query_better_than_threshold=0.2,
+                best_model_func_raw=gpt_complete,
+                best_model_name="best-model",
+                best_model_max_token_size=32768,
+                best_model_max_async=4,
+                cheap_model_func_raw=gpt_complete,
+                cheap_model_name="cheap-model",
+                cheap_model_max_token_size=32768,
+                cheap_model_max_async=4,
+                caption_model_func_raw=dashscope_caption_complete,
+                caption_model_name="caption-model",
+                caption_model_max_async=1,
+            ),
+            working_dir=str(tmp_path),
+            llm_scheduler_address=scheduler.address,
+        )
+
+        async def ask_twice():
+            first = await rag.llm.cheap_model_func("hello", global_config={})
+            # the second call is answered by the response cache
+            second = await rag.llm.cheap_model_func("hello", global_config={})
+            return first, second
+
+        assert asyncio.run(ask_twice()) == ("answer from cheap-model",) * 2
+        assert completions.calls == [{}]
+        assert scheduler.stats()["cheap-model"]["granted"] == 1
+        assert scheduler.stats()["cheap-model"]["in_use"] == 0
+    finally:
+        scheduler.stop()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+BatchCompletion against LocalBatchServer: submit, poll, parse, fallback for
+failed requests, and resuming a submitted job from jobs.json after a restart
+"""
+
+import asyncio
+import json
+import os
+import threading
+
+
+class DictKV:
+    """In-memory stand-in for the LLM response cache"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get_by_id(self, id):
+        return self.data.get(id)
+
+    async def upsert(self, data):
+        self.data.update(data)
+
+    async def index_done_callback(self):
+        pass
+
+
+def make_server(release: threading.Event = None):
+    from videorag import LocalBatchServer
+
+    async def complete(body):
+        prompt = body["messages"][-1]["content"]
+        if release is not None:
+            await asyncio.to_thread(release.wait)
+        if prompt.startswith("fail"):
+            raise RuntimeError("model error")
+        return f"batch: {prompt}"
+
+    server = LocalBatchServer(complete)
+    server.start()
+    return server
+
+
+def make_batch(server, working_dir, hashing_kv, fallback_func=None):
+    from videorag._batch import BatchCompletion
+
+    return BatchCompletion(
+        "test-model",
+        str(working_dir),
+        hashing_kv=hashing_kv,
+        fallback_func=fallback_func,
+        base_url=server.base_url,
+        api_key="test",
+        poll_interval=0.05,
+    )
+
+
+def submitted_jobs(working_dir) -> dict:
+    state_file = os.path.join(str(working_dir), "_batch", "jobs.json")
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_batch_round_with_fallback(tmp_path, algorithm_videorag):
+    server = make_server()
+    fallback_prompts = []
+
+    async def fallback(prompt, history_messages=[]):
+        fallback_prompts.append(prompt)
+        return f"fallback: {prompt}"
+
+    try:
+        hashing_kv = DictKV()
+        batch = make_batch(server, tmp_path, hashing_kv, fallback)
+
+        async def run():
+            return await asyncio.gather(
+                *[batch.track(batch(prompt)) for prompt in ("alpha", "beta", "fail-gamma")]
+            )
+
+        answers = asyncio.run(run())
+        assert answers == ["batch: alpha", "batch: beta", "fallback: fail-gamma"]
+        assert fallback_prompts == ["fail-gamma"]
+        # one round for all three tracked callers
+        assert len(server.batches) == 1
+        assert sorted(v["return"] for v in hashing_kv.data.values()) == ["batch: alpha", "batch: beta"]
+        assert submitted_jobs(tmp_path) == {}
+
+        # answered from the cache, without another batch
+        assert asyncio.run(batch("alpha")) == "batch: alpha"
+        assert len(server.batches) == 1
+    finally:
+        server.stop()
+
+
+def test_batch_resumes_submitted_job_after_restart(tmp_path, algorithm_videorag):
+    release = threading.Event()
+    server = make_server(release)
+    try:
+        hashing_kv = DictKV()
+        prompts = ("alpha", "beta")
+
+        async def submit_then_stop():
+            batch = make_batch(server, tmp_path, hashing_kv)
+            calls = asyncio.gather(*[batch.track(batch(p)) for p in prompts])
+            while not submitted_jobs(tmp_path):
+                await asyncio.sleep(0.01)
+            # leaving asyncio.run cancels the callers and the polling, as a
+            # stopped ingestion would
+            calls.cancel()
+
+        asyncio.run(submit_then_stop())
+        assert len(submitted_jobs(tmp_path)) == 1
+        assert len(server.batches) == 1
+
+        release.set()
+
+        async def restart():
+            batch = make_batch(server, tmp_path, hashing_kv)
+            return await asyncio.gather(*[batch.track(batch(p)) for p in prompts])
+
+        assert asyncio.run(restart()) == ["batch: alpha", "batch: beta"]
+        # polled the recorded job instead of submitting it again
+        assert len(server.batches) == 1
+        assert submitted_jobs(tmp_path) == {}
+    finally:
+        release.set()
+        server.stop()
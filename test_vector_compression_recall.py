@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+recall@k of the compressed MmapVectorDB layouts against exact float32 search
+"""
+
+import numpy as np
+import pytest
+
+NUM_VECTORS = 5000
+DIM = 256
+NUM_QUERIES = 50
+K = 10
+
+
+def exact_top_k(vectors, queries, k):
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    return [set(np.argsort(-(vectors @ q))[:k].tolist()) for q in queries]
+
+
+@pytest.mark.parametrize(
+    "dtype, rescore_factor, min_recall",
+    [
+        ("float16", 0, 0.99),
+        ("int8", 0, 0.95),
+        ("float16", 4, 0.99),
+        ("int8", 4, 0.99),
+    ],
+)
+def test_compressed_recall_at_k(tmp_path, algorithm_videorag, dtype, rescore_factor, min_recall):
+    from videorag._storage.vdb_mmap import MmapVectorDB
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((NUM_VECTORS, DIM), dtype=np.float32)
+    # queries are noisy copies of stored vectors, so neighbourhoods are meaningful
+    queries = vectors[rng.choice(NUM_VECTORS, NUM_QUERIES, replace=False)]
+    queries = queries + 0.5 * rng.standard_normal(queries.shape, dtype=np.float32)
+    truth = exact_top_k(vectors, queries, K)
+
+    prefix = str(tmp_path / "vdb_recall")
+    client = MmapVectorDB(DIM, prefix, dtype=dtype, rescore_factor=rescore_factor)
+    client.upsert([{"__id__": str(i), "__vector__": v} for i, v in enumerate(vectors)])
+    client.save()
+    # query the memory-mapped files, not the rows still held from the upsert
+    client = MmapVectorDB(DIM, prefix, dtype=dtype, rescore_factor=rescore_factor)
+    assert client.dtype == np.dtype(dtype)
+
+    results = client.query_batch(queries, top_k=K)
+    hits = sum(
+        len({int(r["__id__"]) for r in result} & expected)
+        for result, expected in zip(results, truth)
+    )
+    recall = hits / (K * NUM_QUERIES)
+    assert recall >= min_recall, f"{dtype} (rescore x{rescore_factor}) recall@{K} {recall:.3f} < {min_recall}"